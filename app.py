@@ -1,82 +1,93 @@
-from flask import Flask, jsonify
+from flask import Flask, jsonify, Response, stream_with_context
 from flask_cors import CORS
+from flask.json.provider import DefaultJSONProvider
 from config import Config
 from backend.models import init_db
-from backend.models import get_bnpl_records, insert_bnpl_record, clear_bnpl_records, get_user_salary, update_user_salary, get_user_profile, update_user_profile, update_bnpl_status, get_bnpl_record_by_id, is_gmail_message_processed
-from backend.finance import calculate_analysis, calculate_affordability
+from backend.models import get_bnpl_records, insert_bnpl_record, clear_bnpl_records, get_user_salary, update_user_salary, get_user_profile, update_user_profile, update_bnpl_status, get_bnpl_record_by_id, is_gmail_message_processed, get_record_merges, update_bnpl_statuses, get_dashboard_snapshot, get_data_version, get_bnpl_records_page, get_dues_calendar, due_date_ordinal, iter_export_rows, EXPORT_FIELDS
+from backend.archive import start_compaction_scheduler
+from backend.reminders import start_reminder_dispatcher
+from backend.jobs import RUN_BACKGROUND_JOBS
+from backend.risk_history import get_risk_history, RESOLUTIONS
+from backend.email_cache import cache_messages
+from backend.ttl_store import create_store
+from backend.http_client import OUTBOUND_TIMEOUT
+from backend.gemini import generate_reply, stream_reply, GeminiError, GeminiBlocked, chat_metrics
+from backend.chat_context import build_context, context_stats
+from backend.records import record_type, dumps as dump_records, encode_rows
+from backend.simulation import simulate_cash_flow, payoff_plan, PAYOFF_STRATEGIES, DEFAULT_PATHS, MAX_PATHS, MIN_MONTHS, MAX_MONTHS
+from backend.finance import calculate_affordability, get_cached_analysis, get_cached_affordability, metrics_cache_stats, get_cached_totals, analysis_from_totals, what_if, month_key, format_month, parse_month, month_risk
 from backend.gmail_service import create_flow, get_gmail_service, fetch_gmail_messages, get_user_email
 from flask import redirect, session, request
 from backend.gmail_service import get_credentials_from_session
+from backend.security import rate_limit, client_ip, store_credentials, load_credentials, revoke_credentials, issue_token, decode_token, credentials_to_dict, credentials_from_dict
 from backend.parser import parse_bnpl_email, is_bnpl_email
 import os
+import sys
 from dotenv import load_dotenv
-import jwt
 import json
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
 import uuid
-import json
-import requests
+import hashlib
+import csv
+import io
+import zlib
 
 load_dotenv()
 
-# Temporary storage for auth codes (maps code → credentials)
-AUTH_CODE_STORE = {}
+# Seconds an auth code from /auth/callback stays redeemable
+AUTH_CODE_TTL = 300
+
+# Temporary storage for auth codes (maps code → email + vault handle), shared by all workers
+AUTH_CODE_STORE = create_store("auth_codes")
+
+class RecordJSONProvider(DefaultJSONProvider):
+    """jsonify with a fast path for compact records; everything else goes through Flask's encoder"""
+    def dumps(self, obj, **kwargs):
+        return dump_records(obj, lambda value: super(RecordJSONProvider, self).dumps(value, **kwargs))
 
 app = Flask(__name__)
+app.json = RecordJSONProvider(app)
+
+# Create tables on every shard (gunicorn never runs the __main__ block below)
+init_db()
+# Compaction and reminders run in the separate worker process (python -m backend.jobs),
+# not once per gunicorn worker; RUN_BACKGROUND_JOBS=1 keeps them in a single-process app
+if RUN_BACKGROUND_JOBS:
+    start_compaction_scheduler()
+    start_reminder_dispatcher()
+
+
+def get_bearer_payload():
+    """Verified JWT payload from the Authorization header, or None"""
+    parts = (request.headers.get("Authorization") or "").split()
+    if len(parts) == 2 and parts[0].lower() == "bearer":
+        return decode_token(parts[1])
+    return None
 
 
 def get_user_email_from_request():
     """Get current user email from JWT token (Authorization header) or session. Works for cross-origin (Vercel->Railway)."""
     # 1. Try JWT from Authorization header (used by frontend after code exchange)
-    token = None
-    if request.headers.get("Authorization"):
-        parts = request.headers.get("Authorization").split()
-        if len(parts) == 2 and parts[0].lower() == "bearer":
-            token = parts[1]
-    if token:
-        try:
-            payload = jwt.decode(
-                token,
-                app.config.get("SECRET_KEY", os.getenv("SECRET_KEY", "default-secret")),
-                algorithms=["HS256"]
-            )
-            return payload.get("email")
-        except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
-            pass
+    payload = get_bearer_payload()
+    if payload and payload.get("email"):
+        return payload["email"]
     # 2. Fall back to session (same-origin or when cookie is sent)
     return session.get("user_email")
 
 
 def get_credentials_from_request():
     """Get Gmail credentials from JWT token or session. Returns (creds, user_email) or (None, None)."""
-    from google.oauth2.credentials import Credentials
-    # 1. Try JWT from Authorization header
-    token = None
-    if request.headers.get("Authorization"):
-        parts = request.headers.get("Authorization").split()
-        if len(parts) == 2 and parts[0].lower() == "bearer":
-            token = parts[1]
-    if token:
-        try:
-            payload = jwt.decode(
-                token,
-                app.config.get("SECRET_KEY", os.getenv("SECRET_KEY", "default-secret")),
-                algorithms=["HS256"]
-            )
-            user_email = payload.get("email")
-            creds_data = payload.get("credentials")
-            if user_email and creds_data:
-                creds = Credentials(
-                    token=creds_data.get("token"),
-                    refresh_token=creds_data.get("refresh_token"),
-                    token_uri=creds_data.get("token_uri"),
-                    client_id=creds_data.get("client_id"),
-                    client_secret=creds_data.get("client_secret"),
-                    scopes=creds_data.get("scopes") or []
-                )
+    # 1. Try JWT from Authorization header; the token only names a vault handle
+    payload = get_bearer_payload()
+    if payload and payload.get("email"):
+        user_email = payload["email"]
+        if payload.get("cid"):
+            creds = load_credentials(payload["cid"], user_email)
+            if creds:
                 return creds, user_email
-        except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
-            pass
+        elif payload.get("credentials"):
+            # Tokens minted before the credential vault embed the credentials
+            return credentials_from_dict(payload["credentials"]), user_email
     # 2. Fall back to session
     creds = get_credentials_from_session(session)
     if creds:
@@ -98,68 +109,158 @@ def health():
     return jsonify({"status": "ok"})
 
 
+@app.route("/api/metrics/chat")
+def chat_metrics_view():
+    """Gemini upstream latency, FAQ reply cache and context summary statistics"""
+    return jsonify(dict(chat_metrics(), context=context_stats()))
+
+@app.route("/api/metrics/cache")
+def cache_metrics():
+    """Hit/miss/eviction counters of this worker's derived-metrics cache"""
+    return jsonify(metrics_cache_stats())
+
+
+def data_etag(user_email, data_version, *variant):
+    """
+    Weak ETag for a read endpoint, derived from the user's data version.
+    The user hash keeps a browser cache from replaying another account's response.
+    """
+    user_hash = hashlib.sha1(user_email.encode("utf-8")).hexdigest()[:12]
+    return "-".join([user_hash, str(data_version)] + [str(v) for v in variant])
+
+
+def not_modified_response(etag):
+    """304 response when the client's If-None-Match already holds etag, else None"""
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        return with_etag(response, etag)
+    return None
+
+
+def with_etag(response, etag):
+    response.set_etag(etag, weak=True)
+    # Clients may store the body but must revalidate on every poll
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+# Columns calculate_analysis reads
+ANALYSIS_FIELDS = ("amount", "installments", "due_date", "status")
+
+def get_user_metrics(user_email, profile, data_version=None, records=None):
+    """
+    Analysis and affordability for a user, served from the derived-metrics cache.
+    The analysis scores all of the user's records with their stored salary, as
+    /api/risk-score always has; records (every status) and the salary are only loaded
+    on a cache miss for the user's current data version. Affordability uses the
+    profile salary and is None for users without a profile.
+    """
+    if data_version is None:
+        data_version = get_data_version(user_email)
+
+    def load_analysis_inputs():
+        loaded = records
+        if loaded is None:
+            loaded = get_bnpl_records(user_email, fields=ANALYSIS_FIELDS)
+        return get_user_salary(user_email), loaded
+
+    analysis = get_cached_analysis(user_email, data_version, load_analysis_inputs)
+    if not profile:
+        return analysis, None
+
+    affordability_data = get_cached_affordability(
+        user_email,
+        data_version,
+        lambda: (profile["salary"], analysis["monthly_obligation"], profile["monthly_rent"], profile["other_expenses"])
+    )
+    return analysis, affordability_data
+
+
+# Token-bucket budgets as (burst, refill seconds): each Gmail sync makes ~50 API calls,
+# each chat message one Gemini call on the shared key
+SYNC_RATE_LIMIT = {"user": (5, 600), "ip": (20, 600)}
+CHAT_RATE_LIMIT = {"user": (20, 60), "ip": (60, 60)}
+
+
+def build_chat_contents(data, gemini_key):
+    """
+    Token-budgeted (contents, system instruction, summary refresh) for a chat request
+    body, or None when the message is missing
+    """
+    owner = get_user_email_from_request() or f"ip:{client_ip()}"
+    return build_context(data, gemini_key, owner)
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
 @app.route("/api/chat", methods=["POST"])
+@rate_limit("chat", get_user=get_user_email_from_request, **CHAT_RATE_LIMIT)
 def chat():
     """
     Simple chatbot endpoint that proxies to Google's Gemini API.
-    Expects JSON: { "message": string, "history": [{ "role": "user"|"assistant", "content": string }] }
+    Expects JSON: { "message": string, "history": [{ "role": "user"|"assistant", "content": string }],
+                    "conversation_id": string (optional, enables the cached rolling summary) }
     """
     gemini_key = os.getenv("GEMINI_API_KEY")
     if not gemini_key:
         return jsonify({"error": "Chatbot is not configured. Set GEMINI_API_KEY in backend env."}), 500
 
-    data = request.get_json() or {}
-    message = (data.get("message") or "").strip()
-    history = data.get("history") or []
-
-    if not message:
+    context = build_chat_contents(request.get_json() or {}, gemini_key)
+    if not context:
         return jsonify({"error": "Message is required"}), 400
+    contents, system, refresh_summary = context
 
-    # Build Gemini contents from last few turns to keep context small
-    contents = []
-    for turn in history[-8:]:
-        role = "user" if turn.get("role") == "user" else "model"
-        text = (turn.get("content") or "").strip()
-        if not text:
-            continue
-        contents.append({"role": role, "parts": [{"text": text}]})
+    try:
+        text = generate_reply(contents, gemini_key, system=system)
+    except GeminiError as e:
+        return jsonify({"error": str(e)}), 502
+
+    response = jsonify({"reply": text})
+    if refresh_summary:
+        # Summarize older turns once the reply has been sent
+        response.call_on_close(refresh_summary)
+    return response
+
+@app.route("/api/chat/stream", methods=["POST"])
+@rate_limit("chat", get_user=get_user_email_from_request, **CHAT_RATE_LIMIT)
+def chat_stream():
+    """
+    Streaming variant of /api/chat over Server-Sent Events. Same request body.
+    Events: 'chunk' {text} as Gemini produces it, then 'done' {}, or 'error'
+    {error, blocked} if the upstream fails or a safety filter stops the reply
+    part-way. A client disconnect closes the upstream request.
+    """
+    gemini_key = os.getenv("GEMINI_API_KEY")
+    if not gemini_key:
+        return jsonify({"error": "Chatbot is not configured. Set GEMINI_API_KEY in backend env."}), 500
 
-    contents.append({"role": "user", "parts": [{"text": message}]})
+    context = build_chat_contents(request.get_json() or {}, gemini_key)
+    if not context:
+        return jsonify({"error": "Message is required"}), 400
+    contents, system, refresh_summary = context
 
-    try:
-        resp = requests.post(
-            "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent",
-            params={"key": gemini_key},
-            json={
-                "contents": contents,
-                "safetySettings": [
-                    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                ],
-            },
-            timeout=20,
-        )
-        resp.raise_for_status()
-        payload = resp.json()
-        candidates = payload.get("candidates") or []
-        if not candidates:
-            return jsonify({"error": "No response from AI"}), 502
-
-        parts = (candidates[0].get("content") or {}).get("parts") or []
-        text = ""
-        for part in parts:
-            if "text" in part:
-                text += part["text"]
-
-        if not text:
-            return jsonify({"error": "Empty response from AI"}), 502
-
-        return jsonify({"reply": text})
-    except requests.RequestException as e:
-        print(f"[Chat] Request error: {e}")
-        return jsonify({"error": "Failed to contact AI service"}), 502
+    def events():
+        stream = stream_reply(contents, gemini_key, system=system)
+        try:
+            for text in stream:
+                yield sse_event("chunk", {"text": text})
+            yield sse_event("done", {})
+        except GeminiError as e:
+            yield sse_event("error", {"error": str(e), "blocked": isinstance(e, GeminiBlocked)})
+        finally:
+            # Runs when the server closes the response after a disconnect, too
+            stream.close()
+
+    response = Response(events(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+    if refresh_summary:
+        # Summarize older turns after the stream ends, never before the first chunk
+        response.call_on_close(refresh_summary)
+    return response
 
 @app.route("/api/user/email")
 def get_current_user_email():
@@ -227,27 +328,80 @@ def user_profile():
             }), 500
     
     # GET request
+    etag = data_etag(user_email, get_data_version(user_email), "profile")
+    cached = not_modified_response(etag)
+    if cached:
+        return cached
+    
     profile = get_user_profile(user_email)
-    if profile:
-        return jsonify({
-            "success": True,
-            "data": profile
-        })
-    else:
-        return jsonify({
-            "success": True,
-            "data": {
-                "email": user_email,
-                "salary": 30000,
-                "full_name": None,
-                "monthly_rent": 0,
-                "other_expenses": 0,
-                "city": None,
-                "existing_loans": 0
-            }
-        })
+    return with_etag(jsonify({
+        "success": True,
+        "data": profile or default_profile(user_email)
+    }), etag)
+
+def default_profile(user_email):
+    """Profile returned for users who have not completed onboarding yet"""
+    return {
+        "email": user_email,
+        "salary": 30000,
+        "full_name": None,
+        "monthly_rent": 0,
+        "other_expenses": 0,
+        "city": None,
+        "existing_loans": 0
+    }
+
+DASHBOARD_SECTIONS = ("profile", "records", "risk", "affordability")
+
+@app.route("/api/dashboard")
+def dashboard():
+    """
+    Everything the dashboard needs in one round-trip, computed from one read transaction.
+    Query params:
+    - sections: comma-separated subset of profile, records, risk, affordability (default: all)
+    """
+    user_email = get_user_email_from_request()
+    if not user_email:
+        return jsonify({"error": "Not authenticated"}), 401
+    
+    requested = request.args.get("sections")
+    sections = [s.strip() for s in requested.split(",") if s.strip()] if requested else list(DASHBOARD_SECTIONS)
+    unknown = [s for s in sections if s not in DASHBOARD_SECTIONS]
+    if unknown:
+        return jsonify({"error": f"Unknown sections: {', '.join(unknown)}"}), 400
+    
+    # Risk includes upcoming dues, which shift with the date
+    etag = data_etag(user_email, get_data_version(user_email), "dashboard", ".".join(sections), date.today().toordinal())
+    cached = not_modified_response(etag)
+    if cached:
+        return cached
+    
+    profile, records, data_version = get_dashboard_snapshot(
+        user_email,
+        include_records=any(s in sections for s in ("records", "risk", "affordability"))
+    )
+    
+    result = {}
+    
+    if "profile" in sections:
+        result["profile"] = profile or default_profile(user_email)
+    
+    if "records" in sections:
+        result["records"] = records
+        result["count"] = len(records)
+    
+    if "risk" in sections or "affordability" in sections:
+        # Same rule as /api/affordability: no affordability before onboarding
+        analysis, affordability_data = get_user_metrics(user_email, profile, data_version=data_version, records=records)
+        if "risk" in sections:
+            result["risk"] = analysis
+        if "affordability" in sections:
+            result["affordability"] = affordability_data
+    
+    return with_etag(jsonify(result), etag)
 
 @app.route("/api/emails/sync")
+@rate_limit("sync", get_user=get_user_email_from_request, **SYNC_RATE_LIMIT)
 def sync_emails():
     """
     Fetch Gmail messages, parse BNPL data with STRICT filtering, and store in database.
@@ -303,6 +457,12 @@ def sync_emails():
             }
         })
     
+    # Keep the raw emails locally so parser changes can be replayed without Gmail
+    try:
+        cache_messages(user_email, messages)
+    except Exception as e:
+        print(f"[Sync] WARNING: Could not cache raw emails - {e}")
+    
     print(f"[Sync] Processing {len(messages)} messages with IDEMPOTENT + STRICT filtering...")
     
     # Parse and store BNPL records with idempotent logic
@@ -367,12 +527,56 @@ def sync_emails():
         }
     })
 
+# Largest page /api/bnpl/records will return
+MAX_RECORDS_PAGE = 500
+
+def parse_record_filters(args):
+    """
+    Shared query params of record listings: fields, vendor, due_from, due_to.
+    Dates are YYYY-MM-DD or DD/MM/YYYY. Raises ValueError with a client-facing message.
+    """
+    filters = {}
+    if args.get("fields"):
+        filters["fields"] = [f.strip() for f in args["fields"].split(",") if f.strip()]
+    if args.get("vendor"):
+        filters["vendor"] = args["vendor"]
+    for param in ("due_from", "due_to"):
+        value = args.get(param)
+        if not value:
+            continue
+        ordinal = due_date_ordinal(value)
+        if ordinal is None:
+            try:
+                ordinal = datetime.strptime(value, "%Y-%m-%d").toordinal()
+            except ValueError:
+                raise ValueError(f"{param} must be YYYY-MM-DD or DD/MM/YYYY")
+        filters[param] = ordinal
+    return filters
+
+def parse_page_limit(args, default=None, maximum=MAX_RECORDS_PAGE):
+    """limit query param as an int in 1..maximum; raises ValueError on bad input."""
+    value = args.get("limit")
+    if value is None:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    return min(limit, maximum)
+
 @app.route("/api/bnpl/records")
 def bnpl_records():
     """
-    Get all BNPL records for authenticated user.
+    Get BNPL records for authenticated user, newest first.
     Query params:
     - status: 'active', 'paid', or None for all
+    - limit: page size (max 500); without it every record is returned
+    - cursor: next_cursor from the previous page
+    - fields: comma-separated columns to return (default: all)
+    - vendor: case-insensitive vendor name
+    - due_from, due_to: due-date range, YYYY-MM-DD or DD/MM/YYYY
     """
     user_email = get_user_email_from_request()
     if not user_email:
@@ -380,32 +584,168 @@ def bnpl_records():
     
     status_filter = request.args.get("status")  # Can be 'active', 'paid', or None
     
-    records = get_bnpl_records(user_email, status_filter=status_filter)
+    # Answer unchanged polls before touching the records table
+    query_hash = hashlib.sha1(request.query_string).hexdigest()[:12]
+    etag = data_etag(user_email, get_data_version(user_email), "records", query_hash)
+    cached = not_modified_response(etag)
+    if cached:
+        return cached
     
-    return jsonify({
+    try:
+        filters = parse_record_filters(request.args)
+        limit = parse_page_limit(request.args)
+        if limit:
+            records, next_cursor = get_bnpl_records_page(
+                user_email, limit, cursor=request.args.get("cursor"), status_filter=status_filter, **filters
+            )
+        else:
+            records = get_bnpl_records(user_email, status_filter=status_filter, **filters)
+            next_cursor = None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    return with_etag(jsonify({
         "records": records,
-        "count": len(records)
+        "count": len(records),
+        "next_cursor": next_cursor
+    }), etag)
+
+@app.route("/api/bnpl/merges")
+def bnpl_merges():
+    """
+    List duplicate-reminder merges for the authenticated user:
+    each canonical record with the Gmail message ids folded into it.
+    """
+    user_email = get_user_email_from_request()
+    if not user_email:
+        return jsonify({"error": "Not authenticated"}), 401
+    
+    merges = get_record_merges(user_email)
+    
+    return jsonify({
+        "merges": merges,
+        "count": len(merges)
     })
 
 @app.route("/api/risk-score")
 def risk_score():
     """
     Calculate and return risk analysis.
+    With ?month=YYYY-MM the risk of that calendar month's installment dues is
+    returned instead, read from the precomputed dues calendar.
     """
     user_email = get_user_email_from_request()
     if not user_email:
         return jsonify({"error": "Not authenticated"}), 401
     
-    # Get user salary
-    salary = get_user_salary(user_email)
+    if request.args.get("month"):
+        try:
+            month = parse_month(request.args["month"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        data_version = get_data_version(user_email)
+        etag = data_etag(user_email, data_version, "risk-month", month)
+        cached = not_modified_response(etag)
+        if cached:
+            return cached
+        profile = get_user_profile(user_email)
+        [(_, dues, installment_count)] = get_dues_calendar(user_email, month, 1)
+        result = month_risk(profile["salary"] if profile else 30000, dues)
+        result.update(month=format_month(month), installment_count=installment_count)
+        return with_etag(jsonify(result), etag)
     
-    # Get BNPL records
-    records = get_bnpl_records(user_email)
+    # Answer unchanged polls before recomputing; upcoming dues shift with the date
+    data_version = get_data_version(user_email)
+    etag = data_etag(user_email, data_version, "risk", date.today().toordinal())
+    cached = not_modified_response(etag)
+    if cached:
+        return cached
     
-    # Calculate analysis
-    analysis = calculate_analysis(salary, records)
+    # Cached per data version; records are only read on a miss
+    profile = get_user_profile(user_email)
+    analysis, _ = get_user_metrics(user_email, profile, data_version=data_version)
     
-    return jsonify(analysis)
+    return with_etag(jsonify(analysis), etag)
+
+# Default history window per resolution, in days
+HISTORY_DEFAULT_DAYS = {"raw": 30, "day": 90, "week": 365, "month": 730}
+
+@app.route("/api/risk-score/history")
+def risk_score_history():
+    """
+    Stored risk-score history; nothing is recomputed.
+    Query params:
+    - resolution: raw (every change), day, week or month (default day)
+    - from, to: YYYY-MM-DD (default: a window ending today that suits the resolution)
+    """
+    user_email = get_user_email_from_request()
+    if not user_email:
+        return jsonify({"error": "Not authenticated"}), 401
+    
+    resolution = request.args.get("resolution", "day")
+    if resolution not in HISTORY_DEFAULT_DAYS:
+        return jsonify({"error": f"resolution must be raw or one of {', '.join(RESOLUTIONS)}"}), 400
+    try:
+        last_day = datetime.strptime(request.args["to"], "%Y-%m-%d").date() if request.args.get("to") else date.today()
+        first_day = (datetime.strptime(request.args["from"], "%Y-%m-%d").date() if request.args.get("from")
+                     else last_day - timedelta(days=HISTORY_DEFAULT_DAYS[resolution]))
+    except ValueError:
+        return jsonify({"error": "from and to must be YYYY-MM-DD"}), 400
+    if first_day > last_day:
+        return jsonify({"error": "from must not be after to"}), 400
+    
+    data_version = get_data_version(user_email)
+    etag = data_etag(user_email, data_version, "risk-history", resolution, first_day.toordinal(),
+                     last_day.toordinal(), date.today().toordinal())
+    cached = not_modified_response(etag)
+    if cached:
+        return cached
+    
+    points = get_risk_history(user_email, resolution, first_day, last_day)
+    return with_etag(jsonify({
+        "resolution": resolution,
+        "from": first_day.isoformat(),
+        "to": last_day.isoformat(),
+        "points": points
+    }), etag)
+
+MAX_CALENDAR_MONTHS = 36
+
+@app.route("/api/dues-calendar")
+def dues_calendar():
+    """
+    Installment dues per calendar month for the authenticated user.
+    Query params:
+    - from: first month, YYYY-MM (default: current month)
+    - months: number of months, 1-36 (default 12)
+    """
+    user_email = get_user_email_from_request()
+    if not user_email:
+        return jsonify({"error": "Not authenticated"}), 401
+    
+    try:
+        first_month = parse_month(request.args["from"]) if request.args.get("from") else month_key(date.today())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    months = request.args.get("months", "12")
+    if not months.isdigit() or not 1 <= int(months) <= MAX_CALENDAR_MONTHS:
+        return jsonify({"error": f"months must be between 1 and {MAX_CALENDAR_MONTHS}"}), 400
+    months = int(months)
+    
+    data_version = get_data_version(user_email)
+    etag = data_etag(user_email, data_version, "dues", first_month, months)
+    cached = not_modified_response(etag)
+    if cached:
+        return cached
+    
+    calendar = [
+        {"month": format_month(month), "amount": round(amount, 2), "installment_count": count}
+        for month, amount, count in get_dues_calendar(user_email, first_month, months)
+    ]
+    return with_etag(jsonify({
+        "months": calendar,
+        "total": round(sum(entry["amount"] for entry in calendar), 2)
+    }), etag)
 
 @app.route("/api/affordability")
 def affordability():
@@ -416,28 +756,170 @@ def affordability():
     if not user_email:
         return jsonify({"error": "Not authenticated"}), 401
     
+    data_version = get_data_version(user_email)
+    etag = data_etag(user_email, data_version, "affordability")
+    cached = not_modified_response(etag)
+    if cached:
+        return cached
+    
     # Get user profile
     profile = get_user_profile(user_email)
     if not profile:
         return jsonify({"error": "User profile not found"}), 404
     
-    salary = profile.get("salary", 30000)
-    rent = profile.get("monthly_rent", 0)
-    other_expenses = profile.get("other_expenses", 0)
+    # Monthly obligation comes from the (cached) analysis of the active records
+    _, affordability_data = get_user_metrics(user_email, profile, data_version=data_version)
+    
+    return with_etag(jsonify(affordability_data), etag)
+
+MAX_WHAT_IF_PURCHASES = 10
+MAX_WHAT_IF_INSTALLMENTS = 60
+
+def parse_purchases(data):
+    """
+    Hypothetical purchases of a what-if request as active record dicts.
+    due_date (YYYY-MM-DD or DD/MM/YYYY) defaults to 30 days from today.
+    Raises ValueError with a client-facing message.
+    """
+    purchases = data.get("purchases")
+    if purchases is None and "amount" in data:
+        purchases = [data]
+    if not isinstance(purchases, list) or not 1 <= len(purchases) <= MAX_WHAT_IF_PURCHASES:
+        raise ValueError(f"purchases must be a list of 1 to {MAX_WHAT_IF_PURCHASES} purchases")
+
+    default_due = (date.today() + timedelta(days=30)).strftime("%d/%m/%Y")
+    records = []
+    for purchase in purchases:
+        if not isinstance(purchase, dict):
+            raise ValueError("Each purchase must be an object")
+        amount = purchase.get("amount")
+        installments = purchase.get("installments", 1)
+        if isinstance(amount, bool) or not isinstance(amount, (int, float)) or not 0 < amount < 1e9:
+            raise ValueError("amount must be a positive number")
+        if isinstance(installments, bool) or not isinstance(installments, int) \
+                or not 1 <= installments <= MAX_WHAT_IF_INSTALLMENTS:
+            raise ValueError(f"installments must be an integer between 1 and {MAX_WHAT_IF_INSTALLMENTS}")
+        due_date = default_due
+        if purchase.get("due_date"):
+            ordinal = due_date_ordinal(purchase["due_date"])
+            if ordinal is None:
+                try:
+                    ordinal = datetime.strptime(purchase["due_date"], "%Y-%m-%d").toordinal()
+                except (TypeError, ValueError):
+                    raise ValueError("due_date must be YYYY-MM-DD or DD/MM/YYYY")
+            due_date = date.fromordinal(ordinal).strftime("%d/%m/%Y")
+        records.append({"amount": amount, "installments": installments, "due_date": due_date, "status": "active"})
+    return records
+
+@app.route("/api/what-if", methods=["POST"])
+def what_if_purchase():
+    """
+    Risk and affordability if hypothetical purchases were added; nothing is written.
+    Expects JSON: { "purchases": [{ "amount": number, "installments": int, "due_date": string (optional) }] }
+    or a single purchase at the top level. The current totals are cached per data
+    version, so each call only adds the purchases to them.
+    """
+    user_email = get_user_email_from_request()
+    if not user_email:
+        return jsonify({"error": "Not authenticated"}), 401
+    
+    try:
+        purchases = parse_purchases(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    data_version = get_data_version(user_email)
+    profile = get_user_profile(user_email)
+    salary = profile["salary"] if profile else 30000
+    totals = get_cached_totals(
+        user_email, data_version,
+        lambda: get_bnpl_records(user_email, status_filter="active", fields=("amount", "installments", "due_date", "status"))
+    )
+    expenses = (profile["monthly_rent"], profile["other_expenses"]) if profile else None
+    return jsonify(what_if(salary, totals, purchases, expenses))
+
+@app.route("/api/simulation")
+def cash_flow_simulation():
+    """
+    Monte Carlo projection of the user's cash flow: probability of EMIs breaching
+    the 30% safe limit and percentile bands per month.
+    Query params:
+    - paths: number of scenarios (default 10000, max 50000)
+    - months: horizon, 12-24 (default 12)
+    - seed: integer; the same seed and data give the same result (default 0)
+    """
+    user_email = get_user_email_from_request()
+    if not user_email:
+        return jsonify({"error": "Not authenticated"}), 401
+    
+    try:
+        paths = int(request.args.get("paths", DEFAULT_PATHS))
+        months = int(request.args.get("months", MIN_MONTHS))
+        seed = int(request.args.get("seed", 0))
+    except ValueError:
+        return jsonify({"error": "paths, months and seed must be integers"}), 400
+    if not 1 <= paths <= MAX_PATHS:
+        return jsonify({"error": f"paths must be between 1 and {MAX_PATHS}"}), 400
+    if not MIN_MONTHS <= months <= MAX_MONTHS:
+        return jsonify({"error": f"months must be between {MIN_MONTHS} and {MAX_MONTHS}"}), 400
+    if seed < 0:
+        return jsonify({"error": "seed must not be negative"}), 400
+    
+    # Seeded, so the result only changes with the data or the starting month
+    data_version = get_data_version(user_email)
+    etag = data_etag(user_email, data_version, "simulation", paths, months, seed, month_key(date.today()))
+    cached = not_modified_response(etag)
+    if cached:
+        return cached
+    
+    profile = get_user_profile(user_email)
+    if not profile:
+        return jsonify({"error": "User profile not found"}), 404
+    
+    records = get_bnpl_records(user_email, status_filter="active", fields=("amount", "installments", "due_date"))
+    result = simulate_cash_flow(
+        profile["salary"], profile["monthly_rent"], profile["other_expenses"], records,
+        paths=paths, months=months, seed=seed
+    )
+    return with_etag(jsonify(result), etag)
+
+@app.route("/api/payoff-plan")
+def payoff_plans():
+    """
+    Month-by-month payoff plans for the active records, with the monthly surplus taken
+    from the user's disposable income.
+    Query params:
+    - strategy: avalanche, snowball, risk or all (default all)
+    """
+    user_email = get_user_email_from_request()
+    if not user_email:
+        return jsonify({"error": "Not authenticated"}), 401
     
-    # Get BNPL records (only active)
-    records = get_bnpl_records(user_email, status_filter="active")
+    strategy = request.args.get("strategy", "all")
+    if strategy != "all" and strategy not in PAYOFF_STRATEGIES:
+        return jsonify({"error": f"strategy must be all or one of {', '.join(PAYOFF_STRATEGIES)}"}), 400
     
-    # Calculate monthly obligation
-    monthly_bnpl_obligation = 0
-    for record in records:
-        if record["amount"] and record["installments"] and record["installments"] > 0:
-            monthly_bnpl_obligation += record["amount"] / record["installments"]
+    data_version = get_data_version(user_email)
+    etag = data_etag(user_email, data_version, "payoff", strategy, month_key(date.today()))
+    cached = not_modified_response(etag)
+    if cached:
+        return cached
     
-    # Calculate affordability
-    affordability_data = calculate_affordability(salary, monthly_bnpl_obligation, rent, other_expenses)
+    profile = get_user_profile(user_email)
+    if not profile:
+        return jsonify({"error": "User profile not found"}), 404
     
-    return jsonify(affordability_data)
+    _, affordability_data = get_user_metrics(user_email, profile, data_version=data_version)
+    records = get_bnpl_records(user_email, status_filter="active", fields=("id", "amount", "installments"))
+    strategies = list(PAYOFF_STRATEGIES) if strategy == "all" else [strategy]
+    plans = {
+        name: payoff_plan(records, affordability_data["disposable_income"], name, salary=profile["salary"])
+        for name in strategies
+    }
+    return with_etag(jsonify({
+        "surplus": affordability_data["disposable_income"],
+        "plans": plans
+    }), etag)
 
 @app.route("/api/bnpl/<int:record_id>/mark-paid", methods=["PUT"])
 def mark_bnpl_paid(record_id):
@@ -448,8 +930,8 @@ def mark_bnpl_paid(record_id):
     if not user_email:
         return jsonify({"error": "Not authenticated"}), 401
     
-    # Get the record
-    record = get_bnpl_record_by_id(record_id)
+    # Get the record (looked up on the user's shard)
+    record = get_bnpl_record_by_id(record_id, user_email=user_email)
     if not record:
         return jsonify({"error": "Record not found"}), 404
     
@@ -459,48 +941,196 @@ def mark_bnpl_paid(record_id):
     
     # Update status to paid
     try:
-        update_bnpl_status(record_id, "paid")
+        update_bnpl_status(record_id, "paid", user_email=user_email)
         print(f"[Mark Paid] Record {record_id} marked as paid by {user_email}")
     except Exception as e:
         print(f"[Mark Paid] ERROR: {e}")
         return jsonify({"error": "Failed to update record"}), 500
     
-    # Recalculate financial metrics
+    # Recalculate financial metrics (the write bumped the data version, so this misses the cache)
     profile = get_user_profile(user_email)
-    salary = profile.get("salary", 30000)
-    rent = profile.get("monthly_rent", 0)
-    other_expenses = profile.get("other_expenses", 0)
+    analysis, affordability_data = get_user_metrics(user_email, profile)
+    
+    return jsonify({
+        "success": True,
+        "message": "Payment recorded successfully",
+        "analysis": analysis,
+        "affordability": affordability_data
+    })
+
+# Upper bound on status changes accepted by one batch request
+MAX_BATCH_STATUS_CHANGES = 500
+
+@app.route("/api/bnpl/status", methods=["PUT", "POST"])
+def batch_update_bnpl_status():
+    """
+    Change the status of many BNPL records at once and recalculate financial metrics once.
+    Expects JSON: { "updates": [{ "id": int, "status": "paid"|"active" }] }
+    or the shorthand { "ids": [int], "status": "paid"|"active" }.
+    """
+    user_email = get_user_email_from_request()
+    if not user_email:
+        return jsonify({"error": "Not authenticated"}), 401
+    
+    data = request.get_json() or {}
+    if "updates" in data:
+        updates = data.get("updates") or []
+        changes = [(u.get("id"), u.get("status", "paid")) for u in updates if isinstance(u, dict)]
+    else:
+        changes = [(record_id, data.get("status", "paid")) for record_id in data.get("ids") or []]
     
-    # Get updated BNPL records (only active)
-    records = get_bnpl_records(user_email, status_filter="active")
+    if not changes:
+        return jsonify({"error": "No record ids given"}), 400
+    if len(changes) > MAX_BATCH_STATUS_CHANGES:
+        return jsonify({"error": f"At most {MAX_BATCH_STATUS_CHANGES} records per request"}), 400
+    # bool is an int subclass: JSON true would otherwise address record 1
+    if not all(isinstance(record_id, int) and not isinstance(record_id, bool) for record_id, _ in changes):
+        return jsonify({"error": "Record ids must be integers"}), 400
     
-    # Recalculate analysis
-    analysis = calculate_analysis(salary, records)
+    try:
+        results = update_bnpl_statuses(user_email, changes)
+    except Exception as e:
+        print(f"[Batch Status] ERROR: {e}")
+        return jsonify({"error": "Failed to update records"}), 500
     
-    # Recalculate affordability
-    monthly_bnpl_obligation = analysis["monthly_obligation"]
-    affordability_data = calculate_affordability(salary, monthly_bnpl_obligation, rent, other_expenses)
+    updated = [record_id for record_id, outcome in results.items() if outcome == "updated"]
+    print(f"[Batch Status] {len(updated)} of {len(results)} records updated by {user_email}")
+    
+    # Recalculate financial metrics once for the whole batch
+    profile = get_user_profile(user_email)
+    analysis, affordability_data = get_user_metrics(user_email, profile)
     
     return jsonify({
         "success": True,
-        "message": "Payment recorded successfully",
+        "message": f"Updated {len(updated)} of {len(results)} records",
+        "results": [{"id": record_id, "result": outcome} for record_id, outcome in results.items()],
         "analysis": analysis,
         "affordability": affordability_data
     })
 
+# Users allowed to export every user's records (comma-separated emails)
+EXPORT_ADMIN_EMAILS = {e.strip() for e in os.getenv("EXPORT_ADMIN_EMAILS", "").split(",") if e.strip()}
+
+# Rows fetched from SQLite per chunk of an export stream
+EXPORT_CHUNK_SIZE = 500
+
+def _export_chunks(rows_iter, export_format):
+    """Serialize row chunks as NDJSON or CSV text, one string per chunk"""
+    if export_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        yield buffer.getvalue()
+        for rows in rows_iter:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(rows)
+            yield buffer.getvalue()
+    else:
+        prefixes = record_type(EXPORT_FIELDS).prefixes
+        for rows in rows_iter:
+            yield "".join([line + "\n" for line in encode_rows(rows, prefixes)])
+
+def _gzip_stream(chunks):
+    """Compress a text stream on the fly"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route("/api/export")
+def export_records():
+    """
+    Stream BNPL records as NDJSON or CSV without loading them into memory.
+    Query params:
+    - format: 'ndjson' (default) or 'csv'
+    - gzip: '1' to receive a gzip-compressed file
+    - status: 'active', 'paid', or None for all
+    - scope: 'all' exports every user (only for EXPORT_ADMIN_EMAILS)
+    """
+    user_email = get_user_email_from_request()
+    if not user_email:
+        return jsonify({"error": "Not authenticated"}), 401
+    
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in ("ndjson", "csv"):
+        return jsonify({"error": "format must be ndjson or csv"}), 400
+    
+    scope_user = user_email
+    if request.args.get("scope") == "all":
+        if user_email not in EXPORT_ADMIN_EMAILS:
+            return jsonify({"error": "Unauthorized"}), 403
+        scope_user = None
+    
+    print(f"[Export] {export_format} export for {scope_user or 'all users'} requested by {user_email}")
+    rows_iter = iter_export_rows(scope_user, request.args.get("status"), EXPORT_CHUNK_SIZE)
+    chunks = _export_chunks(rows_iter, export_format)
+    
+    filename = f"bnpl_records.{export_format}"
+    mimetype = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    if request.args.get("gzip") == "1":
+        chunks = _gzip_stream(chunks)
+        filename += ".gz"
+        mimetype = "application/gzip"
+    
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+# Page size of the legacy /api/bnpl listing
+LEGACY_PAGE_SIZE = 100
+
 @app.route("/api/bnpl")
 def get_bnpl():
-    """Legacy endpoint - kept for backward compatibility"""
-    return jsonify(get_bnpl_records())
+    """
+    Legacy endpoint - kept for backward compatibility.
+    Returns one page (limit, default 100, max 500) of the authenticated user's records
+    as a JSON array; the cursor for the next page is in the X-Next-Cursor header.
+    scope=all lists every user's records (only for EXPORT_ADMIN_EMAILS).
+    """
+    user_email = get_user_email_from_request()
+    if not user_email:
+        return jsonify({"error": "Not authenticated"}), 401
+    
+    scope_user = user_email
+    if request.args.get("scope") == "all":
+        if user_email not in EXPORT_ADMIN_EMAILS:
+            return jsonify({"error": "Unauthorized"}), 403
+        scope_user = None
+    
+    try:
+        limit = parse_page_limit(request.args, default=LEGACY_PAGE_SIZE)
+        records, next_cursor = get_bnpl_records_page(scope_user, limit, cursor=request.args.get("cursor"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    response = jsonify(records)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
 
 @app.route("/api/analysis")
 def analysis():
-    """Legacy endpoint - kept for backward compatibility"""
-    fake_profile = {"salary": 30000}
-    records = get_bnpl_records()
-
-    result = calculate_analysis(fake_profile.get("salary"), records)
-    return jsonify(result)
+    """Legacy endpoint - kept for backward compatibility; the authenticated user's analysis"""
+    user_email = get_user_email_from_request()
+    if not user_email:
+        return jsonify({"error": "Not authenticated"}), 401
+    
+    data_version = get_data_version(user_email)
+    etag = data_etag(user_email, data_version, "analysis")
+    cached = not_modified_response(etag)
+    if cached:
+        return cached
+    
+    totals = get_cached_totals(
+        user_email, data_version,
+        lambda: get_bnpl_records(user_email, status_filter="active", fields=("amount", "installments", "due_date", "status"))
+    )
+    return with_etag(jsonify(analysis_from_totals(get_user_salary(user_email) or 30000, totals)), etag)
 
 @app.route("/auth/login")
 def login():
@@ -515,29 +1145,16 @@ def exchange_code():
     """Exchange temporary auth code for credentials"""
     code = request.args.get("code")
     print(f"[Auth] Exchange code request: {code}")
-    print(f"[Auth] Available codes in store: {list(AUTH_CODE_STORE.keys())}")
     
-    if not code or code not in AUTH_CODE_STORE:
-        print(f"[Auth] Code not found in store: {code}")
+    # Codes are single use: take() removes the code atomically, so a retry or a
+    # second worker cannot redeem it again
+    auth_data = AUTH_CODE_STORE.take(code) if code else None
+    if not auth_data:
+        print(f"[Auth] Code not found in store or expired: {code}")
         return jsonify({"authenticated": False, "error": "Invalid or expired code"}), 401
     
-    auth_data = AUTH_CODE_STORE[code]
-    
-    # Check if code expired
-    if auth_data["expires"] < datetime.utcnow():
-        print(f"[Auth] Code expired: {code}")
-        del AUTH_CODE_STORE[code]
-        return jsonify({"authenticated": False, "error": "Code expired"}), 401
-    
-    # Create JWT token
-    token = jwt.encode({
-        "email": auth_data["email"],
-        "exp": datetime.utcnow() + timedelta(days=30),
-        "credentials": auth_data["credentials"]
-    }, app.config.get("SECRET_KEY", os.getenv("SECRET_KEY", "default-secret")), algorithm="HS256")
-    
-    # Cleanup
-    del AUTH_CODE_STORE[code]
+    # Create JWT token (user id + vault handle only)
+    token = issue_token(auth_data["email"], auth_data["handle"])
     print(f"[Auth] Code exchanged successfully: {code}, email: {auth_data['email']}")
     
     return jsonify({
@@ -557,23 +1174,28 @@ def auth_status():
         token = request.args.get("token")
     
     if token:
-        try:
-            payload = jwt.decode(token, app.config.get("SECRET_KEY", os.getenv("SECRET_KEY", "default-secret")), algorithms=["HS256"])
-            user_email = payload.get("email")
-            
-            # Store credentials in session from token
-            if "credentials" in payload:
-                session["credentials"] = payload["credentials"]
-                session["user_email"] = user_email
-            
-            return jsonify({
-                "authenticated": True,
-                "email": user_email
-            })
-        except jwt.ExpiredSignatureError:
-            return jsonify({"authenticated": False, "error": "Token expired"}), 401
-        except jwt.InvalidTokenError:
-            return jsonify({"authenticated": False, "error": "Invalid token"}), 401
+        payload = decode_token(token)
+        if payload is None:
+            return jsonify({"authenticated": False, "error": "Invalid or expired token"}), 401
+        user_email = payload.get("email")
+        
+        # Point the session at the token's vault handle
+        if payload.get("cid"):
+            session.pop("credentials", None)
+            session["credential_handle"] = payload["cid"]
+            session["user_email"] = user_email
+        elif "credentials" in payload and (
+            "credential_handle" not in session or session.get("user_email") != user_email
+        ):
+            # Pre-vault token: move its credentials into the vault once
+            session.pop("credentials", None)
+            session["credential_handle"] = store_credentials(user_email, payload["credentials"])
+            session["user_email"] = user_email
+        
+        return jsonify({
+            "authenticated": True,
+            "email": user_email
+        })
     
     # Fall back to session-based auth
     creds = get_credentials_from_session(session)
@@ -588,6 +1210,10 @@ def auth_status():
 @app.route("/auth/logout")
 def logout():
     """Logout user"""
+    revoke_credentials(session.get("credential_handle"))
+    payload = get_bearer_payload()
+    if payload:
+        revoke_credentials(payload.get("cid"))
     session.clear()
     return jsonify({"message": "Logged out successfully"})
 
@@ -595,40 +1221,24 @@ def logout():
 def callback():
     print("[Auth] Callback triggered")
     flow = create_flow()
-    flow.fetch_token(authorization_response=request.url)
+    flow.fetch_token(authorization_response=request.url, timeout=OUTBOUND_TIMEOUT)
 
     credentials = flow.credentials
-
-    session["credentials"] = {
-        "token": credentials.token,
-        "refresh_token": credentials.refresh_token,
-        "token_uri": credentials.token_uri,
-        "client_id": credentials.client_id,
-        "client_secret": credentials.client_secret,
-        "scopes": credentials.scopes
-    }
     
     # Get and store user email
     user_email = get_user_email(credentials)
     print(f"[Auth] User email from Gmail: {user_email}")
     if user_email:
+        # Credentials go to the encrypted vault; session and token only carry the handle
+        handle = store_credentials(user_email, credentials_to_dict(credentials))
+        session.pop("credentials", None)
+        session["credential_handle"] = handle
         session["user_email"] = user_email
         
         # Create a temporary auth code (short ID) to pass in URL
         auth_code = str(uuid.uuid4())[:8]
-        AUTH_CODE_STORE[auth_code] = {
-            "email": user_email,
-            "credentials": {
-                "token": credentials.token,
-                "refresh_token": credentials.refresh_token,
-                "token_uri": credentials.token_uri,
-                "client_id": credentials.client_id,
-                "client_secret": credentials.client_secret,
-                "scopes": list(credentials.scopes) if credentials.scopes else []
-            },
-            "expires": datetime.utcnow() + timedelta(minutes=5)
-        }
-        print(f"[Auth] Code generated: {auth_code}, expires: {AUTH_CODE_STORE[auth_code]['expires']}")
+        AUTH_CODE_STORE.put(auth_code, {"email": user_email, "handle": handle}, AUTH_CODE_TTL)
+        print(f"[Auth] Code generated: {auth_code}, expires in {AUTH_CODE_TTL}s")
         
         # Check if user has completed profile
         profile = get_user_profile(user_email)
@@ -727,9 +1337,151 @@ def fetch_bnpl():
 
 
 
+def selftest():
+    """
+    Request checks against a scratch database. Conditional GET: a poll carrying the
+    current ETag gets an empty 304 without a record query, and a write makes the next
+    poll a 200 again. Batch status: JSON booleans are rejected as record ids, and an
+    id repeated in one batch is applied once. Legacy /api/bnpl is scoped to the caller.
+    Risk analysis keeps the /api/risk-score rules (all records, stored salary). Chat
+    rejects non-object bodies and summarizes long conversations after the reply.
+    """
+    import tempfile
+    patched = ("get_bnpl_records", "get_bnpl_records_page")
+    originals = {name: globals()[name] for name in patched}
+    queries = []
+
+    def counted(name):
+        def query(*args, **kwargs):
+            queries.append(name)
+            return originals[name](*args, **kwargs)
+        return query
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        globals().update({name: counted(name) for name in patched})
+        try:
+            os.makedirs("database")
+            init_db()
+            user_email = "selftest@example.com"
+            for n in range(50):
+                insert_bnpl_record(user_email, f"msg-{n}", "LazyPay", 1200.0 + n, 3, "01/01/2030", "Installment due")
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess["user_email"] = user_email
+
+            first = client.get("/api/bnpl/records")
+            assert first.status_code == 200 and queries == ["get_bnpl_records"]
+            etag = first.headers["ETag"]
+
+            unchanged = client.get("/api/bnpl/records", headers={"If-None-Match": etag})
+            assert unchanged.status_code == 304 and unchanged.data == b"", "unchanged poll was not an empty 304"
+            assert len(queries) == 1, "a 304 queried the records"
+            assert unchanged.headers["ETag"] == etag
+
+            record_id = first.get_json()["records"][0]["id"]
+            update_bnpl_status(record_id, "paid", user_email)
+            changed = client.get("/api/bnpl/records", headers={"If-None-Match": etag})
+            assert changed.status_code == 200 and len(queries) == 2 and changed.headers["ETag"] != etag
+
+            print(f"[ETag] Unchanged poll: 304 with 0 body bytes instead of {len(first.data)}, no record query")
+            print("[ETag] Poll after a write: 200 with a new ETag")
+
+            # Record 1 is still active; true must not address it
+            for body in ({"ids": [True]}, {"updates": [{"id": True, "status": "paid"}]}):
+                rejected = client.post("/api/bnpl/status", json=body)
+                assert rejected.status_code == 400, f"{body} was accepted"
+            assert get_bnpl_record_by_id(1, user_email)["status"] == "active"
+            accepted = client.post("/api/bnpl/status", json={"ids": [1]})
+            assert accepted.status_code == 200 and get_bnpl_record_by_id(1, user_email)["status"] == "paid"
+            print("[Batch Status] Boolean record ids rejected with 400, integer ids accepted")
+
+            # A repeated id must not subtract its installment from the risk history twice
+            other_email = "selftest-repeat@example.com"
+            update_user_salary(other_email, 10000)
+            insert_bnpl_record(other_email, "msg-a", "Simpl", 1000.0, 1, "01/01/2030", "Installment due")
+            insert_bnpl_record(other_email, "msg-b", "Simpl", 2000.0, 1, "01/02/2030", "Installment due")
+            repeated_id = get_bnpl_records(other_email)[0]["id"]
+            with client.session_transaction() as sess:
+                sess["user_email"] = other_email
+            repeated = client.post("/api/bnpl/status", json={"ids": [repeated_id, repeated_id], "status": "paid"})
+            assert repeated.status_code == 200
+            assert repeated.get_json()["results"] == [{"id": repeated_id, "result": "updated"}]
+            today = date.today()
+            latest = get_risk_history(other_email, "raw", today, today)[-1]
+            assert latest["monthly_obligation"] == 1000.0 and latest["debt_ratio"] == 0.1, latest
+            print("[Batch Status] Repeated ids applied once; risk history obligation stays 1000.0")
+
+            # Legacy listing: signed-in users see their own records, nobody else's
+            assert app.test_client().get("/api/bnpl").status_code == 401
+            own = client.get("/api/bnpl")
+            assert own.status_code == 200 and len(own.get_json()) == 2, "legacy /api/bnpl leaked other users' records"
+            assert client.get("/api/bnpl?scope=all").status_code == 403
+            print("[Legacy] /api/bnpl: 401 without a session, the caller's 2 records with one, 403 for scope=all")
+
+            # Risk scores every record with the stored salary: all-paid users still get a
+            # scored analysis, and a salary of 0 is not replaced by the default
+            paid_email = "selftest-paid@example.com"
+            update_user_profile(paid_email, {"salary": 0, "monthly_rent": 0, "other_expenses": 0})
+            insert_bnpl_record(paid_email, "msg-paid", "Simpl", 900.0, 3, "01/01/2030", "Installment due")
+            update_bnpl_status(get_bnpl_records(paid_email)[0]["id"], "paid", paid_email)
+            with client.session_transaction() as sess:
+                sess["user_email"] = paid_email
+            risk = client.get("/api/risk-score").get_json()
+            assert risk["risk_level"] == "Low" and risk["salary"] == 0 and risk["transaction_count"] == 0, risk
+            assert client.get("/api/dashboard?sections=risk").get_json()["risk"] == risk
+            print("[Risk] All-paid user with salary 0: scored 'Low' with salary 0 on /api/risk-score and the dashboard")
+
+            # Chat: bodies that are not JSON objects are a 400; the rolling summary of a long
+            # conversation is computed after the reply, never before it
+            from backend import chat_context
+            from backend.ttl_store import MemoryTTLStore
+            originals_chat = generate_reply
+            calls = []
+            summarize, summaries = chat_context._summarize, chat_context._summaries
+            gemini_key = os.environ.get("GEMINI_API_KEY")
+            # The store opened at import time points at the database outside this scratch directory
+            chat_context._summaries = MemoryTTLStore()
+            os.environ["GEMINI_API_KEY"] = "selftest"
+            globals()["generate_reply"] = lambda contents, key, system=None: calls.append(("reply", system)) or "ok"
+            chat_context._summarize = lambda previous, turns, key: calls.append(("summary", len(turns))) or "earlier"
+            try:
+                for body in ([1], "hello", {"message": 5}):
+                    assert client.post("/api/chat", json=body).status_code == 400, f"{body!r} was not a 400"
+                # A malformed history is ignored rather than failing the request
+                assert client.post("/api/chat", json={"message": "hi", "history": "nope"}).status_code == 200
+                calls.clear()
+                history = [{"role": "user" if n % 2 == 0 else "assistant", "content": f"turn {n} " + "words " * 200}
+                           for n in range(30)]
+                body = {"message": "and now?", "history": history, "conversation_id": "selftest"}
+                first = client.post("/api/chat", json=body)
+                assert first.status_code == 200 and calls == [("reply", None)], calls
+                first.close()
+                assert calls[1][0] == "summary", "the summary was not computed after the reply"
+                second = client.post("/api/chat", json=body)
+                assert second.status_code == 200 and calls[2] == ("reply", "Summary of the earlier part of this conversation:\nearlier")
+                second.close()
+                assert len(calls) == 3, "a fresh summary was recomputed"
+            finally:
+                globals()["generate_reply"] = originals_chat
+                chat_context._summarize, chat_context._summaries = summarize, summaries
+                if gemini_key is None:
+                    os.environ.pop("GEMINI_API_KEY", None)
+                else:
+                    os.environ["GEMINI_API_KEY"] = gemini_key
+            print("[Chat] Non-object bodies answered 400; the summary was computed after the reply and reused next")
+        finally:
+            globals().update(originals)
+            os.chdir(cwd)
+
+
 if __name__ == "__main__":
+    # python app.py selftest runs the request checks instead of the server
+    if sys.argv[1:2] == ["selftest"]:
+        selftest()
+        sys.exit(0)
     app.config.from_object(Config)
-    init_db()
     # Production: Gunicorn handles the server
     # Local development: debug=True for hot reload
     app.run(debug=os.getenv('FLASK_DEBUG', 'False') == 'True', 
@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+import sqlite3
+import threading
+from backend.sharding import all_shard_paths
+from backend.risk_history import prune_history, rebase_history
+
+# Paid records older than this many days move to the bnpl_archive cold tier
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+
+# Hours between compaction runs in the background-jobs process (0 disables the scheduler;
+# python -m backend.jobs defaults to 24)
+ARCHIVE_INTERVAL_HOURS = float(os.getenv("ARCHIVE_INTERVAL_HOURS", "0"))
+
+# Free pages returned to the OS per incremental_vacuum call
+VACUUM_PAGES = 2000
+
+_scheduler_started = False
+
+
+def compact_shard(path, max_age_days=ARCHIVE_AFTER_DAYS):
+    """
+    Move old paid records of one shard into bnpl_archive and reclaim the freed pages.
+    Returns the number of records archived.
+    """
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+
+        # Fix the cutoff once so the copy and the delete see the same set of rows
+        cutoff = cursor.execute(
+            "SELECT datetime('now', ?)", (f"-{int(max_age_days)} days",)
+        ).fetchone()[0]
+
+        # Records paid before paid_at existed fall back to their creation time
+        cursor.execute("""
+            INSERT OR IGNORE INTO bnpl_archive (
+                id, user_email, gmail_message_id, vendor, amount, installments,
+                due_date, email_subject, created_at, paid_at, due_ordinal
+            )
+            SELECT id, user_email, gmail_message_id, vendor, amount, installments,
+                   due_date, email_subject, created_at, paid_at, due_ordinal
+            FROM bnpl_records
+            WHERE status = 'paid' AND COALESCE(paid_at, created_at) < ?
+        """, (cutoff,))
+        archived = cursor.rowcount
+
+        cursor.execute("""
+            DELETE FROM bnpl_records
+            WHERE status = 'paid' AND COALESCE(paid_at, created_at) < ?
+        """, (cutoff,))
+        conn.commit()
+
+        # Raw risk history and old daily rollups past retention; weekly and monthly stay
+        prune_history(cursor)
+        # Writes update the history by delta; a periodic rescan keeps it anchored
+        corrected = rebase_history(cursor)
+        conn.commit()
+        if corrected:
+            print(f"[Archive] {path}: re-based the risk history of {corrected} users")
+
+        if archived:
+            cursor.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+        return archived
+    finally:
+        conn.close()
+
+
+def run_compaction(max_age_days=ARCHIVE_AFTER_DAYS):
+    """Compact every shard. Returns the total number of records archived."""
+    total = 0
+    for path in all_shard_paths():
+        if not os.path.exists(path):
+            continue
+        try:
+            archived = compact_shard(path, max_age_days)
+            total += archived
+            print(f"[Archive] {path}: archived {archived} paid records")
+        except sqlite3.Error as e:
+            print(f"[Archive] ERROR compacting {path}: {e}")
+    return total
+
+
+def start_compaction_scheduler(interval_hours=ARCHIVE_INTERVAL_HOURS, max_age_days=ARCHIVE_AFTER_DAYS):
+    """Run compaction periodically on a daemon thread. No-op when interval_hours is 0."""
+    global _scheduler_started
+    if interval_hours <= 0 or _scheduler_started:
+        return
+    _scheduler_started = True
+
+    def loop():
+        while True:
+            time.sleep(interval_hours * 3600)
+            run_compaction(max_age_days)
+
+    threading.Thread(target=loop, name="bnpl-archive", daemon=True).start()
+    print(f"[Archive] Compaction scheduled every {interval_hours}h for records paid over {max_age_days} days ago")
+
+
+if __name__ == "__main__":
+    # Usage: python -m backend.archive [max_age_days]
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else ARCHIVE_AFTER_DAYS
+    print(f"[Archive] Archived {run_compaction(days)} records in total")
@@ -0,0 +1,211 @@
+import os
+import hashlib
+import threading
+from backend.gemini import generate_reply, GeminiError
+from backend.ttl_store import create_store
+
+# Estimated tokens allowed per Gemini request (history, summary and the new message)
+CHAT_TOKEN_BUDGET = int(os.getenv("CHAT_TOKEN_BUDGET", "2000"))
+
+# A single turn longer than this is cut (long pastes would otherwise eat the budget)
+MAX_TURN_TOKENS = int(os.getenv("CHAT_MAX_TURN_TOKENS", "600"))
+
+# Room kept for the rolling summary of older turns
+SUMMARY_TOKENS = 300
+
+# When the summary has to grow, it absorbs this many extra tokens of older turns at
+# once, so the next several messages reuse it instead of re-summarizing every time
+SUMMARY_SLACK_TOKENS = CHAT_TOKEN_BUDGET // 3
+
+# Turns read from a request body; older ones are assumed to be covered by the summary
+MAX_HISTORY_TURNS = 200
+
+# Upper bound on the turns sent to one summarization call
+SUMMARY_INPUT_TOKENS = CHAT_TOKEN_BUDGET * 4
+
+SUMMARY_TTL = 6 * 3600
+
+_summaries = create_store("chat_summaries")
+
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "summaries_computed": 0, "summaries_reused": 0, "summaries_deferred": 0,
+          "summary_failures": 0, "truncated_turns": 0}
+
+
+def _count(key, amount=1):
+    with _stats_lock:
+        _stats[key] += amount
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token plus per-turn overhead)"""
+    return len(text) // 4 + 4
+
+
+def _clip(text):
+    max_chars = MAX_TURN_TOKENS * 4
+    if len(text) <= max_chars:
+        return text
+    _count("truncated_turns")
+    # Keep both ends of a long paste; the question is usually at the start or the end
+    half = max_chars // 2
+    return f"{text[:half]}\n[... {len(text) - max_chars} characters omitted ...]\n{text[-half:]}"
+
+
+def parse_turns(data):
+    """
+    (turns, offset): (role, text) turns from a chat request body with the new message
+    last, and how many older turns were cut by MAX_HISTORY_TURNS. None when the
+    message is missing, and for bodies that are not a JSON object. A history that
+    already ends with the message is not doubled.
+    """
+    if not isinstance(data, dict):
+        return None
+    message = data.get("message")
+    message = message.strip() if isinstance(message, str) else ""
+    if not message:
+        return None
+
+    history = data.get("history")
+    turns = history if isinstance(history, list) else []
+    history = []
+    for turn in turns:
+        text = turn.get("content") if isinstance(turn, dict) else None
+        text = text.strip() if isinstance(text, str) else ""
+        if text:
+            history.append(("user" if turn.get("role") == "user" else "model", text))
+    if history and history[-1] == ("user", message):
+        history.pop()
+
+    offset = max(0, len(history) - MAX_HISTORY_TURNS)
+    turns = [(role, _clip(text)) for role, text in history[offset:]]
+    turns.append(("user", _clip(message)))
+    return turns, offset
+
+
+def _turn_digest(turn):
+    return hashlib.sha1(f"{turn[0]}\0{turn[1]}".encode("utf-8")).hexdigest()
+
+
+def _window_start(costs, budget):
+    """
+    Index of the oldest turn kept when the newest turns are packed under budget.
+    The new message is always kept, even if it alone exceeds the budget.
+    """
+    start = len(costs) - 1
+    total = costs[start]
+    while start > 0 and total + costs[start - 1] <= budget:
+        start -= 1
+        total += costs[start]
+    return start
+
+
+def _summarize(previous, turns, api_key):
+    # One summarization call stays bounded too: very old turns beyond the cap are dropped
+    costs = [estimate_tokens(text) for _, text in turns]
+    start = _window_start(costs, SUMMARY_INPUT_TOKENS)
+    turns = turns[start:]
+    transcript = "\n".join(f"{'User' if role == 'user' else 'Assistant'}: {text}" for role, text in turns)
+    prompt = (
+        "Summarize this conversation between a user and a BNPL finance assistant in at most "
+        f"{SUMMARY_TOKENS * 3} characters. Keep figures, decisions and open questions; drop small talk.\n\n"
+    )
+    if previous:
+        prompt += f"Summary so far:\n{previous}\n\nNew turns:\n"
+    return generate_reply([{"role": "user", "parts": [{"text": prompt + transcript}]}], api_key)
+
+
+def _summary_for(owner, conversation_id, turns, offset, needed, api_key):
+    """
+    (summary, covered, refresh) for a request that must drop turns[:needed].
+    summary covers turns[:covered] and comes from the cache only, so no Gemini call
+    delays the reply. When the cached rolling summary does not reach needed (or there
+    is none), the turns it misses are left out of this request and refresh is a
+    callable that extends the summary; run it after the reply so the following
+    messages find it. The cache stores the boundary as an absolute turn number plus a
+    digest of the last turn it covers, so it still matches once old turns fall off.
+    """
+    key = f"{owner}:{conversation_id}"
+    cached = _summaries.get(key)
+    cached_covered = None
+    if cached:
+        local = cached["covered"] - offset
+        if 1 <= local < len(turns) and _turn_digest(turns[local - 1]) == cached["boundary"]:
+            cached_covered = local
+    if cached_covered is not None and cached_covered >= needed and turns[cached_covered][0] == "user":
+        _count("summaries_reused")
+        return cached["summary"], cached_covered, None
+
+    # Extend past what is needed right now, within the slack, so following messages reuse it
+    costs = [estimate_tokens(text) for _, text in turns]
+    covered = needed
+    slack = SUMMARY_SLACK_TOKENS
+    while covered < len(turns) - 1 and costs[covered] <= slack:
+        slack -= costs[covered]
+        covered += 1
+    # The verbatim turns must open with a user turn
+    while turns[covered][0] != "user":
+        covered += 1
+
+    previous, start = None, 0
+    if cached_covered is not None:
+        previous, start = cached["summary"], cached_covered
+
+    def refresh():
+        try:
+            summary = _summarize(previous, turns[start:covered], api_key)
+        except GeminiError:
+            _count("summary_failures")
+            return
+        _count("summaries_computed")
+        _summaries.put(key, {
+            "summary": summary,
+            "covered": covered + offset,
+            "boundary": _turn_digest(turns[covered - 1])
+        }, SUMMARY_TTL)
+
+    _count("summaries_deferred")
+    # Until the refresh lands, an older summary still stands in for the turns it covers
+    return previous, needed, refresh
+
+
+def build_context(data, api_key, owner):
+    """
+    (contents, system, refresh) for a chat request, kept under CHAT_TOKEN_BUDGET: the
+    newest turns verbatim, starting with a user turn, and a rolling summary of the older
+    ones as the system instruction (None when nothing was summarized). Summaries are
+    cached per (owner, conversation_id); without a conversation_id older turns are
+    dropped. refresh is None, or a callable that brings a missing or stale summary up
+    to date with a Gemini call; callers run it after the reply has been sent, so
+    summarization never adds to the reply's latency.
+    Returns None when the message is missing or the body is not a JSON object.
+    """
+    parsed = parse_turns(data)
+    if parsed is None:
+        return None
+    turns, offset = parsed
+    _count("requests")
+
+    costs = [estimate_tokens(text) for _, text in turns]
+    refresh = None
+    if sum(costs) <= CHAT_TOKEN_BUDGET:
+        kept, summary = turns, None
+    else:
+        needed = _window_start(costs, CHAT_TOKEN_BUDGET - SUMMARY_TOKENS)
+        # The new message is the last turn and a user turn, so this stops at it at the latest
+        while turns[needed][0] != "user":
+            needed += 1
+        conversation_id = str(data.get("conversation_id") or "")[:64]
+        summary, covered = None, needed
+        if conversation_id:
+            summary, covered, refresh = _summary_for(owner, conversation_id, turns, offset, needed, api_key)
+        kept = turns[covered:]
+
+    contents = [{"role": role, "parts": [{"text": text}]} for role, text in kept]
+    system = f"Summary of the earlier part of this conversation:\n{summary}" if summary else None
+    return contents, system, refresh
+
+
+def context_stats():
+    with _stats_lock:
+        return dict(_stats)
@@ -0,0 +1,92 @@
+import os
+import sys
+import sqlite3
+from backend.sharding import all_shard_paths
+from backend.models import DEDUPE_WINDOW_DAYS, bump_data_version, notify_record_changes
+
+
+def _plan_merges(rows, window_days=DEDUPE_WINDOW_DAYS):
+    """
+    rows: (id, fingerprint, due_ordinal) ordered by id.
+    Returns {duplicate_id: canonical_id}; the oldest record of a group is kept,
+    matching what insert_bnpl_record would have done had the rows arrived in order.
+    """
+    canonical = {}
+    merges = {}
+    for record_id, fingerprint, due_ordinal in rows:
+        if due_ordinal is None:
+            continue
+        candidates = canonical.setdefault(fingerprint, [])
+        match = next((cid for cid, cord in candidates if abs(cord - due_ordinal) <= window_days), None)
+        if match is None:
+            candidates.append((record_id, due_ordinal))
+        else:
+            merges[record_id] = match
+    return merges
+
+
+def dedupe_shard(path, user_email=None, window_days=DEDUPE_WINDOW_DAYS):
+    """Merge duplicate active records already stored in one shard. Returns the number merged."""
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        if user_email:
+            cursor.execute("""
+                SELECT user_email, id, fingerprint, due_ordinal FROM bnpl_records
+                WHERE status = 'active' AND user_email = ?
+                ORDER BY user_email, id
+            """, (user_email,))
+        else:
+            cursor.execute("""
+                SELECT user_email, id, fingerprint, due_ordinal FROM bnpl_records
+                WHERE status = 'active'
+                ORDER BY user_email, id
+            """)
+
+        by_user = {}
+        for email, record_id, fingerprint, due_ordinal in cursor.fetchall():
+            by_user.setdefault(email, []).append((record_id, fingerprint, due_ordinal))
+
+        merged = {}
+        for email, rows in by_user.items():
+            merges = _plan_merges(rows, window_days)
+            if not merges:
+                continue
+            pairs = list(merges.items())
+            # The duplicate's own message id and anything merged into it move to the canonical record
+            cursor.executemany("""
+                INSERT OR IGNORE INTO bnpl_record_sources (user_email, gmail_message_id, record_id)
+                SELECT user_email, gmail_message_id, ? FROM bnpl_records WHERE id = ?
+            """, [(canonical_id, dup_id) for dup_id, canonical_id in pairs])
+            cursor.executemany(
+                "UPDATE bnpl_record_sources SET record_id = ? WHERE record_id = ?",
+                [(canonical_id, dup_id) for dup_id, canonical_id in pairs]
+            )
+            cursor.executemany("DELETE FROM bnpl_records WHERE id = ?", [(dup_id,) for dup_id, _ in pairs])
+            bump_data_version(cursor, email)
+            merged[email] = [dup_id for dup_id, _ in pairs]
+            print(f"[Dedupe] {email}: merged {len(pairs)} duplicate records")
+
+        conn.commit()
+    finally:
+        conn.close()
+
+    for email, dup_ids in merged.items():
+        notify_record_changes(email, [(dup_id, "merged") for dup_id in dup_ids])
+    return sum(len(dup_ids) for dup_ids in merged.values())
+
+
+def dedupe_records(user_email=None, window_days=DEDUPE_WINDOW_DAYS):
+    """Run the duplicate merge over every shard (or only the given user's rows)."""
+    total = 0
+    for path in all_shard_paths():
+        if os.path.exists(path):
+            total += dedupe_shard(path, user_email, window_days)
+    print(f"[Dedupe] Merged {total} duplicate records in total")
+    return total
+
+
+if __name__ == "__main__":
+    # Usage: python -m backend.dedupe [user_email]
+    dedupe_records(sys.argv[1] if len(sys.argv) > 1 else None)
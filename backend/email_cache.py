@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+from backend.sharding import get_connection
+from backend.parser import is_bnpl_email, parse_bnpl_email
+from backend.models import record_fingerprint, due_date_ordinal, bump_data_version, notify_record_changes
+from backend.dedupe import dedupe_records
+
+CACHE_PATH = os.getenv("EMAIL_CACHE_PATH", "database/email_cache.db")
+
+# Compressed bytes kept on disk before least-recently-used emails are evicted
+CACHE_MAX_BYTES = int(os.getenv("EMAIL_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+# Eviction trims down to this fraction of the cap so it does not run on every sync
+EVICT_TARGET_RATIO = 0.9
+
+
+def _connect():
+    conn = sqlite3.connect(CACHE_PATH, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS email_blobs (
+            digest TEXT PRIMARY KEY,
+            data BLOB,
+            size INTEGER,
+            last_access REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_email_blobs_access ON email_blobs(last_access)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS email_refs (
+            user_email TEXT,
+            gmail_message_id TEXT,
+            digest TEXT,
+            PRIMARY KEY (user_email, gmail_message_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_email_refs_digest ON email_refs(digest)")
+    return conn
+
+
+def normalize_email(sender, subject, body):
+    """Canonical form of an email; identical content always hashes to the same digest."""
+    def clean(value):
+        return (value or "").replace("\r\n", "\n").replace("\r", "\n").strip()
+    return clean(sender), clean(subject), clean(body)
+
+
+def _encode(sender, subject, body):
+    raw = json.dumps([sender, subject, body], ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest(), zlib.compress(raw, 6)
+
+
+def _decode(data):
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+def cache_messages(user_email, messages):
+    """
+    Store fetched Gmail messages (dicts with id, sender, subject, body) in one transaction.
+    Messages are stored whether or not they turn out to be BNPL emails, so rejected
+    mail can be re-evaluated after a parser change.
+    """
+    if not messages:
+        return 0
+
+    now = time.time()
+    blobs = []
+    refs = []
+    for msg in messages:
+        digest, data = _encode(*normalize_email(msg["sender"], msg["subject"], msg["body"]))
+        blobs.append((digest, data, len(data), now))
+        refs.append((user_email, msg["id"], digest))
+
+    conn = _connect()
+    try:
+        conn.executemany("""
+            INSERT INTO email_blobs (digest, data, size, last_access) VALUES (?, ?, ?, ?)
+            ON CONFLICT(digest) DO UPDATE SET last_access = excluded.last_access
+        """, blobs)
+        conn.executemany(
+            "INSERT OR REPLACE INTO email_refs (user_email, gmail_message_id, digest) VALUES (?, ?, ?)",
+            refs
+        )
+        conn.commit()
+        _evict(conn)
+    finally:
+        conn.close()
+    return len(refs)
+
+
+def get_cached_email(user_email, gmail_message_id):
+    """Return (sender, subject, body) for a cached message, or None."""
+    conn = _connect()
+    try:
+        row = conn.execute("""
+            SELECT b.digest, b.data FROM email_refs r
+            JOIN email_blobs b ON b.digest = r.digest
+            WHERE r.user_email = ? AND r.gmail_message_id = ?
+        """, (user_email, gmail_message_id)).fetchone()
+        if not row:
+            return None
+        conn.execute("UPDATE email_blobs SET last_access = ? WHERE digest = ?", (time.time(), row[0]))
+        conn.commit()
+        return tuple(_decode(row[1]))
+    finally:
+        conn.close()
+
+
+def _evict(conn, max_bytes=CACHE_MAX_BYTES):
+    """Drop least-recently-used blobs (and the refs pointing at them) while over the size cap."""
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM email_blobs").fetchone()[0]
+    if total <= max_bytes:
+        return 0
+
+    target = max_bytes * EVICT_TARGET_RATIO
+    evicted = []
+    for digest, size in conn.execute("SELECT digest, size FROM email_blobs ORDER BY last_access"):
+        if total <= target:
+            break
+        evicted.append((digest,))
+        total -= size
+
+    conn.executemany("DELETE FROM email_refs WHERE digest = ?", evicted)
+    conn.executemany("DELETE FROM email_blobs WHERE digest = ?", evicted)
+    conn.commit()
+    print(f"[EmailCache] Evicted {len(evicted)} cached emails to stay under {max_bytes} bytes")
+    return len(evicted)
+
+
+def cache_stats():
+    conn = _connect()
+    try:
+        blobs, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM email_blobs").fetchone()
+        refs = conn.execute("SELECT COUNT(*) FROM email_refs").fetchone()[0]
+    finally:
+        conn.close()
+    return {"messages": refs, "unique_blobs": blobs, "bytes": size, "max_bytes": CACHE_MAX_BYTES}
+
+
+def reparse_cached_emails(user_email=None):
+    """
+    Re-run the parser over cached emails and apply the results in bulk.
+
+    Records that already exist get their parsed fields refreshed; emails that are now
+    accepted but were rejected before are inserted. Records are never deleted, and
+    archived records are left alone. Returns counts per outcome.
+    """
+    conn = _connect()
+    if user_email:
+        cursor = conn.execute("""
+            SELECT r.user_email, r.gmail_message_id, b.data FROM email_refs r
+            JOIN email_blobs b ON b.digest = r.digest
+            WHERE r.user_email = ?
+        """, (user_email,))
+    else:
+        cursor = conn.execute("""
+            SELECT r.user_email, r.gmail_message_id, b.data FROM email_refs r
+            JOIN email_blobs b ON b.digest = r.digest
+            ORDER BY r.user_email
+        """)
+
+    by_user = {}
+    for email, gmail_message_id, data in cursor:
+        sender, subject, body = _decode(data)
+        if not is_bnpl_email(sender, subject, body):
+            continue
+        parsed = parse_bnpl_email(sender, subject, body)
+        if not parsed["amount"]:
+            continue
+        by_user.setdefault(email, []).append((
+            gmail_message_id, parsed["vendor"], parsed["amount"],
+            parsed["installments"] or 1, parsed["due_date"], subject
+        ))
+    conn.close()
+
+    stats = {"users": len(by_user), "updated": 0, "inserted": 0}
+    for email, rows in by_user.items():
+        shard = get_connection(email)
+        try:
+            cursor = shard.cursor()
+            cursor.executemany("""
+                UPDATE bnpl_records
+                SET vendor = ?, amount = ?, installments = ?, due_date = ?, fingerprint = ?, due_ordinal = ?
+                WHERE user_email = ? AND gmail_message_id = ?
+            """, [
+                (v, a, i, d, record_fingerprint(v, a, i), due_date_ordinal(d), email, mid)
+                for mid, v, a, i, d, _ in rows
+            ])
+            changed = cursor.rowcount
+            stats["updated"] += cursor.rowcount
+
+            # Emails accepted by the new rules; archived, merged and cleared messages stay in the idempotency set
+            cursor.executemany("""
+                INSERT OR IGNORE INTO bnpl_records (user_email, gmail_message_id, vendor, amount, installments, due_date, email_subject, fingerprint, due_ordinal)
+                SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM bnpl_archive WHERE user_email = ? AND gmail_message_id = ?
+                ) AND NOT EXISTS (
+                    SELECT 1 FROM bnpl_record_sources WHERE user_email = ? AND gmail_message_id = ?
+                ) AND NOT EXISTS (
+                    SELECT 1 FROM bnpl_message_tombstones WHERE user_email = ? AND gmail_message_id = ?
+                )
+            """, [
+                (email, mid, v, a, i, d, s, record_fingerprint(v, a, i), due_date_ordinal(d),
+                 email, mid, email, mid, email, mid)
+                for mid, v, a, i, d, s in rows
+            ])
+            changed += cursor.rowcount
+            stats["inserted"] += cursor.rowcount
+            touched = []
+            if changed:
+                bump_data_version(cursor, email)
+                message_ids = [row[0] for row in rows]
+                for start in range(0, len(message_ids), 500):
+                    chunk = message_ids[start:start + 500]
+                    placeholders = ", ".join("?" for _ in chunk)
+                    touched += [row[0] for row in cursor.execute(f"""
+                        SELECT id FROM bnpl_records
+                        WHERE user_email = ? AND status = 'active' AND gmail_message_id IN ({placeholders})
+                    """, [email] + chunk)]
+            shard.commit()
+        finally:
+            shard.close()
+
+        if changed:
+            # Amounts and due dates may have moved; listeners re-read these records
+            notify_record_changes(email, [(record_id, "active") for record_id in touched])
+            # Re-parsed fields can make records collide that did not before
+            dedupe_records(email)
+
+    print(f"[EmailCache] Re-parse complete: {stats}")
+    return stats
+
+
+if __name__ == "__main__":
+    # Usage:
+    #   python -m backend.email_cache reparse [user_email]
+    #   python -m backend.email_cache stats
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    if command == "reparse":
+        reparse_cached_emails(sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        print(cache_stats())
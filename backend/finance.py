@@ -1,11 +1,75 @@
-from datetime import datetime, timedelta
+import os
+import calendar
+from operator import attrgetter
+from datetime import date, datetime, timedelta
+from backend.cache import LRUCache
+from backend.records import Record
+
+# Derived metrics per (user, data version); the version changes on every write to the user's data
+_metrics_cache = LRUCache(
+    maxsize=int(os.getenv("METRICS_CACHE_SIZE", "2048")),
+    ttl=float(os.getenv("METRICS_CACHE_TTL", "600"))
+)
 
 def calculate_analysis(salary, bnpl_records):
     """
     Calculate comprehensive financial analysis.
     Returns: total_outstanding, monthly_obligation, upcoming_dues, debt_ratio, risk_score
+    bnpl_records may be any iterable (e.g. a streaming cursor); it is read once.
+    """
+    return analysis_from_totals(salary, summarize_records(bnpl_records))
+
+# Fields summarize_records reads, taken from a compact record in one C-level call;
+# record["amount"] on a compact record is a Python-level lookup
+_summary_attrs = attrgetter("status", "amount", "installments", "due_date")
+
+def _summary_values(record):
+    """(status, amount, installments, due_date) of a record or a record-like dict"""
+    if isinstance(record, Record):
+        try:
+            return _summary_attrs(record)
+        except AttributeError:
+            pass  # a projection without some of the fields
+    return record.get("status"), record.get("amount"), record.get("installments", 1), record.get("due_date")
+
+def summarize_records(bnpl_records):
     """
-    if not bnpl_records:
+    Single pass over records accumulating the sums calculate_analysis needs.
+    Additions happen in record order, so results match summing a list exactly.
+    """
+    today = datetime.now()
+    thirty_days_later = today + timedelta(days=30)
+    totals = {
+        "record_count": 0,
+        "active_count": 0,
+        "total_outstanding": 0,
+        "monthly_obligation": 0,
+        "upcoming_dues": 0
+    }
+    
+    for record in bnpl_records:
+        totals["record_count"] += 1
+        status, amount, installments, due_date = _summary_values(record)
+        if status != "active":
+            continue
+        totals["active_count"] += 1
+        
+        # Calculate total outstanding (only active records)
+        if amount:
+            totals["total_outstanding"] += amount
+        
+        # Calculate monthly obligation (amount / installments for each active record)
+        if amount and installments and installments > 0:
+            totals["monthly_obligation"] += amount / installments
+        
+        # Calculate upcoming dues (within next 30 days, only active)
+        totals["upcoming_dues"] += _upcoming_amount(due_date, amount, installments, today, thirty_days_later)
+    
+    return totals
+
+def analysis_from_totals(salary, totals):
+    """Turn summarize_records totals into the calculate_analysis response."""
+    if not totals["record_count"]:
         return {
             "total_outstanding": 0,
             "monthly_obligation": 0,
@@ -16,22 +80,26 @@ def calculate_analysis(salary, bnpl_records):
             "transaction_count": 0
         }
     
-    # Calculate total outstanding (only active records)
-    total_outstanding = sum([r["amount"] for r in bnpl_records if r["amount"] and r.get("status") == "active"])
-    
-    # Calculate monthly obligation (amount / installments for each active record)
-    monthly_obligation = 0
-    for record in bnpl_records:
-        if record.get("status") == "active" and record["amount"] and record["installments"] and record["installments"] > 0:
-            monthly_obligation += record["amount"] / record["installments"]
-    
-    # Calculate upcoming dues (within next 30 days, only active)
-    upcoming_dues = calculate_upcoming_dues(bnpl_records)
+    monthly_obligation = totals["monthly_obligation"]
     
     # Calculate debt-to-income ratio
     debt_ratio = (monthly_obligation / salary) if salary > 0 else 0
     
-    # Calculate risk score (0-100)
+    risk_score, risk_level = risk_from_debt_ratio(debt_ratio)
+    
+    return {
+        "total_outstanding": round(totals["total_outstanding"], 2),
+        "monthly_obligation": round(monthly_obligation, 2),
+        "upcoming_dues": round(totals["upcoming_dues"], 2),
+        "debt_ratio": round(debt_ratio, 4),
+        "risk_score": risk_score,
+        "risk_level": risk_level,
+        "transaction_count": totals["active_count"],
+        "salary": salary
+    }
+
+def risk_from_debt_ratio(debt_ratio):
+    """Piecewise risk score (0-100) and level for a debt-to-income ratio"""
     if debt_ratio < 0.2:
         risk_score = int(debt_ratio * 100)  # 0-20
         risk_level = "Low"
@@ -41,17 +109,7 @@ def calculate_analysis(salary, bnpl_records):
     else:
         risk_score = min(50 + int((debt_ratio - 0.4) * 100), 100)  # 50-100
         risk_level = "High"
-    
-    return {
-        "total_outstanding": round(total_outstanding, 2),
-        "monthly_obligation": round(monthly_obligation, 2),
-        "upcoming_dues": round(upcoming_dues, 2),
-        "debt_ratio": round(debt_ratio, 4),
-        "risk_score": risk_score,
-        "risk_level": risk_level,
-        "transaction_count": len([r for r in bnpl_records if r.get("status") == "active"]),
-        "salary": salary
-    }
+    return risk_score, risk_level
 
 def calculate_upcoming_dues(bnpl_records):
     """
@@ -63,25 +121,109 @@ def calculate_upcoming_dues(bnpl_records):
     upcoming = 0
     
     for record in bnpl_records:
-        if record.get("status") != "active" or not record.get("due_date") or not record.get("amount"):
-            continue
-        
-        try:
-            # Parse due date (DD/MM/YYYY format)
-            due_date_str = record["due_date"]
-            due_date = datetime.strptime(due_date_str, '%d/%m/%Y')
-            
-            # Check if due date is within next 30 days
-            if today <= due_date <= thirty_days_later:
-                # Add monthly installment amount
-                installments = record.get("installments", 1)
-                if installments > 0:
-                    upcoming += record["amount"] / installments
-        except:
+        if record.get("status") != "active":
             continue
+        upcoming += _upcoming_amount(
+            record.get("due_date"), record.get("amount"), record.get("installments", 1), today, thirty_days_later
+        )
     
     return upcoming
 
+def _upcoming_amount(due_date_str, amount, installments, today, thirty_days_later):
+    """Monthly installment of an active record if its due date falls in [today, thirty_days_later]"""
+    if not due_date_str or not amount:
+        return 0
+    
+    try:
+        # Parse due date (DD/MM/YYYY format)
+        due_date = datetime.strptime(due_date_str, '%d/%m/%Y')
+        
+        # Check if due date is within next 30 days
+        if today <= due_date <= thirty_days_later:
+            # Add monthly installment amount
+            if installments > 0:
+                return amount / installments
+    except:
+        pass
+    
+    return 0
+
+def add_months(day, months):
+    """Same day of the month `months` later, clamped to the month's last day (31 Jan -> 28/29 Feb)"""
+    index = day.year * 12 + day.month - 1 + months
+    year, month = divmod(index, 12)
+    month += 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+def month_key(day):
+    """Months since year 0 (year * 12 + month - 1); consecutive months are consecutive keys"""
+    return day.year * 12 + day.month - 1
+
+def format_month(key):
+    return f"{key // 12:04d}-{key % 12 + 1:02d}"
+
+def parse_month(text):
+    """Month key of a YYYY-MM string; raises ValueError"""
+    try:
+        year, month = (int(part) for part in text.split("-"))
+    except (AttributeError, ValueError):
+        raise ValueError("Month must be YYYY-MM")
+    if not 1 <= month <= 12 or not 1 <= year <= 9999:
+        raise ValueError("Month must be YYYY-MM")
+    return year * 12 + month - 1
+
+def installment_schedule(record, since=None):
+    """
+    Remaining installments of an active record as (date, amount) pairs: `installments`
+    monthly payments of amount / installments, the first on due_date. Only dates on or
+    after since (default today) are returned. Records without an amount, a positive
+    installment count or a parseable due date have no schedule, as in calculate_analysis.
+    """
+    amount = record.get("amount")
+    installments = record.get("installments")
+    if not amount or not installments or installments <= 0 or not record.get("due_date"):
+        return []
+    try:
+        first_due = datetime.strptime(record["due_date"], '%d/%m/%Y').date()
+    except ValueError:
+        return []
+    
+    since = since or date.today()
+    per_installment = amount / installments
+    schedule = []
+    for number in range(int(installments)):
+        due = add_months(first_due, number)
+        if due >= since:
+            schedule.append((due, per_installment))
+    return schedule
+
+def monthly_dues(bnpl_records, since=None):
+    """
+    Dues calendar of active records: {month_key: (amount, installment_count)}.
+    since is passed to installment_schedule (date.min keeps every installment).
+    """
+    months = {}
+    for record in bnpl_records:
+        if record.get("status", "active") != "active":
+            continue
+        for due, amount in installment_schedule(record, since):
+            key = month_key(due)
+            total, count = months.get(key, (0, 0))
+            months[key] = (total + amount, count + 1)
+    return months
+
+def month_risk(salary, dues):
+    """Debt ratio, risk score and level of one calendar month's dues"""
+    debt_ratio = (dues / salary) if salary > 0 else 0
+    risk_score, risk_level = risk_from_debt_ratio(debt_ratio)
+    return {
+        "dues": round(dues, 2),
+        "debt_ratio": round(debt_ratio, 4),
+        "risk_score": risk_score,
+        "risk_level": risk_level,
+        "salary": salary
+    }
+
 def calculate_affordability(salary, monthly_bnpl_obligation, rent, other_expenses):
     """
     Calculate affordability capacity.
@@ -121,3 +263,67 @@ def calculate_affordability(salary, monthly_bnpl_obligation, rent, other_expense
         "emi_percentage": round(emi_percentage, 2),
         "safe_emi_percentage": round(min(100, safe_emi_percentage), 2)
     }
+
+def _next_midnight():
+    """Epoch seconds of the next local midnight, when upcoming dues shift by a day."""
+    tomorrow = (datetime.now() + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return tomorrow.timestamp()
+
+def get_cached_analysis(user_email, data_version, load):
+    """
+    calculate_analysis for a user, cached per data version.
+    load() -> (salary, active_records) is only called on a miss.
+    upcoming_dues depends on today's date, so entries never outlive the current day.
+    """
+    key = ("analysis", user_email, data_version, datetime.now().date().toordinal())
+    return _metrics_cache.get_or_compute(key, lambda: calculate_analysis(*load()), expires_at=_next_midnight())
+
+def get_cached_affordability(user_email, data_version, load):
+    """
+    calculate_affordability for a user, cached per data version.
+    load() -> (salary, monthly_bnpl_obligation, rent, other_expenses) is only called on a miss.
+    """
+    key = ("affordability", user_email, data_version)
+    return _metrics_cache.get_or_compute(key, lambda: calculate_affordability(*load()))
+
+def get_cached_totals(user_email, data_version, load):
+    """
+    summarize_records totals of a user's active records, cached per data version.
+    load() -> active_records is only called on a miss. Like the analysis, entries
+    never outlive the current day.
+    """
+    key = ("totals", user_email, data_version, datetime.now().date().toordinal())
+    return _metrics_cache.get_or_compute(key, lambda: summarize_records(load()), expires_at=_next_midnight())
+
+def merge_totals(totals, extra):
+    """Totals of two record sets combined"""
+    return {key: totals[key] + extra[key] for key in totals}
+
+def what_if(salary, totals, purchases, expenses=None):
+    """
+    Analysis and affordability now and after adding hypothetical purchases (record-like
+    dicts). Only the purchases are summarized and added to the current totals, so the
+    cost does not depend on how many records the user has.
+    expenses: (monthly_rent, other_expenses), or None to skip affordability.
+    """
+    def state(state_totals):
+        analysis = analysis_from_totals(salary, state_totals)
+        affordability = None
+        if expenses:
+            affordability = calculate_affordability(salary, analysis["monthly_obligation"], *expenses)
+        return {"analysis": analysis, "affordability": affordability}
+
+    current = state(totals)
+    projected = state(merge_totals(totals, summarize_records(purchases)))
+    delta = {
+        key: round(projected["analysis"][key] - current["analysis"][key], 4)
+        for key in ("monthly_obligation", "upcoming_dues", "debt_ratio", "risk_score")
+    }
+    if expenses:
+        delta["available_emi_capacity"] = round(
+            projected["affordability"]["available_emi_capacity"] - current["affordability"]["available_emi_capacity"], 2
+        )
+    return {"current": current, "projected": projected, "delta": delta}
+
+def metrics_cache_stats():
+    return _metrics_cache.stats()
@@ -0,0 +1,357 @@
+import os
+import re
+import sys
+import json
+import time
+import threading
+from collections import deque
+import requests
+from backend.cache import LRUCache
+from backend.http_client import get_session
+
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+]
+
+# Replies to general questions ("what is a debt ratio?"), shared by all users
+_faq_cache = LRUCache(
+    maxsize=int(os.getenv("CHAT_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("CHAT_CACHE_TTL", "86400"))
+)
+
+# Only short single-turn questions without numbers are treated as FAQ-style; anything
+# quoting amounts, dates or earlier turns may be about the user's own situation
+FAQ_MAX_CHARS = 160
+_DIGITS = re.compile(r"\d")
+_NON_WORD = re.compile(r"[^\w\s]")
+
+# Recent upstream latencies (seconds) for percentile metrics
+LATENCY_SAMPLES = 1000
+
+
+class GeminiError(Exception):
+    """Upstream failure; the message is safe to show to the user."""
+
+
+class GeminiBlocked(GeminiError):
+    """The prompt or the reply was stopped by the safety filters."""
+
+# finishReason values that mean the reply was cut off by a filter rather than completed
+BLOCKED_FINISH_REASONS = {"SAFETY", "RECITATION", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII"}
+
+
+class _Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._first_token = deque(maxlen=LATENCY_SAMPLES)
+        self.requests = 0
+        self.errors = 0
+
+    def record(self, seconds, ok, first_token=None):
+        with self._lock:
+            self.requests += 1
+            if not ok:
+                self.errors += 1
+            self._latencies.append(seconds)
+            if first_token is not None:
+                self._first_token.append(first_token)
+
+    def snapshot(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            first_token = sorted(self._first_token)
+            requests_made, errors = self.requests, self.errors
+
+        def percentiles(samples):
+            def at(p):
+                return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 1) if samples else 0
+            return {"p50": at(0.5), "p95": at(0.95), "max": at(1.0)}
+
+        return {
+            "upstream_requests": requests_made,
+            "upstream_errors": errors,
+            "latency_ms": percentiles(latencies),
+            "first_token_ms": percentiles(first_token),
+        }
+
+
+_metrics = _Metrics()
+
+
+def normalize_prompt(text):
+    """Cache key form of a prompt: lowercase, punctuation dropped, whitespace collapsed"""
+    return " ".join(_NON_WORD.sub(" ", text.lower()).split())
+
+
+def faq_cache_key(contents, system=None):
+    """
+    Key for a conversation whose reply may be shared between users, or None.
+    Only a lone user turn that is short and free of digits, without a system
+    instruction carrying earlier context, qualifies.
+    """
+    if system or len(contents) != 1 or contents[0]["role"] != "user":
+        return None
+    text = "".join(part.get("text", "") for part in contents[0]["parts"])
+    if len(text) > FAQ_MAX_CHARS or _DIGITS.search(text):
+        return None
+    key = normalize_prompt(text)
+    return (GEMINI_MODEL, key) if key else None
+
+
+def _request_body(contents, system):
+    body = {"contents": contents, "safetySettings": SAFETY_SETTINGS}
+    if system:
+        body["systemInstruction"] = {"parts": [{"text": system}]}
+    return body
+
+
+def _extract_text(payload):
+    candidates = payload.get("candidates") or []
+    if not candidates:
+        raise GeminiError("No response from AI")
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    text = "".join(part["text"] for part in parts if "text" in part)
+    if not text:
+        raise GeminiError("Empty response from AI")
+    return text
+
+
+def _chunk_text(payload):
+    """Text of one streamed chunk; raises GeminiBlocked when a safety filter stopped the reply"""
+    block_reason = (payload.get("promptFeedback") or {}).get("blockReason")
+    if block_reason:
+        raise GeminiBlocked("This question was blocked by the AI safety filters.")
+    candidates = payload.get("candidates") or []
+    if not candidates:
+        return ""
+    candidate = candidates[0]
+    parts = (candidate.get("content") or {}).get("parts") or []
+    text = "".join(part["text"] for part in parts if "text" in part)
+    if candidate.get("finishReason") in BLOCKED_FINISH_REASONS:
+        raise GeminiBlocked("The reply was stopped by the AI safety filters.")
+    return text
+
+
+def generate_reply(contents, api_key, system=None):
+    """
+    Reply text for Gemini contents, with an optional system instruction. FAQ-style
+    prompts are answered from the shared cache when possible. Raises GeminiError
+    when the upstream call fails.
+    """
+    cache_key = faq_cache_key(contents, system)
+    if cache_key:
+        cached = _faq_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    start = time.perf_counter()
+    ok = False
+    try:
+        resp = get_session().post(
+            f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}:generateContent",
+            params={"key": api_key},
+            json=_request_body(contents, system),
+        )
+        resp.raise_for_status()
+        text = _extract_text(resp.json())
+        ok = True
+    except (requests.RequestException, ValueError) as e:
+        print(f"[Chat] Request error: {e}")
+        raise GeminiError("Failed to contact AI service") from e
+    finally:
+        _metrics.record(time.perf_counter() - start, ok)
+
+    if cache_key:
+        _faq_cache.set(cache_key, text)
+    return text
+
+
+def stream_reply(contents, api_key, system=None):
+    """
+    Yield reply text chunks from streamGenerateContent as they arrive.
+    Raises GeminiError (GeminiBlocked for safety stops) at the point of failure, so
+    callers can report it after the chunks already sent. Closing the generator (e.g.
+    when the client disconnects) closes the upstream connection.
+    """
+    cache_key = faq_cache_key(contents, system)
+    if cache_key:
+        cached = _faq_cache.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+    start = time.perf_counter()
+    first_token = None
+    ok = False
+    resp = None
+    chunks = []
+    try:
+        try:
+            resp = get_session().post(
+                f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}:streamGenerateContent",
+                params={"key": api_key, "alt": "sse"},
+                json=_request_body(contents, system),
+                stream=True,
+            )
+            resp.raise_for_status()
+            # SSE is always UTF-8; requests would guess ISO-8859-1 for text/* without a charset
+            resp.encoding = "utf-8"
+            # chunk_size=None hands over each network read as it arrives instead of filling 512 bytes
+            for line in resp.iter_lines(chunk_size=None, decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                text = _chunk_text(json.loads(line[5:]))
+                if not text:
+                    continue
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                chunks.append(text)
+                yield text
+        except (requests.RequestException, ValueError) as e:
+            print(f"[Chat] Stream error: {e}")
+            raise GeminiError("Failed to contact AI service") from e
+
+        if not chunks:
+            raise GeminiError("Empty response from AI")
+        ok = True
+    except GeneratorExit:
+        # Client went away; not an upstream failure
+        ok = True
+        raise
+    finally:
+        if resp is not None:
+            resp.close()
+        _metrics.record(time.perf_counter() - start, ok, first_token)
+
+    if cache_key:
+        _faq_cache.set(cache_key, "".join(chunks))
+
+
+def chat_metrics():
+    return dict(_metrics.snapshot(), cache=_faq_cache.stats())
+
+
+def selftest():
+    """Exercise the client against a local stub of the generateContent endpoint."""
+    import json
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    global GEMINI_API_BASE
+
+    calls = []
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            calls.append((self.client_address, body))
+            prompt = body["contents"][-1]["parts"][0]["text"]
+            if "streamGenerateContent" in self.path:
+                return self._stream(prompt)
+            if prompt == "fail":
+                payload, status = {"error": "boom"}, 500
+            elif prompt == "empty":
+                payload, status = {"candidates": []}, 200
+            else:
+                payload, status = {"candidates": [{"content": {"parts": [{"text": f"echo: {prompt}"}]}}]}, 200
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _stream(self, prompt):
+            events = [{"candidates": [{"content": {"parts": [{"text": word + " "}]}}]} for word in prompt.split()]
+            if prompt.startswith("blocked"):
+                events.append({"candidates": [{"finishReason": "SAFETY"}]})
+            # Chunked transfer encoding, like the real endpoint
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for event in events:
+                    data = f"data: {json.dumps(event)}\r\n\r\n".encode("utf-8")
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    self.wfile.flush()
+                    time.sleep(0.05)
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    GEMINI_API_BASE = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def user(text):
+        return [{"role": "user", "parts": [{"text": text}]}]
+
+    try:
+        assert generate_reply(user("What is a debt ratio?"), "k") == "echo: What is a debt ratio?"
+        assert generate_reply(user("what is a  DEBT ratio"), "k") == "echo: What is a debt ratio?"
+        assert len(calls) == 1, "normalized FAQ prompt should be served from cache"
+
+        generate_reply(user("Can I afford 4500 more?"), "k")
+        generate_reply(user("Can I afford 4500 more?"), "k")
+        assert len(calls) == 3, "prompts with numbers must not be cached"
+
+        for prompt, error in (("fail", "Failed to contact AI service"), ("empty", "No response from AI")):
+            try:
+                generate_reply(user(prompt), "k")
+                raise AssertionError(f"{prompt} should raise")
+            except GeminiError as e:
+                assert str(e) == error
+
+        # A system instruction is sent as such and keeps the prompt out of the shared cache
+        before = len(calls)
+        generate_reply(user("What is a debt ratio?"), "k", system="Summary: earlier turns")
+        assert len(calls) == before + 1, "prompts with a system instruction must not be cached"
+        assert calls[-1][1]["systemInstruction"] == {"parts": [{"text": "Summary: earlier turns"}]}
+        assert "systemInstruction" not in calls[0][1]
+
+        # Keep-alive: every call after the first reuses the pooled connection
+        assert len({address for address, _ in calls}) == 1, "connections were not reused"
+        assert calls[0][1]["safetySettings"] == SAFETY_SETTINGS
+
+        # Streaming: chunks arrive one by one, the first well before the last
+        start = time.perf_counter()
+        arrivals = []
+        for chunk in stream_reply(user("stream me 4 words please"), "k"):
+            arrivals.append((chunk, time.perf_counter() - start))
+        assert "".join(c for c, _ in arrivals) == "stream me 4 words please "
+        assert arrivals[0][1] < arrivals[-1][1] / 2, "first chunk was not relayed early"
+
+        received = []
+        try:
+            for chunk in stream_reply(user("blocked after 2 words"), "k"):
+                received.append(chunk)
+            raise AssertionError("safety stop should raise")
+        except GeminiBlocked:
+            assert received == ["blocked ", "after ", "2 ", "words "]
+
+        # Cancellation: closing the generator early closes the upstream response
+        stream = stream_reply(user("cancel this long stream of 8 words"), "k")
+        assert next(stream) == "cancel "
+        stream.close()
+        print(f"[Gemini] Stub checks passed: {chat_metrics()}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    # Usage: python -m backend.gemini selftest
+    if len(sys.argv) > 1 and sys.argv[1] == "selftest":
+        selftest()
+    else:
+        print("Usage: python -m backend.gemini selftest")
@@ -2,14 +2,25 @@ import os
 import base64
 import json
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build as build_api
 from flask import session, redirect, request
 from google.oauth2.credentials import Credentials
+from backend.security import load_credentials
 
 CLIENT_SECRETS_FILE = "client_secret.json"
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 
+# Seconds before a single Gmail API call is abandoned
+GMAIL_TIMEOUT = float(os.getenv("GMAIL_TIMEOUT", "20"))
+
+def build(service_name, version, credentials):
+    """Google API client whose HTTP calls time out (httplib2 waits forever by default)"""
+    http = AuthorizedHttp(credentials, http=httplib2.Http(timeout=GMAIL_TIMEOUT))
+    return build_api(service_name, version, http=http, cache_discovery=False)
+
 def create_flow():
     """
     Create an OAuth2 Flow.
@@ -83,6 +94,11 @@ def get_gmail_service(credentials):
     return build("gmail", "v1", credentials=credentials)
 
 def get_credentials_from_session(session):
+    # The session cookie only carries a vault handle; the secrets stay server-side
+    if "credential_handle" in session:
+        return load_credentials(session["credential_handle"], session.get("user_email"))
+
+    # Sessions created before the credential vault still hold the full blob
     if "credentials" not in session:
         return None
 
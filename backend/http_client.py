@@ -0,0 +1,152 @@
+import os
+import sys
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# Upper bound on pooled keep-alive connections per upstream host. With pool_block the
+# pool also caps concurrent outbound calls; extra callers wait for a free connection
+OUTBOUND_POOL_SIZE = int(os.getenv("OUTBOUND_POOL_SIZE", "100"))
+
+# (connect, read) seconds applied to every outbound call that does not pass its own
+OUTBOUND_TIMEOUT = (
+    float(os.getenv("OUTBOUND_CONNECT_TIMEOUT", "5")),
+    float(os.getenv("OUTBOUND_READ_TIMEOUT", "20"))
+)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class PooledSession(requests.Session):
+    """requests.Session with a bounded connection pool and a default timeout."""
+
+    def __init__(self, pool_size=OUTBOUND_POOL_SIZE, timeout=OUTBOUND_TIMEOUT):
+        super().__init__()
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_size, pool_block=True)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def get_session():
+    """Process-wide outbound session; under gevent workers its sockets are cooperative."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = PooledSession()
+    return _session
+
+
+# --- Load test -------------------------------------------------------------
+# python -m backend.http_client loadtest [concurrency] [requests] [upstream_ms]
+# Starts a stub upstream that answers after upstream_ms, then runs gunicorn with one
+# sync worker and one gevent worker in turn, each serving a route that checks the
+# SQLite rate limiter and makes one outbound call through get_session(), and reports
+# requests/sec per worker.
+
+_loadtest_limiter = None
+
+
+def loadtest_app(environ, start_response):
+    """WSGI app used by the load test: a rate-limit check and one outbound call, like /api/chat."""
+    global _loadtest_limiter
+    if _loadtest_limiter is None:
+        from backend.security import SQLiteRateLimiter
+        _loadtest_limiter = SQLiteRateLimiter(os.environ["LOADTEST_RATE_LIMIT_PATH"])
+    _loadtest_limiter.consume(f"loadtest:ip:{environ.get('REMOTE_ADDR')}", 10 ** 9, 1)
+    upstream = os.environ["LOADTEST_UPSTREAM"]
+    resp = get_session().get(upstream)
+    body = resp.content
+    start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))])
+    return [body]
+
+
+def _start_stub_upstream(delay):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class SlowHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, *args):
+            pass
+
+    ThreadingHTTPServer.daemon_threads = True
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _run_worker(worker_class, port, upstream, concurrency, total):
+    import tempfile
+    import subprocess
+    from concurrent.futures import ThreadPoolExecutor
+
+    tmp = tempfile.TemporaryDirectory()
+    env = dict(os.environ, LOADTEST_UPSTREAM=upstream,
+               LOADTEST_RATE_LIMIT_PATH=os.path.join(tmp.name, "rate_limits.db"))
+    server = subprocess.Popen([
+        sys.executable, "-m", "gunicorn", "backend.http_client:loadtest_app",
+        "--bind", f"127.0.0.1:{port}", "--workers", "1",
+        "--worker-class", worker_class, "--worker-connections", "1000",
+        "--timeout", "120", "--log-level", "warning"
+    ], env=env)
+    url = f"http://127.0.0.1:{port}/"
+    try:
+        client = requests.Session()
+        client.mount("http://", HTTPAdapter(pool_maxsize=concurrency))
+        for _ in range(100):
+            try:
+                client.get(url, timeout=5)
+                break
+            except requests.RequestException:
+                time.sleep(0.1)
+
+        def call(_):
+            try:
+                return client.get(url, timeout=120).status_code == 200
+            except requests.RequestException:
+                return False
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            ok = sum(pool.map(call, range(total)))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+        tmp.cleanup()
+    return ok, elapsed
+
+
+def loadtest(concurrency=200, total=400, upstream_ms=200):
+    stub = _start_stub_upstream(upstream_ms / 1000)
+    upstream = f"http://127.0.0.1:{stub.server_address[1]}/"
+    results = {}
+    for port, worker_class in ((18041, "sync"), (18042, "gevent")):
+        ok, elapsed = _run_worker(worker_class, port, upstream, concurrency, total)
+        results[worker_class] = round(ok / elapsed, 1)
+        print(f"[LoadTest] {worker_class:6s} worker: {ok}/{total} ok in {elapsed:.1f}s "
+              f"-> {results[worker_class]} req/s per worker ({concurrency} concurrent, upstream {upstream_ms}ms)")
+    stub.shutdown()
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "loadtest":
+        args = [int(a) for a in sys.argv[2:5]]
+        loadtest(*args)
+    else:
+        print("Usage: python -m backend.http_client loadtest [concurrency] [requests] [upstream_ms]")
@@ -0,0 +1,24 @@
+import os
+import sys
+from backend.models import init_db
+from backend.archive import ARCHIVE_INTERVAL_HOURS, ARCHIVE_AFTER_DAYS, start_compaction_scheduler
+from backend.reminders import REMINDER_INTERVAL_MINUTES, REMINDER_SINK, SINKS, DueIndex, ReminderDispatcher, run_dispatcher
+
+# Background jobs (compaction and reminders) run in one process per deployment: the
+# Procfile's worker, or the web process itself when RUN_BACKGROUND_JOBS=1 (a single
+# `python app.py`). Inside gunicorn every worker would run its own copy, each holding an
+# all-user reminder index and blocking its gevent loop on SQLite while it works.
+RUN_BACKGROUND_JOBS = os.getenv("RUN_BACKGROUND_JOBS", "0") == "1"
+
+
+def main(archive_hours=ARCHIVE_INTERVAL_HOURS or 24, reminder_minutes=REMINDER_INTERVAL_MINUTES or 15):
+    """Compaction on a daemon thread, the reminder dispatcher in the foreground until exit."""
+    init_db()
+    start_compaction_scheduler(archive_hours, ARCHIVE_AFTER_DAYS)
+    print(f"[Jobs] Dispatching reminders every {reminder_minutes}min to the {REMINDER_SINK} sink")
+    run_dispatcher(ReminderDispatcher(DueIndex(), SINKS[REMINDER_SINK]()), reminder_minutes)
+
+
+if __name__ == "__main__":
+    # Usage: python -m backend.jobs [archive_hours] [reminder_minutes]
+    main(*[float(arg) for arg in sys.argv[1:3]])
@@ -1,9 +1,43 @@
+import os
+import sys
+import json
+import base64
 import sqlite3
+from datetime import date, datetime
+from backend.records import record_type
+from backend.finance import monthly_dues
+from backend.risk_history import init_history_tables, backfill_history, record_snapshot, monthly_installment
+from backend.sharding import DB_PATH, get_connection, get_shard_path, all_shard_paths, get_layout, shard_path, seed_id_range, fan_out_query
 
-DB_PATH = "database/bnpl.db"
+# Reminders for the same installment whose due dates are at most this many days apart are merged
+DEDUPE_WINDOW_DAYS = int(os.getenv("DEDUPE_WINDOW_DAYS", "3"))
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    """Create the schema on every shard of the current layout."""
+    layout = get_layout(refresh=True)
+    layouts = [(layout["generation"], layout["shard_count"])]
+    if layout["target_generation"] is not None:
+        layouts.append((layout["target_generation"], layout["target_count"]))
+
+    for generation, count in layouts:
+        for index in range(count):
+            conn = sqlite3.connect(shard_path(index, count, generation))
+            init_shard(conn, index, generation)
+            conn.close()
+
+def init_shard(conn, index=0, generation=0):
+    """
+    Create tables on one shard connection.
+    Runs in every worker at startup, so it only issues idempotent DDL; data backfills
+    and the VACUUM for older files live in migrate_shard.
+    """
+    # Incremental auto-vacuum lets the archival job hand freed pages back to the OS.
+    # It applies without a VACUUM only while the file has no tables yet.
+    if conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone() is None:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+    # WAL lets dashboard reads proceed while a sync holds the shard's write lock
+    conn.execute("PRAGMA journal_mode=WAL")
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -34,6 +68,88 @@ def init_db():
         # Create unique constraint after adding column
         cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_gmail_msg ON bnpl_records(user_email, gmail_message_id)")
     
+    if 'paid_at' not in columns:
+        cursor.execute("ALTER TABLE bnpl_records ADD COLUMN paid_at TIMESTAMP")
+    
+    if 'fingerprint' not in columns:
+        cursor.execute("ALTER TABLE bnpl_records ADD COLUMN fingerprint TEXT")
+    
+    if 'due_ordinal' not in columns:
+        cursor.execute("ALTER TABLE bnpl_records ADD COLUMN due_ordinal INTEGER")
+    
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_bnpl_fingerprint
+        ON bnpl_records(user_email, fingerprint, due_ordinal)
+    """)
+    
+    # Gmail messages merged into an existing record as repeated reminders of the same purchase
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bnpl_record_sources (
+            user_email TEXT,
+            gmail_message_id TEXT,
+            record_id INTEGER,
+            merged_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_email, gmail_message_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bnpl_sources_record ON bnpl_record_sources(record_id)")
+    
+    # Message ids of paid, archived and merged records that clear_bnpl_records removed;
+    # they stay in the idempotency set so a re-sync does not bring them back as active
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bnpl_message_tombstones (
+            user_email TEXT,
+            gmail_message_id TEXT,
+            PRIMARY KEY (user_email, gmail_message_id)
+        ) WITHOUT ROWID
+    """)
+    
+    # Bumped in the same transaction as every write to a user's data; keys derived-metric caches
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_data_versions (
+            user_email TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    
+    # Dues per calendar month (finance.monthly_dues of the active records), updated in
+    # the transaction of every write that adds or removes active records
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS dues_calendar (
+            user_email TEXT,
+            month INTEGER,
+            amount REAL,
+            installment_count INTEGER,
+            PRIMARY KEY (user_email, month)
+        ) WITHOUT ROWID
+    """)
+    
+    # Keyset pagination walks this index newest-first
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bnpl_user_created ON bnpl_records(user_email, created_at, id)")
+    
+    # Cold tier for paid records; indexed for idempotency and paging only
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bnpl_archive (
+            id INTEGER PRIMARY KEY,
+            user_email TEXT,
+            gmail_message_id TEXT,
+            vendor TEXT,
+            amount REAL,
+            installments INTEGER,
+            due_date TEXT,
+            email_subject TEXT,
+            created_at TIMESTAMP,
+            paid_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            due_ordinal INTEGER,
+            UNIQUE(user_email, gmail_message_id)
+        )
+    """)
+    cursor.execute("PRAGMA table_info(bnpl_archive)")
+    if 'due_ordinal' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE bnpl_archive ADD COLUMN due_ordinal INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_archive_user_created ON bnpl_archive(user_email, created_at, id)")
+    
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -48,69 +164,366 @@ def init_db():
         )
     """)
 
-    conn.commit()   
+    init_history_tables(cursor)
+
+    seed_id_range(conn, index, generation)
+    conn.commit()
+
+def migrate_shard(conn):
+    """
+    One-time upgrade of a shard created by an older version: backfill fingerprints and
+    risk history, rebuild every user's dues calendar (older versions built it lazily on
+    read), then VACUUM once to switch on incremental auto-vacuum.
+    Takes an exclusive lock and rewrites the file; run it from the CLI, not at startup.
+    """
+    cursor = conn.cursor()
+    # Rows written before fingerprints existed
+    cursor.execute("SELECT id, vendor, amount, installments, due_date FROM bnpl_records WHERE fingerprint IS NULL")
+    cursor.executemany(
+        "UPDATE bnpl_records SET fingerprint = ?, due_ordinal = ? WHERE id = ?",
+        [(record_fingerprint(v, a, i), due_date_ordinal(d), rid) for rid, v, a, i, d in cursor.fetchall()]
+    )
+    fingerprinted = cursor.rowcount
+    seeded = backfill_history(cursor)
+    emails = [row[0] for row in cursor.execute("SELECT DISTINCT user_email FROM bnpl_records").fetchall()]
+    cursor.execute("DELETE FROM dues_calendar")
+    for email in emails:
+        rebuild_dues_calendar(cursor, email)
+    cursor.execute("DROP TABLE IF EXISTS dues_calendar_versions")
+    conn.commit()
+
+    vacuumed = conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2
+    if vacuumed:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    return {"fingerprinted": max(fingerprinted, 0), "history_seeded": seeded,
+            "calendars_rebuilt": len(emails), "vacuumed": vacuumed}
+
+def migrate_db():
+    """migrate_shard on every shard of the current layout"""
+    init_db()
+    for path in all_shard_paths():
+        if not os.path.exists(path):
+            continue
+        conn = sqlite3.connect(path, timeout=60)
+        try:
+            print(f"[DB] Migrated {path}: {migrate_shard(conn)}")
+        finally:
+            conn.close()
+
+
+RECORD_FIELDS = ("id", "gmail_message_id", "vendor", "amount", "installments", "due_date", "email_subject", "status", "created_at")
+
+def bump_data_version(cursor, user_email, active_changes=None):
+    """
+    Advance a user's data version; call inside the transaction that changes the data.
+    The user's risk history and dues calendar are updated in the same transaction.
+    Record writes pass active_changes, a list of (sign, amount, installments, due_date)
+    for every record that became active (+1) or stopped being active (-1), so both are
+    updated from the change alone ([] when no record changed); batch jobs leave it
+    None and pay for one rescan per user.
+    """
+    cursor.execute("""
+        INSERT INTO user_data_versions (user_email, version) VALUES (?, 1)
+        ON CONFLICT(user_email) DO UPDATE SET version = version + 1
+    """, (user_email,))
+    if active_changes is None:
+        record_snapshot(cursor, user_email)
+        rebuild_dues_calendar(cursor, user_email)
+        return
+    record_snapshot(cursor, user_email, sum(
+        sign * monthly_installment(amount, installments) for sign, amount, installments, _ in active_changes
+    ))
+    _apply_dues(cursor, user_email, active_changes)
+
+def active_sign(old_status, new_status):
+    """+1 when a status change makes a record active, -1 when it stops being active, else 0"""
+    return (new_status == "active") - (old_status == "active")
+
+# Callbacks (user_email, record_id, status) run after a commit that creates, changes or
+# removes a record, e.g. to keep in-process indexes current. Removed records are
+# reported with status 'deleted' or 'merged'; 'active' means "re-read this record".
+_record_listeners = []
+
+def add_record_listener(listener):
+    _record_listeners.append(listener)
+
+def notify_record_changes(user_email, changes):
+    for listener in _record_listeners:
+        for record_id, status in changes:
+            try:
+                listener(user_email, record_id, status)
+            except Exception as e:
+                print(f"[DB] Record listener failed for record {record_id}: {e}")
+
+def get_data_version(user_email):
+    """Current data version of a user (0 before the first write)"""
+    conn = get_connection(user_email)
+    row = conn.execute(
+        "SELECT version FROM user_data_versions WHERE user_email = ?", (user_email,)
+    ).fetchone()
     conn.close()
-    
-def get_bnpl_records(user_email=None, status_filter=None):
+    return row[0] if row else 0
+
+def _records_query(user_email=None, status_filter=None, fields=RECORD_FIELDS, limit=None, after=None,
+                   vendor=None, due_from=None, due_to=None):
+    """
+    Build the SELECT over both record tiers; returns (sql, params).
+    Rows hold the requested fields followed by the (created_at, id) keyset.
+    Paid records that were moved to bnpl_archive are included for None and 'paid'.
+    With limit each tier is cut at the index before the union, so the work is
+    bounded by the page size instead of the user's history.
+    """
+    tables = ["bnpl_records"]
+    if status_filter in (None, "paid"):
+        tables.append("bnpl_archive")
+
+    sql_parts = []
+    params = []
+    for table in tables:
+        columns = [
+            "'paid' AS status" if table == "bnpl_archive" and field == "status" else field
+            for field in fields
+        ] + ["created_at AS k_created", "id AS k_id"]
+
+        where = []
+        if user_email:
+            where.append("user_email = ?")
+            params.append(user_email)
+        if table == "bnpl_records" and status_filter:
+            where.append("status = ?")
+            params.append(status_filter)
+        if vendor:
+            where.append("vendor = ? COLLATE NOCASE")
+            params.append(vendor)
+        if due_from is not None:
+            where.append("due_ordinal >= ?")
+            params.append(due_from)
+        if due_to is not None:
+            where.append("due_ordinal <= ?")
+            params.append(due_to)
+        if after:
+            where.append("(created_at, id) < (?, ?)")
+            params.extend(after)
+
+        part = f"SELECT {', '.join(columns)} FROM {table}"
+        if where:
+            part += " WHERE " + " AND ".join(where)
+        if limit:
+            part = f"SELECT * FROM ({part} ORDER BY created_at DESC, id DESC LIMIT {int(limit)})"
+        sql_parts.append(part)
+
+    sql = " UNION ALL ".join(sql_parts) + " ORDER BY k_created DESC, k_id DESC"
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    return sql, params
+
+def canonical_fields(fields):
+    """
+    Requested fields deduplicated and in RECORD_FIELDS order (all fields when empty).
+    Raises ValueError for unknown names. Every projection maps to one record class,
+    so a client reordering fields= cannot mint new ones.
+    """
+    if not fields:
+        return RECORD_FIELDS
+    unknown = [field for field in fields if field not in RECORD_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    requested = set(fields)
+    return tuple(field for field in RECORD_FIELDS if field in requested)
+
+def _query_records(user_email=None, status_filter=None, fields=RECORD_FIELDS, limit=None, after=None, **filters):
+    sql, params = _records_query(user_email, status_filter, fields, limit, after, **filters)
+    if user_email:
+        conn = get_connection(user_email)
+        rows = conn.execute(sql, params).fetchall()
+        conn.close()
+        return rows
+
+    # Every shard returns its own first page; merging and cutting gives the global page
+    rows = fan_out_query(sql, params, sort_key=lambda row: (row[-2] or "", row[-1]), reverse=True)
+    return rows[:limit] if limit else rows
+
+def get_bnpl_records(user_email=None, status_filter=None, fields=None, vendor=None, due_from=None, due_to=None):
     """
     Get BNPL records. 
     status_filter: None (all), 'active', 'paid'
+    fields: subset of RECORD_FIELDS to select (default: all), returned in RECORD_FIELDS order
+    vendor: case-insensitive vendor match; due_from/due_to: due-date day ordinals
+    Without user_email the query fans out over every shard.
     """
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    if user_email:
-        if status_filter:
-            cursor.execute("""
-                SELECT id, gmail_message_id, vendor, amount, installments, due_date, email_subject, status, created_at 
-                FROM bnpl_records 
-                WHERE user_email = ? AND status = ?
-                ORDER BY created_at DESC
-            """, (user_email, status_filter))
-        else:
-            cursor.execute("""
-                SELECT id, gmail_message_id, vendor, amount, installments, due_date, email_subject, status, created_at 
-                FROM bnpl_records 
-                WHERE user_email = ?
-                ORDER BY created_at DESC
-            """, (user_email,))
-    else:
-        cursor.execute("""
-            SELECT id, gmail_message_id, vendor, amount, installments, due_date, email_subject, status, created_at 
-            FROM bnpl_records 
-            ORDER BY created_at DESC
-        """)
-    
-    rows = cursor.fetchall()
-    conn.close()
+    fields = canonical_fields(fields)
+    rows = _query_records(user_email, status_filter, fields, vendor=vendor, due_from=due_from, due_to=due_to)
+    return _to_records(rows, fields)
 
-    return [
-        {
-            "id": row[0],
-            "gmail_message_id": row[1],
-            "vendor": row[2],
-            "amount": row[3],
-            "installments": row[4],
-            "due_date": row[5],
-            "email_subject": row[6],
-            "status": row[7],
-            "created_at": row[8]
-        }
-        for row in rows
-    ]
+def get_bnpl_records_page(user_email, limit, cursor=None, status_filter=None, fields=None, **filters):
+    """
+    One page of records, newest first, using keyset pagination on (created_at, id).
+    Returns (records, next_cursor); next_cursor is None on the last page.
+    Raises ValueError for a malformed cursor or unknown fields.
+    """
+    fields = canonical_fields(fields)
+    after = decode_records_cursor(cursor) if cursor else None
+    rows = _query_records(user_email, status_filter, fields, limit + 1, after, **filters)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_records_cursor(rows[-1][-2], rows[-1][-1])
+    return _to_records(rows, fields), next_cursor
+
+EXPORT_FIELDS = ("user_email",) + RECORD_FIELDS
+
+def iter_export_rows(user_email=None, status_filter=None, chunk_size=500):
+    """
+    Yield lists of at most chunk_size row tuples (EXPORT_FIELDS order) straight
+    from SQLite cursors, one shard and tier at a time, so memory stays constant
+    no matter how many records exist. Rows are not globally ordered.
+    """
+    tables = ["bnpl_records"]
+    if status_filter in (None, "paid"):
+        tables.append("bnpl_archive")
+    paths = [get_shard_path(user_email)] if user_email else all_shard_paths()
+
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        conn = sqlite3.connect(path)
+        try:
+            for table in tables:
+                columns = ", ".join(
+                    "'paid' AS status" if table == "bnpl_archive" and field == "status" else field
+                    for field in EXPORT_FIELDS
+                )
+                where = []
+                params = []
+                if user_email:
+                    where.append("user_email = ?")
+                    params.append(user_email)
+                if table == "bnpl_records" and status_filter:
+                    where.append("status = ?")
+                    params.append(status_filter)
+                sql = f"SELECT {columns} FROM {table}"
+                if where:
+                    sql += " WHERE " + " AND ".join(where)
+
+                cursor = conn.execute(sql, params)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+        finally:
+            conn.close()
+
+def iter_bnpl_records(user_email=None, status_filter=None, chunk_size=500):
+    """Records (EXPORT_FIELDS projection), streamed from iter_export_rows"""
+    make = record_type(EXPORT_FIELDS)._make
+    for rows in iter_export_rows(user_email, status_filter, chunk_size):
+        yield from map(make, rows)
+
+def encode_records_cursor(created_at, record_id):
+    raw = json.dumps([created_at, record_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_records_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, record_id = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(created_at, str) or not isinstance(record_id, int):
+        raise ValueError("Invalid cursor")
+    return created_at, record_id
+
+def _to_records(rows, fields=RECORD_FIELDS):
+    """Compact records from query rows; the trailing keyset columns are dropped."""
+    make = record_type(fields)._make
+    width = len(fields)
+    return [make(row[:width]) for row in rows]
+
+def record_fingerprint(vendor, amount, installments):
+    """Normalized (vendor, amount, installments) key; the due-date window is matched on due_ordinal."""
+    vendor_key = " ".join((vendor or "").lower().split())
+    amount_key = int(round(amount or 0))
+    return f"{vendor_key}|{amount_key}|{installments or 1}"
+
+def due_date_ordinal(due_date):
+    """Day number of a DD/MM/YYYY due date, or None when it is missing or unparseable."""
+    try:
+        return datetime.strptime(due_date, '%d/%m/%Y').toordinal()
+    except (TypeError, ValueError):
+        return None
+
+def _find_duplicate(cursor, user_email, fingerprint, due_ordinal):
+    """Id of the active record this one is a repeated reminder of, if any."""
+    if due_ordinal is None:
+        # Without a due date two purchases of the same amount are too easy to confuse
+        return None
+    cursor.execute("""
+        SELECT id FROM bnpl_records
+        WHERE user_email = ? AND fingerprint = ? AND status = 'active'
+          AND due_ordinal BETWEEN ? AND ?
+        ORDER BY id
+        LIMIT 1
+    """, (user_email, fingerprint, due_ordinal - DEDUPE_WINDOW_DAYS, due_ordinal + DEDUPE_WINDOW_DAYS))
+    row = cursor.fetchone()
+    return row[0] if row else None
 
 def insert_bnpl_record(user_email, gmail_message_id, vendor, amount, installments, due_date, email_subject):
-    """Insert BNPL record with Gmail message ID for idempotent sync"""
-    conn = sqlite3.connect(DB_PATH)
+    """
+    Insert BNPL record with Gmail message ID for idempotent sync.
+    A likely duplicate of an existing active record (same fingerprint, due date within
+    DEDUPE_WINDOW_DAYS) is merged into it as an extra source instead of a new row.
+    Returns True only when a new record was created.
+    """
+    conn = get_connection(user_email)
     cursor = conn.cursor()
+    fingerprint = record_fingerprint(vendor, amount, installments)
+    due_ordinal = due_date_ordinal(due_date)
     
     try:
+        canonical_id = _find_duplicate(cursor, user_email, fingerprint, due_ordinal)
+        if canonical_id is not None:
+            cursor.execute("""
+                INSERT OR IGNORE INTO bnpl_record_sources (user_email, gmail_message_id, record_id)
+                SELECT ?, ?, ?
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM bnpl_records WHERE user_email = ? AND gmail_message_id = ?
+                ) AND NOT EXISTS (
+                    SELECT 1 FROM bnpl_message_tombstones WHERE user_email = ? AND gmail_message_id = ?
+                )
+            """, (user_email, gmail_message_id, canonical_id, user_email, gmail_message_id,
+                  user_email, gmail_message_id))
+            merged = cursor.rowcount
+            if merged:
+                bump_data_version(cursor, user_email, [])
+            conn.commit()
+            if merged:
+                print(f"[DB] Merged Gmail message {gmail_message_id} into record {canonical_id} for user {user_email}")
+            return False
+
+        # Archived, merged and cleared messages stay in the idempotency set so they are never re-imported
         cursor.execute("""
-            INSERT INTO bnpl_records (user_email, gmail_message_id, vendor, amount, installments, due_date, email_subject)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (user_email, gmail_message_id, vendor, amount, installments, due_date, email_subject))
+            INSERT INTO bnpl_records (user_email, gmail_message_id, vendor, amount, installments, due_date, email_subject, fingerprint, due_ordinal)
+            SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?
+            WHERE NOT EXISTS (
+                SELECT 1 FROM bnpl_archive WHERE user_email = ? AND gmail_message_id = ?
+            ) AND NOT EXISTS (
+                SELECT 1 FROM bnpl_record_sources WHERE user_email = ? AND gmail_message_id = ?
+            ) AND NOT EXISTS (
+                SELECT 1 FROM bnpl_message_tombstones WHERE user_email = ? AND gmail_message_id = ?
+            )
+        """, (user_email, gmail_message_id, vendor, amount, installments, due_date, email_subject,
+              fingerprint, due_ordinal, user_email, gmail_message_id, user_email, gmail_message_id,
+              user_email, gmail_message_id))
         
+        if cursor.rowcount == 0:
+            raise sqlite3.IntegrityError("message already archived, merged or cleared")
+        record_id = cursor.lastrowid
+        bump_data_version(cursor, user_email, [(1, amount, installments, due_date)])
         conn.commit()
+        notify_record_changes(user_email, [(record_id, "active")])
         return True
     except sqlite3.IntegrityError as e:
         # Duplicate gmail_message_id for this user - skip
@@ -119,31 +532,151 @@ def insert_bnpl_record(user_email, gmail_message_id, vendor, amount, installment
     finally:
         conn.close()
 
+def get_record_merges(user_email):
+    """
+    Merge decisions for a user: each canonical record with the message ids folded into it.
+    Canonical records are looked up in both tiers; compaction archives them without their sources.
+    """
+    conn = get_connection(user_email)
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT s.record_id, r.gmail_message_id, r.vendor, r.amount, r.installments, r.due_date,
+               s.gmail_message_id, s.merged_at
+        FROM bnpl_record_sources s
+        LEFT JOIN (
+            SELECT id, gmail_message_id, vendor, amount, installments, due_date
+            FROM bnpl_records WHERE user_email = ?
+            UNION ALL
+            SELECT id, gmail_message_id, vendor, amount, installments, due_date
+            FROM bnpl_archive WHERE user_email = ?
+        ) r ON r.id = s.record_id
+        WHERE s.user_email = ?
+        ORDER BY s.record_id, s.merged_at
+    """, (user_email, user_email, user_email))
+    rows = cursor.fetchall()
+    conn.close()
+
+    merges = {}
+    for record_id, canonical_msg, vendor, amount, installments, due_date, source_msg, merged_at in rows:
+        merge = merges.setdefault(record_id, {
+            "record_id": record_id,
+            "gmail_message_id": canonical_msg,
+            "vendor": vendor,
+            "amount": amount,
+            "installments": installments,
+            "due_date": due_date,
+            "merged_message_ids": [],
+            "last_merged_at": None
+        })
+        merge["merged_message_ids"].append(source_msg)
+        merge["last_merged_at"] = merged_at
+    return list(merges.values())
+
 def clear_bnpl_records(user_email):
-    conn = sqlite3.connect(DB_PATH)
+    """
+    Delete every record of a user, live and archived, so the next sync rebuilds them.
+    Only active records come back: message ids of paid, archived and merged-away
+    records are kept as tombstones, otherwise the re-sync would import them as active.
+    """
+    conn = get_connection(user_email)
     cursor = conn.cursor()
+    cursor.execute("""
+        INSERT OR IGNORE INTO bnpl_message_tombstones (user_email, gmail_message_id)
+        SELECT user_email, gmail_message_id FROM bnpl_records
+        WHERE user_email = ? AND status = 'paid' AND gmail_message_id IS NOT NULL
+        UNION ALL
+        SELECT user_email, gmail_message_id FROM bnpl_archive
+        WHERE user_email = ? AND gmail_message_id IS NOT NULL
+        UNION ALL
+        SELECT user_email, gmail_message_id FROM bnpl_record_sources
+        WHERE user_email = ?
+    """, (user_email, user_email, user_email))
+    cursor.execute("SELECT id FROM bnpl_records WHERE user_email = ?", (user_email,))
+    cleared = [row[0] for row in cursor.fetchall()]
     cursor.execute("DELETE FROM bnpl_records WHERE user_email = ?", (user_email,))
+    cursor.execute("DELETE FROM bnpl_archive WHERE user_email = ?", (user_email,))
+    cursor.execute("DELETE FROM bnpl_record_sources WHERE user_email = ?", (user_email,))
+    bump_data_version(cursor, user_email)
     conn.commit()
     conn.close()
+    notify_record_changes(user_email, [(record_id, "deleted") for record_id in cleared])
+
+SCHEDULE_FIELDS = ("amount", "installments", "due_date")
+
+def _apply_dues(cursor, user_email, active_changes):
+    """Add (sign +1) or remove (sign -1) the installments of records in dues_calendar"""
+    rows = []
+    for sign, amount, installments, due_date in active_changes:
+        if not sign:
+            continue
+        record = dict(zip(SCHEDULE_FIELDS, (amount, installments, due_date)))
+        for month, (dues, count) in monthly_dues([record], since=date.min).items():
+            rows.append((user_email, month, sign * dues, sign * count))
+    if not rows:
+        return
+    cursor.executemany("""
+        INSERT INTO dues_calendar (user_email, month, amount, installment_count) VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_email, month) DO UPDATE SET
+            amount = amount + excluded.amount,
+            installment_count = installment_count + excluded.installment_count
+    """, rows)
+    cursor.execute("DELETE FROM dues_calendar WHERE user_email = ? AND installment_count <= 0", (user_email,))
+
+def rebuild_dues_calendar(cursor, user_email):
+    """Recompute a user's dues_calendar rows from their active records"""
+    cursor.execute(f"""
+        SELECT {', '.join(SCHEDULE_FIELDS)} FROM bnpl_records
+        WHERE user_email = ? AND status = 'active'
+        ORDER BY created_at DESC, id DESC
+    """, (user_email,))
+    # Every installment is stored, so rows stay valid as months go by
+    dues = monthly_dues(_to_records(cursor.fetchall(), SCHEDULE_FIELDS), since=date.min)
+    cursor.execute("DELETE FROM dues_calendar WHERE user_email = ?", (user_email,))
+    cursor.executemany(
+        "INSERT INTO dues_calendar (user_email, month, amount, installment_count) VALUES (?, ?, ?, ?)",
+        [(user_email, month, amount, count) for month, (amount, count) in dues.items()]
+    )
+
+def get_dues_calendar(user_email, first_month, months):
+    """
+    Dues of `months` consecutive calendar months from first_month (a finance.month_key):
+    list of (month_key, amount, installment_count), zero for months without dues.
+    """
+    conn = get_connection(user_email)
+    try:
+        rows = conn.execute("""
+            SELECT month, amount, installment_count FROM dues_calendar
+            WHERE user_email = ? AND month BETWEEN ? AND ?
+        """, (user_email, first_month, first_month + months - 1)).fetchall()
+    finally:
+        conn.close()
+
+    found = {month: (amount, count) for month, amount, count in rows}
+    return [(month,) + found.get(month, (0, 0)) for month in range(first_month, first_month + months)]
 
 def get_user_salary(user_email):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection(user_email)
     cursor = conn.cursor()
     cursor.execute("SELECT salary FROM users WHERE email = ?", (user_email,))
     row = cursor.fetchone()
     conn.close()
     return row[0] if row else 30000  # Default salary
 
+PROFILE_COLUMNS = "email, salary, full_name, monthly_rent, other_expenses, city, existing_loans"
+
 def get_user_profile(user_email):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection(user_email)
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT email, salary, full_name, monthly_rent, other_expenses, city, existing_loans 
+    cursor.execute(f"""
+        SELECT {PROFILE_COLUMNS} 
         FROM users WHERE email = ?
     """, (user_email,))
     row = cursor.fetchone()
     conn.close()
     
+    return _profile_to_dict(row)
+
+def _profile_to_dict(row):
     if row:
         return {
             "email": row[0],
@@ -156,20 +689,45 @@ def get_user_profile(user_email):
         }
     return None
 
+def get_dashboard_snapshot(user_email, include_records=True):
+    """
+    Load profile and all records of a user from one read transaction, so every
+    dashboard section is computed from the same consistent state.
+    Returns (profile or None, records, data version).
+    """
+    conn = get_connection(user_email)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN")
+        cursor.execute(f"SELECT {PROFILE_COLUMNS} FROM users WHERE email = ?", (user_email,))
+        profile = _profile_to_dict(cursor.fetchone())
+        rows = []
+        if include_records:
+            sql, params = _records_query(user_email)
+            rows = cursor.execute(sql, params).fetchall()
+        cursor.execute("SELECT version FROM user_data_versions WHERE user_email = ?", (user_email,))
+        row = cursor.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+
+    return profile, _to_records(rows), row[0] if row else 0
+
 def update_user_salary(user_email, salary):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection(user_email)
     cursor = conn.cursor()
     
     cursor.execute("""
         INSERT INTO users (email, salary) VALUES (?, ?)
         ON CONFLICT(email) DO UPDATE SET salary = ?
     """, (user_email, salary, salary))
+    bump_data_version(cursor, user_email, [])
     
     conn.commit()
     conn.close()
 
 def update_user_profile(user_email, profile_data):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection(user_email)
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -199,64 +757,297 @@ def update_user_profile(user_email, profile_data):
         profile_data.get("city"),
         profile_data.get("existing_loans", 0)
     ))
+    bump_data_version(cursor, user_email, [])
     
     conn.commit()
     conn.close()
 
-def update_bnpl_status(record_id, status):
-    """Update BNPL record status (active/paid)"""
-    conn = sqlite3.connect(DB_PATH)
+def update_bnpl_status(record_id, status, user_email=None):
+    """
+    Update BNPL record status (active/paid).
+    paid_at is stamped so the archival job can tell how long a record has been paid.
+    Record ids are unique across shards, so without user_email the owner is looked up first.
+    """
+    if not user_email:
+        record = get_bnpl_record_by_id(record_id)
+        if not record:
+            return
+        user_email = record["user_email"]
+
+    conn = get_connection(user_email)
     cursor = conn.cursor()
     
+    # The status read and the update share one write transaction, so the obligation
+    # change handed to the risk history is the one this update actually made
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("""
+        SELECT status, amount, installments, due_date FROM bnpl_records WHERE id = ? AND user_email = ?
+    """, (record_id, user_email))
+    current = cursor.fetchone()
     cursor.execute("""
         UPDATE bnpl_records 
-        SET status = ? 
-        WHERE id = ?
-    """, (status, record_id))
+        SET status = ?, paid_at = CASE WHEN ? = 'paid' THEN CURRENT_TIMESTAMP END
+        WHERE id = ? AND user_email = ?
+    """, (status, status, record_id, user_email))
+    changed = cursor.rowcount
+    if changed:
+        bump_data_version(cursor, user_email, [(active_sign(current[0], status),) + current[1:]])
     
     conn.commit()
     conn.close()
+    if changed:
+        notify_record_changes(user_email, [(record_id, status)])
+
+VALID_STATUSES = ("active", "paid")
+
+def update_bnpl_statuses(user_email, changes):
+    """
+    Apply many status changes for one user in a single transaction.
+    changes: list of (record_id, status).
+    Ownership of every id is checked with one query; returns {record_id: outcome}
+    where outcome is 'updated', 'unchanged', 'not_found', 'forbidden' or 'invalid_status'.
+    An id given more than once is applied once, with the last status given for it.
+    """
+    results = {}
+    valid = []
+    for record_id, status in dict(changes).items():
+        if status not in VALID_STATUSES:
+            results[record_id] = "invalid_status"
+        else:
+            valid.append((record_id, status))
+    if not valid:
+        return results
 
-def get_bnpl_record_by_id(record_id):
-    """Get a specific BNPL record by ID"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection(user_email)
     cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT id, user_email, gmail_message_id, vendor, amount, installments, due_date, email_subject, status, created_at 
-        FROM bnpl_records 
-        WHERE id = ?
-    """, (record_id,))
-    
-    row = cursor.fetchone()
-    conn.close()
+    try:
+        # Read the current statuses under the write lock (see update_bnpl_status)
+        cursor.execute("BEGIN IMMEDIATE")
+        ids = [record_id for record_id, _ in valid]
+        placeholders = ", ".join("?" for _ in ids)
+        cursor.execute(f"""
+            SELECT id, user_email, status, amount, installments, due_date FROM bnpl_records
+            WHERE id IN ({placeholders})
+        """, ids)
+        found = {row[0]: row[1:] for row in cursor.fetchall()}
+
+        updates = []
+        active_changes = []
+        for record_id, status in valid:
+            if record_id not in found:
+                results[record_id] = "not_found"
+            elif found[record_id][0] != user_email:
+                results[record_id] = "forbidden"
+            elif found[record_id][1] == status:
+                results[record_id] = "unchanged"
+            else:
+                updates.append((status, status, record_id, user_email))
+                active_changes.append((active_sign(found[record_id][1], status),) + found[record_id][2:])
+                results[record_id] = "updated"
+
+        cursor.executemany("""
+            UPDATE bnpl_records
+            SET status = ?, paid_at = CASE WHEN ? = 'paid' THEN CURRENT_TIMESTAMP END
+            WHERE id = ? AND user_email = ?
+        """, updates)
+        if updates:
+            bump_data_version(cursor, user_email, active_changes)
+        conn.commit()
+    finally:
+        conn.close()
+    notify_record_changes(user_email, [(record_id, status) for status, _, record_id, _ in updates])
+    return results
+
+def get_bnpl_record_by_id(record_id, user_email=None):
+    """Get a specific BNPL record by ID (on the user's shard when user_email is given)"""
+    query = f"SELECT {', '.join(EXPORT_FIELDS)} FROM bnpl_records WHERE id = ?"
+    if user_email:
+        conn = get_connection(user_email)
+        row = conn.execute(query, (record_id,)).fetchone()
+        conn.close()
+    else:
+        rows = fan_out_query(query, (record_id,))
+        row = rows[0] if rows else None
     
     if row:
-        return {
-            "id": row[0],
-            "user_email": row[1],
-            "gmail_message_id": row[2],
-            "vendor": row[3],
-            "amount": row[4],
-            "installments": row[5],
-            "due_date": row[6],
-            "email_subject": row[7],
-            "status": row[8],
-            "created_at": row[9]
-        }
+        return record_type(EXPORT_FIELDS)._make(row)
     return None
 
 def is_gmail_message_processed(user_email, gmail_message_id):
     """Check if a Gmail message has already been processed for this user"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection(user_email)
     cursor = conn.cursor()
     
     cursor.execute("""
         SELECT id FROM bnpl_records 
         WHERE user_email = ? AND gmail_message_id = ?
-    """, (user_email, gmail_message_id))
+        UNION ALL
+        SELECT id FROM bnpl_archive
+        WHERE user_email = ? AND gmail_message_id = ?
+        UNION ALL
+        SELECT record_id FROM bnpl_record_sources
+        WHERE user_email = ? AND gmail_message_id = ?
+        UNION ALL
+        SELECT 0 FROM bnpl_message_tombstones
+        WHERE user_email = ? AND gmail_message_id = ?
+    """, (user_email, gmail_message_id, user_email, gmail_message_id, user_email, gmail_message_id,
+          user_email, gmail_message_id))
     
     row = cursor.fetchone()
     conn.close()
     
-    return row is not None
\ No newline at end of file
+    return row is not None
+
+
+def selftest():
+    """
+    Clear and re-sync on a scratch database: active records come back, while paid,
+    archived and merged-away messages stay tombstoned instead of returning as active.
+    Risk history: concurrent status changes of one record apply its obligation change
+    once, and compaction re-bases a drifted history on a rescan. Dues calendar: the
+    rows kept up to date by each write match a rebuild from the active records.
+    """
+    import tempfile
+    import threading
+    from backend.archive import compact_shard
+    from backend.risk_history import current_metrics
+
+    user_email = "selftest@example.com"
+    messages = [
+        ("msg-active", "LazyPay", 1200.0, 3, "01/01/2030"),
+        ("msg-paid", "Simpl", 900.0, 3, "01/02/2030"),
+        ("msg-archived", "ZestMoney", 3000.0, 6, "01/03/2030"),
+        # Same purchase as msg-active, reminded a day later: merged into it
+        ("msg-merged", "LazyPay", 1200.0, 3, "02/01/2030"),
+    ]
+
+    def sync():
+        for message_id, vendor, amount, installments, due_date in messages:
+            if not is_gmail_message_processed(user_email, message_id):
+                insert_bnpl_record(user_email, message_id, vendor, amount, installments, due_date, "Installment due")
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            os.makedirs(os.path.dirname(DB_PATH))
+            init_db()
+            sync()
+            ids = {record["gmail_message_id"]: record["id"] for record in get_bnpl_records(user_email)}
+            update_bnpl_status(ids["msg-archived"], "paid", user_email)
+            compact_shard(get_shard_path(user_email), max_age_days=-1)
+            update_bnpl_status(ids["msg-paid"], "paid", user_email)
+            assert len(get_record_merges(user_email)) == 1
+
+            # A merged record that gets archived keeps its entry in the merges view
+            merged_email = "selftest-merges@example.com"
+            insert_bnpl_record(merged_email, "msg-first", "Simpl", 600.0, 3, "01/01/2030", "Installment due")
+            insert_bnpl_record(merged_email, "msg-reminder", "Simpl", 600.0, 3, "02/01/2030", "Installment due")
+            update_bnpl_status(get_bnpl_records(merged_email)[0]["id"], "paid", merged_email)
+            compact_shard(get_shard_path(merged_email), max_age_days=-1)
+            [merge] = get_record_merges(merged_email)
+            assert (merge["gmail_message_id"], merge["vendor"], merge["merged_message_ids"]) == \
+                ("msg-first", "Simpl", ["msg-reminder"]), merge
+            print("[DB] Merges view: an archived canonical record still shows its fields")
+
+            clear_bnpl_records(user_email)
+            assert get_bnpl_records(user_email) == []
+            sync()
+            after = [(record["gmail_message_id"], record["status"]) for record in get_bnpl_records(user_email)]
+            assert after == [("msg-active", "active")], f"re-sync after clear imported {after}"
+            print("[DB] Clear + re-sync: the active record came back; paid, archived and merged "
+                  "messages stayed tombstoned")
+
+            history_email = "selftest-history@example.com"
+            update_user_salary(history_email, 10000)
+            insert_bnpl_record(history_email, "msg-a", "Simpl", 1000.0, 1, "01/01/2030", "Installment due")
+            insert_bnpl_record(history_email, "msg-b", "Simpl", 2000.0, 1, "01/02/2030", "Installment due")
+            record_id = get_bnpl_records(history_email)[0]["id"]
+            start = threading.Barrier(8)
+
+            def mark_paid():
+                start.wait()
+                update_bnpl_status(record_id, "paid", history_email)
+
+            workers = [threading.Thread(target=mark_paid) for _ in range(8)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            def stored_obligation():
+                conn = get_connection(history_email)
+                row = conn.execute("""
+                    SELECT monthly_obligation FROM risk_history
+                    WHERE user_email = ? ORDER BY ts DESC LIMIT 1
+                """, (history_email,)).fetchone()
+                conn.close()
+                return row[0]
+
+            assert stored_obligation() == 1000.0, f"concurrent updates stored {stored_obligation()}"
+            print("[DB] 8 concurrent 'mark paid' requests: the obligation change was applied once")
+
+            conn = get_connection(history_email)
+            conn.execute("UPDATE risk_history SET monthly_obligation = -1000 WHERE user_email = ?", (history_email,))
+            conn.commit()
+            conn.close()
+            compact_shard(get_shard_path(history_email))
+            conn = get_connection(history_email)
+            expected = current_metrics(conn.cursor(), history_email)
+            conn.close()
+            assert stored_obligation() == expected[2] == 1000.0
+            print("[DB] Compaction re-based a drifted risk history on a rescan")
+
+            calendar_email = "selftest-calendar@example.com"
+
+            def calendar_rows():
+                conn = get_connection(calendar_email)
+                rows = conn.execute("""
+                    SELECT month, ROUND(amount, 6), installment_count FROM dues_calendar
+                    WHERE user_email = ? ORDER BY month
+                """, (calendar_email,)).fetchall()
+                conn.close()
+                return rows
+
+            def rebuilt_rows():
+                conn = get_connection(calendar_email)
+                rebuild_dues_calendar(conn.cursor(), calendar_email)
+                rows = conn.execute("""
+                    SELECT month, ROUND(amount, 6), installment_count FROM dues_calendar
+                    WHERE user_email = ? ORDER BY month
+                """, (calendar_email,)).fetchall()
+                conn.rollback()
+                conn.close()
+                return rows
+
+            for n, (amount, installments, due_date) in enumerate([
+                (1200.0, 3, "15/01/2030"), (999.0, 6, "31/01/2030"), (500.0, 1, "02/03/2030"), (300.0, 4, None)
+            ]):
+                insert_bnpl_record(calendar_email, f"msg-cal-{n}", "Simpl", amount, installments, due_date, "Installment due")
+            calendar_ids = [record["id"] for record in get_bnpl_records(calendar_email)]
+            update_bnpl_status(calendar_ids[0], "paid", calendar_email)
+            update_bnpl_statuses(calendar_email, [(calendar_ids[1], "paid"), (calendar_ids[2], "paid")])
+            update_bnpl_status(calendar_ids[1], "active", calendar_email)
+            update_user_salary(calendar_email, 50000)
+            assert calendar_rows() and calendar_rows() == rebuilt_rows(), "incremental dues calendar drifted"
+            clear_bnpl_records(calendar_email)
+            assert calendar_rows() == []
+            print("[DB] Dues calendar kept current by each write, matching a rebuild")
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    # Usage:
+    #   python -m backend.models migrate
+    #     Run once per deploy that upgrades an existing database, before starting the workers
+    #   python -m backend.models selftest
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "migrate":
+        migrate_db()
+    elif command == "selftest":
+        # Run in the imported module, which archive and the listeners share
+        from backend.models import selftest
+        selftest()
+    else:
+        print("Usage: python -m backend.models migrate | selftest")
@@ -0,0 +1,214 @@
+import sys
+import json
+import time
+import tracemalloc
+from collections import namedtuple
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+
+
+class Record(tuple):
+    """
+    Base of the compact record classes: a plain tuple underneath (no per-row dict)
+    that also supports record["amount"], record.get("amount") and dict(record),
+    so code written against the old dict rows keeps working.
+    """
+    __slots__ = ()
+    _index = {}
+    prefixes = ()
+
+    def __getitem__(self, key):
+        if key.__class__ is str:
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        return default if i is None else tuple.__getitem__(self, i)
+
+    def keys(self):
+        return self._fields
+
+    def to_dict(self):
+        return dict(zip(self._fields, self))
+
+
+# Projections are canonicalized by models.canonical_fields; the bound only guards
+# against callers that are not
+RECORD_TYPE_CACHE_SIZE = 128
+
+
+@lru_cache(maxsize=RECORD_TYPE_CACHE_SIZE)
+def record_type(fields):
+    """Record class for a tuple of column names (one class per projection)."""
+    return type("BnplRecord", (namedtuple("BnplRecord", fields), Record), {
+        "__slots__": (),
+        "_index": {field: i for i, field in enumerate(fields)},
+        "prefixes": _key_prefixes(fields),
+    })
+
+
+def is_record(value):
+    return isinstance(value, Record)
+
+
+def _key_prefixes(fields):
+    """'{"id":', ',"vendor":', ... — the constant part of every serialized record"""
+    return tuple(
+        ("{" if i == 0 else ",") + encode_basestring_ascii(field) + ":"
+        for i, field in enumerate(fields)
+    )
+
+
+# C encoder for whole columns and for values of mixed columns
+_encode_json = json.JSONEncoder(separators=(",", ":")).encode
+
+
+def _encode_column(values):
+    """JSON text of every value in one column, as a sequence in row order."""
+    kinds = set(map(type, values))
+    if kinds == {str}:
+        return map(encode_basestring_ascii, values)
+    if not any(issubclass(kind, str) for kind in kinds):
+        # Numbers, booleans and nulls contain no commas, so one C encoder call per
+        # column can be split back into values
+        return _encode_json(values)[1:-1].split(",")
+    return [encode_basestring_ascii(value) if value.__class__ is str else _encode_json(value) for value in values]
+
+
+def encode_rows(rows, prefixes):
+    """
+    Rows of one projection as JSON objects, one string per row.
+    Values are encoded a column at a time (C-level map and encoder calls) and the
+    objects assembled from a per-projection template, so no Python code runs per value.
+    """
+    if not rows:
+        return []
+    if not prefixes:
+        return ["{}"] * len(rows)
+    template = "".join(prefix.replace("%", "%%") + "%s" for prefix in prefixes) + "}"
+    columns = map(_encode_column, zip(*rows))
+    return list(map(template.__mod__, zip(*columns)))
+
+
+def encode_record(record, prefixes=None):
+    """One record as a JSON object, written straight from its tuple values."""
+    return encode_rows([record], prefixes or record.prefixes)[0]
+
+
+def encode_records(records):
+    """A list of records of one projection as a JSON array."""
+    if not records:
+        return "[]"
+    return "[" + ",".join(encode_rows(records, records[0].prefixes)) + "]"
+
+
+def contains_records(obj):
+    """True when obj is a record or holds one at any depth of dicts and lists."""
+    if is_record(obj):
+        return True
+    if isinstance(obj, dict):
+        return any(contains_records(value) for value in obj.values())
+    if isinstance(obj, list):
+        # A record list is recognized by its first item without walking the rest
+        return bool(obj) and (is_record(obj[0]) or any(contains_records(value) for value in obj))
+    return False
+
+
+def dumps(obj, fallback=json.dumps):
+    """
+    Serialize a response payload, taking the fast path for records and lists of
+    records wherever they are nested and handing every other value to fallback.
+    """
+    if is_record(obj):
+        return encode_record(obj)
+    if isinstance(obj, list) and obj and is_record(obj[0]):
+        return encode_records(obj)
+    if not contains_records(obj):
+        return fallback(obj)
+    if isinstance(obj, dict):
+        return "{" + ",".join(
+            encode_basestring_ascii(str(key)) + ":" + dumps(value, fallback)
+            for key, value in sorted(obj.items())
+        ) + "}"
+    return "[" + ",".join(dumps(value, fallback) for value in obj) + "]"
+
+
+def _sample_rows(count):
+    from backend.models import RECORD_FIELDS
+    vendors = ("Klarna", "Afterpay", "Simpl", "LazyPay", "ZestMoney")
+    return RECORD_FIELDS, [
+        (i, f"msg-{i:08d}", vendors[i % len(vendors)], 499.0 + i % 4000, 1 + i % 6,
+         f"{1 + i % 28:02d}/{1 + i % 12:02d}/2026", f"Your {vendors[i % len(vendors)]} payment reminder #{i}",
+         "active" if i % 3 else "paid", "2026-01-01 10:00:00")
+        for i in range(count)
+    ]
+
+
+def _measure(build, serialize, repeat=5):
+    """
+    Best of `repeat` untraced runs; tracemalloc slows allocation-heavy code down, so
+    peak memory comes from a separate traced run.
+    """
+    build_s = serialize_s = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        records = build()
+        built = time.perf_counter()
+        body = serialize(records)
+        done = time.perf_counter()
+        build_s, serialize_s = min(build_s, built - start), min(serialize_s, done - built)
+        del records
+
+    tracemalloc.start()
+    serialize(build())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "build_ms": round(build_s * 1000, 2),
+        "serialize_ms": round(serialize_s * 1000, 2),
+        "peak_kb": round(peak / 1024, 1),
+        "bytes": len(body)
+    }
+
+
+def benchmark_serialization(count=10000):
+    """
+    Time and peak memory of turning count fetched rows into a JSON array:
+    dict rows + json.dumps (the old path) against compact records + encode_records,
+    plus one finance pass over each, since finance reads records by field name.
+    """
+    from backend.finance import summarize_records
+    fields, rows = _sample_rows(count)
+    make = record_type(fields)._make
+
+    compact_dumps = json.JSONEncoder(separators=(",", ":")).encode
+    build = {"dicts": lambda: [dict(zip(fields, row)) for row in rows], "records": lambda: [make(row) for row in rows]}
+    results = {
+        "dicts": _measure(build["dicts"], compact_dumps),
+        "records": _measure(build["records"], encode_records),
+    }
+    for name, result in results.items():
+        values = build[name]()
+        best = float("inf")
+        for _ in range(5):
+            start = time.perf_counter()
+            summarize_records(values)
+            best = min(best, time.perf_counter() - start)
+        result["summarize_ms"] = round(best * 1000, 2)
+        print(f"[Records] {name:8s} {count} rows: build {result['build_ms']}ms, "
+              f"serialize {result['serialize_ms']}ms, summarize {result['summarize_ms']}ms, "
+              f"peak {result['peak_kb']}KB, {result['bytes']} bytes")
+
+    # Both paths must produce the same document
+    dict_body = json.loads(json.dumps([dict(zip(fields, row)) for row in rows]))
+    record_body = json.loads(encode_records([make(row) for row in rows]))
+    assert dict_body == record_body, "serializer output differs from json.dumps"
+    nested = {"page": {"records": [make(row) for row in rows[:3]], "next": None}, "count": 3}
+    assert json.loads(dumps(nested)) == json.loads(json.dumps({"page": {"records": [dict(zip(fields, row)) for row in rows[:3]], "next": None}, "count": 3}))
+    return results
+
+
+if __name__ == "__main__":
+    # Usage: python -m backend.records [count]
+    benchmark_serialization(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
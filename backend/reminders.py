@@ -0,0 +1,509 @@
+import os
+import sys
+import time
+import heapq
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta
+from backend.finance import add_months
+from backend.http_client import get_session
+from backend.sharding import all_shard_paths, get_shard_path
+from backend.ttl_store import create_store
+
+# Installments due within this many hours are reminded
+REMINDER_LEAD_HOURS = int(os.getenv("REMINDER_LEAD_HOURS", "72"))
+
+# Minutes between dispatcher runs in the background-jobs process (0 disables the dispatcher;
+# python -m backend.jobs defaults to 15)
+REMINDER_INTERVAL_MINUTES = float(os.getenv("REMINDER_INTERVAL_MINUTES", "0"))
+
+# log, webhook or email
+REMINDER_SINK = os.getenv("REMINDER_SINK", "log")
+REMINDER_WEBHOOK_URL = os.getenv("REMINDER_WEBHOOK_URL")
+
+# Users per notification batch handed to a sink
+REMINDER_BATCH_SIZE = 100
+
+# Hours between full re-seeds of the index from the database, which pick up writes
+# made by other processes (sync workers, the email cache, dedupe)
+REMINDER_RESEED_HOURS = 24
+
+_dispatcher_started = False
+
+
+def _next_installment(first_due, installments, since):
+    """(number, date) of the first installment on or after since, or None when all are past"""
+    for number in range(installments):
+        due = add_months(first_due, number)
+        if due >= since:
+            return number, due
+    return None
+
+
+class DueIndex:
+    """
+    Upcoming installments of active records across all users, bucketed by due day
+    (a timer wheel with one slot per day). Each record sits in the bucket of its next
+    installment only; when that day passes, advance() re-arms it for the following one.
+    Looking up a range of days touches only those buckets, so the cost follows the
+    number of installments found, not the number of records.
+    """
+
+    def __init__(self):
+        self._buckets = {}      # due ordinal -> {record_id: entry}
+        self._days = []         # min-heap of bucket ordinals (may hold emptied days)
+        self._slot = {}         # record_id -> due ordinal of its bucket
+        self._today = date.today().toordinal()
+        self._seen = {}         # shard path -> highest record id read from it
+        self._pending = None    # add/remove calls made while seed() runs, replayed on the new index
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._slot)
+
+    def add(self, record_id, user_email, record):
+        """Index a record's next installment; record needs amount, installments and due_date."""
+        amount = record.get("amount")
+        installments = record.get("installments")
+        try:
+            first_due = datetime.strptime(record.get("due_date") or "", "%d/%m/%Y").date()
+        except ValueError:
+            return
+        if not amount or not installments or installments <= 0:
+            return
+        entry = {
+            "record_id": record_id,
+            "user_email": user_email,
+            "vendor": record.get("vendor"),
+            "amount": amount / installments,
+            "first_due": first_due,
+            "installments": int(installments),
+        }
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((record_id, user_email, record))
+            self._remove(record_id)
+            self._arm(entry, date.fromordinal(self._today))
+
+    def remove(self, record_id):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((record_id, None, None))
+            self._remove(record_id)
+
+    def _remove(self, record_id):
+        day = self._slot.pop(record_id, None)
+        if day is not None:
+            bucket = self._buckets[day]
+            del bucket[record_id]
+            if not bucket:
+                del self._buckets[day]
+
+    def _arm(self, entry, since):
+        upcoming = _next_installment(entry["first_due"], entry["installments"], since)
+        if upcoming is None:
+            return
+        entry["installment"], due = upcoming
+        day = due.toordinal()
+        bucket = self._buckets.get(day)
+        if bucket is None:
+            bucket = self._buckets[day] = {}
+            heapq.heappush(self._days, day)
+        bucket[entry["record_id"]] = entry
+        self._slot[entry["record_id"]] = day
+
+    def advance(self, today=None):
+        """Move past days' entries to their next installment. Returns how many were re-armed."""
+        today = (today or date.today()).toordinal()
+        moved = 0
+        with self._lock:
+            self._today = max(self._today, today)
+            while self._days and self._days[0] < today:
+                day = heapq.heappop(self._days)
+                for entry in self._buckets.pop(day, {}).values():
+                    del self._slot[entry["record_id"]]
+                    self._arm(entry, date.fromordinal(today))
+                    moved += 1
+        return moved
+
+    def due_between(self, first, last):
+        """Entries due on days first..last (dates), in due order."""
+        found = []
+        with self._lock:
+            for day in range(first.toordinal(), last.toordinal() + 1):
+                bucket = self._buckets.get(day)
+                if bucket:
+                    found.extend(dict(entry, due_date=date.fromordinal(day)) for entry in bucket.values())
+        return found
+
+    def _read_shard(self, conn, path, after=0):
+        """Index the active records of one shard with ids above after; remembers the shard's highest id."""
+        # One read transaction, so the highest id and the rows come from the same snapshot
+        conn.execute("BEGIN")
+        highest = conn.execute("SELECT MAX(id) FROM bnpl_records").fetchone()[0] or 0
+        cursor = conn.execute("""
+            SELECT id, user_email, vendor, amount, installments, due_date
+            FROM bnpl_records WHERE status = 'active' AND id > ? AND id <= ?
+        """, (after, highest))
+        found = 0
+        for record_id, user_email, vendor, amount, installments, due_date in cursor:
+            self.add(record_id, user_email, {
+                "vendor": vendor, "amount": amount, "installments": installments, "due_date": due_date
+            })
+            found += 1
+        conn.rollback()
+        with self._lock:
+            self._seen[path] = max(self._seen.get(path, 0), highest)
+        return found
+
+    def seed(self, paths=None):
+        """
+        Rebuild from the active records of every shard. Returns the number indexed.
+        add/remove calls that arrive meanwhile (record listeners) still apply to the
+        current index and are replayed on the new one before it is swapped in, so a
+        change made during the scan is not lost until the next re-seed.
+        """
+        with self._lock:
+            self._pending = []
+        fresh = DueIndex()
+        fresh._today = self._today
+        try:
+            for path in paths or all_shard_paths():
+                if not os.path.exists(path):
+                    continue
+                conn = sqlite3.connect(path)
+                try:
+                    fresh._read_shard(conn, path)
+                finally:
+                    conn.close()
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            for record_id, user_email, record in self._pending:
+                if record is None:
+                    fresh.remove(record_id)
+                else:
+                    fresh.add(record_id, user_email, record)
+            self._pending = None
+            self._buckets, self._days, self._slot = fresh._buckets, fresh._days, fresh._slot
+            self._seen = fresh._seen
+        return len(self)
+
+    def catch_up(self, paths=None):
+        """
+        Index records inserted since the last seed or catch-up (ids only grow), for a
+        dispatcher running outside the web workers, where no record listener fires.
+        Paid or deleted records are filtered by the dispatcher's database check;
+        records set back to active are picked up by the next re-seed.
+        """
+        found = 0
+        for path in paths or all_shard_paths():
+            if not os.path.exists(path):
+                continue
+            conn = sqlite3.connect(path)
+            try:
+                found += self._read_shard(conn, path, self._seen.get(path, 0))
+            finally:
+                conn.close()
+        return found
+
+
+# --- Sinks -----------------------------------------------------------------
+# A sink is any object with send(batch); batch is a list of
+# {"user_email": ..., "reminders": [{record_id, vendor, amount, due_date, installment}]}
+
+class LogSink:
+    def send(self, batch):
+        for notification in batch:
+            items = ", ".join(
+                f"{r['vendor']} {r['amount']:.2f} on {r['due_date']}" for r in notification["reminders"]
+            )
+            print(f"[Reminders] {notification['user_email']}: {items}")
+
+
+class WebhookSink:
+    """POSTs each batch as JSON; without a URL the payload is only logged (stub)."""
+
+    def __init__(self, url=REMINDER_WEBHOOK_URL):
+        self.url = url
+
+    def send(self, batch):
+        if not self.url:
+            print(f"[Reminders] Webhook stub: would POST {len(batch)} notifications")
+            return
+        get_session().post(self.url, json={"notifications": batch}).raise_for_status()
+
+
+class EmailSink:
+    """Renders one email per user; delivery is stubbed out to the log."""
+
+    def render(self, notification):
+        lines = [f"- {r['vendor']}: {r['amount']:.2f} due {r['due_date']}" for r in notification["reminders"]]
+        return "Upcoming BNPL installments", "Hi,\n\nThese installments are due soon:\n" + "\n".join(lines)
+
+    def send(self, batch):
+        for notification in batch:
+            subject, _ = self.render(notification)
+            print(f"[Reminders] Email stub to {notification['user_email']}: {subject} "
+                  f"({len(notification['reminders'])} installments)")
+
+
+SINKS = {"log": LogSink, "webhook": WebhookSink, "email": EmailSink}
+
+
+class ReminderDispatcher:
+    """
+    Sends each installment's reminder once: entries due within lead_hours are checked
+    against the database (the index of this process can miss writes made elsewhere),
+    claimed in a shared TTL store so other workers skip them, grouped per user and
+    handed to the sink in batches.
+    """
+
+    def __init__(self, index, sink, lead_hours=REMINDER_LEAD_HOURS, claims=None):
+        self.index = index
+        self.sink = sink
+        self.lead_hours = lead_hours
+        self.claims = claims or create_store("reminders")
+        self.last_seeded = 0.0
+
+    def _still_active(self, entries):
+        by_shard = {}
+        for entry in entries:
+            by_shard.setdefault(get_shard_path(entry["user_email"]), []).append(entry["record_id"])
+        active = set()
+        for path, ids in by_shard.items():
+            conn = sqlite3.connect(path)
+            try:
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start + 500]
+                    placeholders = ", ".join("?" for _ in chunk)
+                    active.update(row[0] for row in conn.execute(
+                        f"SELECT id FROM bnpl_records WHERE status = 'active' AND id IN ({placeholders})", chunk
+                    ))
+            finally:
+                conn.close()
+        return [entry for entry in entries if entry["record_id"] in active]
+
+    def run_once(self, now=None):
+        """Dispatch reminders that are due; returns the number of installments reminded."""
+        now = now or datetime.now()
+        if time.time() - self.last_seeded > REMINDER_RESEED_HOURS * 3600:
+            self.index.seed()
+            self.last_seeded = time.time()
+        else:
+            self.index.catch_up()
+        self.index.advance(now.date())
+        entries = self.index.due_between(now.date(), (now + timedelta(hours=self.lead_hours)).date())
+        if not entries:
+            return 0
+
+        ttl = (self.lead_hours + 48) * 3600
+        notifications = {}
+        claimed = {}
+        for entry in self._still_active(entries):
+            key = f"{entry['record_id']}:{entry['due_date'].toordinal()}"
+            if not self.claims.add(key, 1, ttl):
+                continue
+            claimed.setdefault(entry["user_email"], []).append(key)
+            notifications.setdefault(entry["user_email"], []).append({
+                "record_id": entry["record_id"],
+                "vendor": entry["vendor"],
+                "amount": round(entry["amount"], 2),
+                "due_date": entry["due_date"].strftime("%d/%m/%Y"),
+                "installment": entry["installment"] + 1
+            })
+
+        batch = [{"user_email": email, "reminders": items} for email, items in notifications.items()]
+        sent = 0
+        for start in range(0, len(batch), REMINDER_BATCH_SIZE):
+            chunk = batch[start:start + REMINDER_BATCH_SIZE]
+            try:
+                self.sink.send(chunk)
+            except Exception as e:
+                # Release the claims so the next run (here or in another worker) retries them
+                for item in chunk:
+                    for key in claimed[item["user_email"]]:
+                        self.claims.take(key)
+                print(f"[Reminders] ERROR sending batch, will retry: {e}")
+                continue
+            sent += sum(len(item["reminders"]) for item in chunk)
+        return sent
+
+    def on_record_change(self, user_email, record_id, status):
+        """models record listener: keep the index current for writes made in this process"""
+        if status != "active":
+            self.index.remove(record_id)
+            return
+        from backend.models import get_bnpl_record_by_id
+        record = get_bnpl_record_by_id(record_id, user_email=user_email)
+        if record:
+            self.index.add(record_id, user_email, record)
+
+
+def run_dispatcher(dispatcher, interval_minutes):
+    """Dispatch every interval_minutes until the process exits."""
+    while True:
+        try:
+            dispatcher.run_once()
+        except Exception as e:
+            # Keep looping; the next run retries whatever was not claimed
+            print(f"[Reminders] ERROR dispatching: {e}")
+        time.sleep(interval_minutes * 60)
+
+
+def start_reminder_dispatcher(interval_minutes=REMINDER_INTERVAL_MINUTES, sink=REMINDER_SINK):
+    """
+    Run the dispatcher periodically on a daemon thread. No-op when interval_minutes is 0.
+    Every process that calls this holds its own all-user index, so only a single-process
+    app (RUN_BACKGROUND_JOBS=1) calls it; deployments run python -m backend.jobs instead.
+    """
+    global _dispatcher_started
+    if interval_minutes <= 0 or _dispatcher_started:
+        return None
+    _dispatcher_started = True
+
+    from backend.models import add_record_listener
+    dispatcher = ReminderDispatcher(DueIndex(), SINKS[sink]())
+    add_record_listener(dispatcher.on_record_change)
+
+    threading.Thread(target=run_dispatcher, args=(dispatcher, interval_minutes),
+                     name="bnpl-reminders", daemon=True).start()
+    print(f"[Reminders] Dispatching every {interval_minutes}min to the {sink} sink, {REMINDER_LEAD_HOURS}h ahead")
+    return dispatcher
+
+
+# --- Benchmark -------------------------------------------------------------
+# python -m backend.reminders bench [records]
+# Indexes synthetic records and compares "due in the next 72 hours" through the index
+# with a scan of every record, as calculate_upcoming_dues does per user.
+
+def benchmark(record_count=200000, seed=49):
+    import random
+    rng = random.Random(seed)
+    today = date.today()
+    records = []
+    for record_id in range(record_count):
+        due = today + timedelta(days=rng.randint(-60, 120))
+        records.append((record_id, f"user{record_id % (record_count // 5 or 1)}@example.com", {
+            "vendor": "Vendor", "amount": rng.uniform(500, 50000),
+            "installments": rng.choice([1, 3, 4, 6, 12]), "due_date": due.strftime("%d/%m/%Y")
+        }))
+
+    index = DueIndex()
+    start = time.perf_counter()
+    for record_id, email, record in records:
+        index.add(record_id, email, record)
+    build = time.perf_counter() - start
+
+    horizon = today + timedelta(hours=REMINDER_LEAD_HOURS)
+    start = time.perf_counter()
+    found = index.due_between(today, horizon)
+    lookup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scanned = 0
+    for _, _, record in records:
+        first_due = datetime.strptime(record["due_date"], "%d/%m/%Y").date()
+        upcoming = _next_installment(first_due, record["installments"], today)
+        if upcoming and upcoming[1] <= horizon:
+            scanned += 1
+    scan = time.perf_counter() - start
+
+    assert scanned == len(found), f"index found {len(found)}, scan found {scanned}"
+    print(f"[Reminders] {record_count} records indexed in {build:.2f}s; "
+          f"{len(found)} due within {REMINDER_LEAD_HOURS}h: index {lookup * 1000:.2f}ms vs scan {scan * 1000:.0f}ms")
+
+    start = time.perf_counter()
+    moved = index.advance(today + timedelta(days=1))
+    print(f"[Reminders] advancing one day re-armed {moved} entries in {(time.perf_counter() - start) * 1000:.2f}ms")
+
+
+def selftest():
+    """
+    Seed an index on a scratch database while records change underneath it: a record
+    paid and one inserted during the scan are reflected once the new index is swapped
+    in. Then catch_up() picks up an insert made without a listener (another process).
+    """
+    import tempfile
+    from backend import models
+
+    user_email = "selftest@example.com"
+    due = (date.today() + timedelta(days=1)).strftime("%d/%m/%Y")
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            os.makedirs(os.path.dirname(models.DB_PATH))
+            models.init_db()
+            def insert(message_id, vendor, amount, installments):
+                assert models.insert_bnpl_record(user_email, message_id, vendor, amount, installments, due, "Due")
+                return next(r["id"] for r in models.get_bnpl_records(user_email) if r["gmail_message_id"] == message_id)
+
+            def due_ids():
+                return {entry["record_id"] for entry in index.due_between(date.today(), date.today() + timedelta(days=1))}
+
+            paid_id = insert("msg-paid", "Simpl", 900.0, 3)
+            insert("msg-kept", "LazyPay", 1200.0, 3)
+
+            index = DueIndex()
+            dispatcher = ReminderDispatcher(index, LogSink(), claims=object())
+            models.add_record_listener(dispatcher.on_record_change)
+            index.seed()
+            assert len(index) == 2, len(index)
+
+            added = {}
+
+            def shards_changing_midway():
+                # Yield each shard, then write through the listener once the scan has read it
+                for path in all_shard_paths():
+                    yield path
+                if not added:
+                    models.update_bnpl_status(paid_id, "paid", user_email=user_email)
+                    added["id"] = insert("msg-during", "ZestMoney", 3000.0, 6)
+
+            index.seed(shards_changing_midway())
+            ids = due_ids()
+            assert paid_id not in ids, "record paid during the seed is still indexed"
+            assert added["id"] in ids, "record inserted during the seed is missing"
+            assert index._pending is None
+            print(f"[Reminders] Seed with concurrent writes: {len(index)} indexed, paid and inserted records applied")
+
+            models._record_listeners.remove(dispatcher.on_record_change)
+            other_id = insert("msg-other", "Uni", 600.0, 1)
+            assert other_id not in due_ids()
+            # msg-during too: it was inserted after the seed read the shard's highest id
+            assert index.catch_up() == 2
+            assert index.catch_up() == 0
+            assert other_id in due_ids()
+            print("[Reminders] catch_up indexed the record inserted without a listener")
+        finally:
+            os.chdir(cwd)
+    print("[Reminders] Selftest passed")
+
+
+if __name__ == "__main__":
+    # Usage: python -m backend.reminders run | serve [minutes] | upcoming [hours] | bench [records] | selftest
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "run":
+        dispatcher = ReminderDispatcher(DueIndex(), SINKS[REMINDER_SINK]())
+        print(f"[Reminders] Reminded {dispatcher.run_once()} installments")
+    elif command == "serve":
+        # The one dispatcher for a deployment, outside the web workers
+        minutes = float(sys.argv[2]) if len(sys.argv) > 2 else (REMINDER_INTERVAL_MINUTES or 15)
+        print(f"[Reminders] Dispatching every {minutes}min to the {REMINDER_SINK} sink, {REMINDER_LEAD_HOURS}h ahead")
+        run_dispatcher(ReminderDispatcher(DueIndex(), SINKS[REMINDER_SINK]()), minutes)
+    elif command == "upcoming":
+        hours = int(sys.argv[2]) if len(sys.argv) > 2 else REMINDER_LEAD_HOURS
+        index = DueIndex()
+        index.seed()
+        now = datetime.now()
+        for entry in index.due_between(now.date(), (now + timedelta(hours=hours)).date()):
+            print(f"{entry['due_date']} {entry['user_email']} {entry['vendor']} {entry['amount']:.2f}")
+    elif command == "bench":
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 200000)
+    elif command == "selftest":
+        selftest()
+    else:
+        print("Usage: python -m backend.reminders run | serve [minutes] | upcoming [hours] | bench [records] | selftest")
@@ -0,0 +1,303 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+from datetime import datetime, timedelta
+import numpy as np
+from backend.finance import calculate_analysis
+from backend.sharding import all_shard_paths
+
+# Salary assumed for users without a profile (or with salary 0), as on the dashboard
+DEFAULT_SALARY = 30000
+
+RISK_LEVELS = ("Low", "Medium", "High")
+
+LOAD_CHUNK_SIZE = 50000
+
+
+class Portfolio:
+    """
+    BNPL records of many users as columns. Record i belongs to user users[i];
+    within a user, records are in the order calculate_analysis reads them.
+    Missing amounts and installments are NaN, a missing due date is ordinal 0.
+    """
+
+    def __init__(self, emails, salaries, users, amount, installments, due_ordinal, active):
+        self.emails = emails
+        self.salaries = salaries
+        self.salary = np.asarray(salaries, dtype=np.float64)
+        self.users = np.asarray(users, dtype=np.int64)
+        self.amount = np.asarray(amount, dtype=np.float64)
+        self.installments = np.asarray(installments, dtype=np.float64)
+        self.due_ordinal = np.asarray(due_ordinal, dtype=np.int64)
+        self.active = np.asarray(active, dtype=bool)
+
+    def __len__(self):
+        return len(self.emails)
+
+
+def load_portfolio(status_filter="active", paths=None, chunk_size=LOAD_CHUNK_SIZE):
+    """
+    Portfolio of every user on every shard. With status_filter='active' (the dashboard's
+    view) only active records are loaded; with None paid and archived records are loaded
+    too and only count towards record_count.
+    """
+    emails = []
+    salaries = []
+    index = {}
+    columns = {"users": [], "amount": [], "installments": [], "due_ordinal": [], "active": []}
+
+    def user_index(email):
+        i = index.get(email)
+        if i is None:
+            i = index[email] = len(emails)
+            emails.append(email)
+            salaries.append(DEFAULT_SALARY)
+        return i
+
+    tables = ["bnpl_records"]
+    if status_filter is None:
+        tables.append("bnpl_archive")
+
+    for path in paths or all_shard_paths():
+        if not os.path.exists(path):
+            continue
+        conn = sqlite3.connect(path)
+        try:
+            for email, salary in conn.execute("SELECT email, salary FROM users"):
+                salaries[user_index(email)] = salary or DEFAULT_SALARY
+
+            for table in tables:
+                active = "status = 'active'" if table == "bnpl_records" else "0"
+                sql = f"SELECT user_email, amount, installments, due_ordinal, {active} FROM {table}"
+                if table == "bnpl_records" and status_filter:
+                    sql += " WHERE status = ?"
+                    params = (status_filter,)
+                else:
+                    params = ()
+                # Newest first within a user, as get_bnpl_records returns them; the
+                # (user_email, created_at, id) index serves this order without a sort
+                cursor = conn.execute(sql + " ORDER BY user_email DESC, created_at DESC, id DESC", params)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    record_emails, amount, installments, due, flags = zip(*rows)
+                    columns["users"].append(np.fromiter(map(user_index, record_emails), np.int64, len(rows)))
+                    columns["amount"].append(np.array(amount, dtype=np.float64))
+                    columns["installments"].append(np.array(installments, dtype=np.float64))
+                    columns["due_ordinal"].append(np.nan_to_num(np.array(due, dtype=np.float64)).astype(np.int64))
+                    columns["active"].append(np.array(flags, dtype=bool))
+        finally:
+            conn.close()
+
+    arrays = {
+        name: np.concatenate(parts) if parts else np.empty(0)
+        for name, parts in columns.items()
+    }
+    return Portfolio(emails, salaries, **arrays)
+
+
+def upcoming_window(now=None):
+    """
+    (first, last) due ordinals counted as upcoming. calculate_analysis compares a
+    midnight due date with now <= due <= now + 30 days, so today only counts at
+    exactly midnight.
+    """
+    now = now or datetime.now()
+    first = now.toordinal()
+    if now != datetime(now.year, now.month, now.day):
+        first += 1
+    return first, (now + timedelta(days=30)).toordinal()
+
+
+def risk_scores(debt_ratio):
+    """Vectorized risk_from_debt_ratio: (scores, level indexes into RISK_LEVELS)"""
+    low = debt_ratio < 0.2
+    medium = ~low & (debt_ratio < 0.4)
+    # int() truncates towards zero, as np.trunc does
+    scores = np.where(
+        low, np.trunc(debt_ratio * 100),
+        np.where(medium, 20 + np.trunc((debt_ratio - 0.2) * 150),
+                 np.minimum(50 + np.trunc((debt_ratio - 0.4) * 100), 100))
+    )
+    levels = np.where(low, 0, np.where(medium, 1, 2))
+    return scores.astype(np.int64), levels
+
+
+def score_portfolio(portfolio, now=None):
+    """
+    calculate_analysis for every user at once, as a dict of per-user arrays.
+    Sums are grouped with bincount, which adds in record order, so every float
+    matches the per-user Python loop exactly.
+    """
+    first_due, last_due = upcoming_window(now)
+    n = len(portfolio)
+    users = portfolio.users
+    amount = portfolio.amount
+    installments = portfolio.installments
+
+    # Same truthiness tests as summarize_records: NULL and 0 amounts are skipped
+    counted = portfolio.active & (amount != 0) & ~np.isnan(amount)
+    per_month = counted & (installments > 0)
+    monthly = np.zeros(len(amount))
+    np.divide(amount, installments, out=monthly, where=per_month)
+    due = portfolio.due_ordinal
+    upcoming = per_month & (due >= first_due) & (due <= last_due)
+
+    def group_sum(mask, values):
+        return np.bincount(users[mask], weights=values[mask], minlength=n)
+
+    monthly_obligation = group_sum(per_month, monthly)
+    salary = portfolio.salary
+    debt_ratio = np.zeros(n)
+    np.divide(monthly_obligation, salary, out=debt_ratio, where=salary > 0)
+    scores, levels = risk_scores(debt_ratio)
+
+    return {
+        "record_count": np.bincount(users, minlength=n),
+        "active_count": np.bincount(users[portfolio.active], minlength=n),
+        "total_outstanding": group_sum(counted, amount),
+        "monthly_obligation": monthly_obligation,
+        "upcoming_dues": group_sum(upcoming, monthly),
+        "debt_ratio": debt_ratio,
+        "risk_score": scores,
+        "risk_level": levels,
+    }
+
+
+def iter_analyses(portfolio, scores):
+    """(email, calculate_analysis-shaped dict) per user"""
+    columns = [scores[name].tolist() for name in (
+        "record_count", "active_count", "total_outstanding", "monthly_obligation",
+        "upcoming_dues", "debt_ratio", "risk_score", "risk_level"
+    )]
+    for email, salary, row in zip(portfolio.emails, portfolio.salaries, zip(*columns)):
+        record_count, active_count, outstanding, monthly, upcoming, ratio, score, level = row
+        if not record_count:
+            yield email, {
+                "total_outstanding": 0,
+                "monthly_obligation": 0,
+                "upcoming_dues": 0,
+                "debt_ratio": 0,
+                "risk_score": 0,
+                "risk_level": "None",
+                "transaction_count": 0
+            }
+            continue
+        yield email, {
+            "total_outstanding": round(outstanding, 2),
+            "monthly_obligation": round(monthly, 2),
+            "upcoming_dues": round(upcoming, 2),
+            "debt_ratio": round(ratio, 4),
+            "risk_score": score,
+            "risk_level": RISK_LEVELS[level],
+            "transaction_count": active_count,
+            "salary": salary
+        }
+
+
+def portfolio_report(portfolio, scores, top=20):
+    """Nightly risk report: totals, users per risk level and the riskiest users"""
+    has_records = scores["record_count"] > 0
+    levels = {"None": int((~has_records).sum())}
+    for i, level in enumerate(RISK_LEVELS):
+        levels[level] = int((has_records & (scores["risk_level"] == i)).sum())
+
+    # Highest score first, ties broken by the larger debt ratio
+    order = np.lexsort((-scores["debt_ratio"], -scores["risk_score"]))[:top]
+    return {
+        "users": len(portfolio),
+        "records": int(scores["record_count"].sum()),
+        "total_outstanding": round(float(scores["total_outstanding"].sum()), 2),
+        "monthly_obligation": round(float(scores["monthly_obligation"].sum()), 2),
+        "upcoming_dues": round(float(scores["upcoming_dues"].sum()), 2),
+        "risk_levels": levels,
+        "riskiest": [
+            {
+                "email": portfolio.emails[i],
+                "risk_score": int(scores["risk_score"][i]),
+                "debt_ratio": round(float(scores["debt_ratio"][i]), 4),
+                "monthly_obligation": round(float(scores["monthly_obligation"][i]), 2)
+            }
+            for i in order if has_records[i]
+        ]
+    }
+
+
+# --- Benchmark -------------------------------------------------------------
+# python -m backend.risk_engine bench [users]
+# Builds a synthetic portfolio (0-10 records per user, with NULL amounts, zero
+# installments and unparseable due dates mixed in), scores it per user with
+# calculate_analysis and in one batch, and checks that every result is identical.
+
+def _synthetic_portfolio(user_count, seed=44):
+    rng = np.random.default_rng(seed)
+    today = datetime.now().toordinal()
+    counts = rng.integers(0, 11, user_count)
+    total = int(counts.sum())
+    users = np.repeat(np.arange(user_count), counts)
+
+    amount = np.round(rng.uniform(100, 60000, total), 2)
+    amount[rng.random(total) < 0.02] = np.nan
+    amount[rng.random(total) < 0.02] = 0
+    installments = rng.choice([0, 1, 3, 4, 6, 9, 12, 24], total).astype(np.float64)
+    installments[rng.random(total) < 0.02] = np.nan
+    due = today + rng.integers(-60, 90, total)
+    due[rng.random(total) < 0.05] = 0
+    active = rng.random(total) < 0.8
+    salaries = [float(s) for s in np.round(rng.uniform(-1000, 200000, user_count), 2)]
+    emails = [f"user{i}@example.com" for i in range(user_count)]
+    portfolio = Portfolio(emails, salaries, users, amount, installments, due, active)
+
+    def value(x):
+        return None if np.isnan(x) else x
+
+    records = [[] for _ in range(user_count)]
+    for user, a, n, d, is_active in zip(users.tolist(), amount.tolist(), installments.tolist(),
+                                        due.tolist(), active.tolist()):
+        records[user].append({
+            "amount": value(a),
+            "installments": None if np.isnan(n) else int(n),
+            "due_date": datetime.fromordinal(d).strftime("%d/%m/%Y") if d else "not a date",
+            "status": "active" if is_active else "paid"
+        })
+    return portfolio, records
+
+
+def benchmark(user_count=100000):
+    portfolio, records = _synthetic_portfolio(user_count)
+    record_count = len(portfolio.users)
+
+    start = time.perf_counter()
+    expected = [calculate_analysis(salary, user_records)
+                for salary, user_records in zip(portfolio.salaries, records)]
+    per_user = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scores = score_portfolio(portfolio)
+    vectorized = time.perf_counter() - start
+    analyses = [analysis for _, analysis in iter_analyses(portfolio, scores)]
+    with_dicts = time.perf_counter() - start
+
+    mismatches = sum(a != b for a, b in zip(expected, analyses))
+    print(f"[RiskEngine] {user_count} users, {record_count} records")
+    print(f"[RiskEngine] calculate_analysis per user: {per_user:.2f}s")
+    print(f"[RiskEngine] batch arrays: {vectorized * 1000:.1f}ms ({per_user / vectorized:.0f}x), "
+          f"with result dicts: {with_dicts * 1000:.1f}ms ({per_user / with_dicts:.0f}x)")
+    print(f"[RiskEngine] mismatching users: {mismatches}")
+    assert mismatches == 0
+    return per_user, vectorized
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "report":
+        portfolio = load_portfolio()
+        top = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+        print(json.dumps(portfolio_report(portfolio, score_portfolio(portfolio), top), indent=2))
+    elif command == "bench":
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
+    else:
+        print("Usage: python -m backend.risk_engine report [top] | bench [users]")
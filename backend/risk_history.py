@@ -0,0 +1,266 @@
+import os
+import time
+from datetime import date, datetime
+from backend.finance import risk_from_debt_ratio, month_key, format_month
+from backend.sharding import get_connection
+
+# Raw change points are kept this long; older history is served from the rollups
+RAW_RETENTION_DAYS = int(os.getenv("RISK_HISTORY_RAW_DAYS", "90"))
+DAILY_RETENTION_DAYS = int(os.getenv("RISK_HISTORY_DAILY_DAYS", "730"))
+
+# Rollup resolutions as stored in risk_rollups.resolution; weekly and monthly are kept forever
+RESOLUTIONS = {"day": 0, "week": 1, "month": 2}
+
+MAX_HISTORY_POINTS = 1000
+
+# Salary assumed for users without a row, as in get_user_salary
+DEFAULT_SALARY = 30000
+
+
+def init_history_tables(cursor):
+    """
+    risk_history holds one row per change of a user's metrics (unchanged writes add
+    nothing); risk_rollups holds min/max/last per day, week and month. Both are
+    clustered on (user_email, ...) so a range read is one index walk.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS risk_history (
+            user_email TEXT,
+            ts INTEGER,
+            risk_score INTEGER,
+            debt_ratio REAL,
+            monthly_obligation REAL,
+            PRIMARY KEY (user_email, ts)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS risk_rollups (
+            user_email TEXT,
+            resolution INTEGER,
+            bucket INTEGER,
+            min_score INTEGER,
+            max_score INTEGER,
+            risk_score INTEGER,
+            max_debt_ratio REAL,
+            debt_ratio REAL,
+            monthly_obligation REAL,
+            samples INTEGER,
+            PRIMARY KEY (user_email, resolution, bucket)
+        ) WITHOUT ROWID
+    """)
+
+
+def monthly_installment(amount, installments):
+    """A record's share of monthly_obligation, with the truthiness tests of summarize_records"""
+    if amount and installments and installments > 0:
+        return amount / installments
+    return 0
+
+
+def current_metrics(cursor, user_email, obligation_delta=None):
+    """
+    (risk_score, debt_ratio, monthly_obligation) of the user's active records.
+    With obligation_delta the obligation is the last stored point plus the change the
+    caller just made, so a write reads two rows instead of every active record.
+    Without it (or without a stored point) the records are summed in the order
+    summarize_records sees them so the values match /api/risk-score.
+    The obligation is returned unrounded to keep the running sum exact.
+    """
+    row = cursor.execute("SELECT salary FROM users WHERE email = ?", (user_email,)).fetchone()
+    # The stored salary as /api/risk-score reads it (get_user_salary): 0 stays 0
+    salary = row[0] if row else DEFAULT_SALARY
+    last = None
+    if obligation_delta is not None:
+        last = cursor.execute("""
+            SELECT monthly_obligation FROM risk_history
+            WHERE user_email = ? ORDER BY ts DESC LIMIT 1
+        """, (user_email,)).fetchone()
+    if last:
+        monthly_obligation = last[0] + obligation_delta
+    else:
+        monthly_obligation = 0
+        for amount, installments in cursor.execute("""
+            SELECT amount, installments FROM bnpl_records
+            WHERE user_email = ? AND status = 'active'
+            ORDER BY created_at DESC, id DESC
+        """, (user_email,)):
+            monthly_obligation += monthly_installment(amount, installments)
+    debt_ratio = (monthly_obligation / salary) if salary and salary > 0 else 0
+    risk_score, _ = risk_from_debt_ratio(debt_ratio)
+    return risk_score, round(debt_ratio, 4), monthly_obligation
+
+
+def bucket_of(resolution, day):
+    """Rollup bucket of a date: day ordinal, ordinal of the week's Monday, or month key"""
+    if resolution == RESOLUTIONS["day"]:
+        return day.toordinal()
+    if resolution == RESOLUTIONS["week"]:
+        return day.toordinal() - day.weekday()
+    return month_key(day)
+
+
+def bucket_label(resolution, bucket):
+    if resolution == RESOLUTIONS["month"]:
+        return format_month(bucket)
+    return date.fromordinal(bucket).isoformat()
+
+
+def record_snapshot(cursor, user_email, obligation_delta=None, ts=None):
+    """
+    Append the user's current metrics if they differ from the last point and fold them
+    into the rollups. Call inside the transaction that changed the data, passing the
+    change in monthly obligation when the caller knows it (see current_metrics).
+    Returns True when a point was written.
+    """
+    metrics = current_metrics(cursor, user_email, obligation_delta)
+    return _append_point(cursor, user_email, metrics, ts)
+
+
+def _append_point(cursor, user_email, metrics, ts=None):
+    risk_score, debt_ratio, monthly_obligation = metrics
+    last = cursor.execute("""
+        SELECT risk_score, debt_ratio, monthly_obligation FROM risk_history
+        WHERE user_email = ? ORDER BY ts DESC LIMIT 1
+    """, (user_email,)).fetchone()
+    if last and last[:2] == (risk_score, debt_ratio) and round(last[2], 2) == round(monthly_obligation, 2):
+        return False
+
+    ts = int(ts if ts is not None else time.time())
+    # Several changes within one second keep the last one
+    cursor.execute(
+        "INSERT OR REPLACE INTO risk_history (user_email, ts, risk_score, debt_ratio, monthly_obligation) VALUES (?, ?, ?, ?, ?)",
+        (user_email, ts, risk_score, debt_ratio, monthly_obligation)
+    )
+    monthly_obligation = round(monthly_obligation, 2)
+    day = datetime.fromtimestamp(ts).date()
+    cursor.executemany("""
+        INSERT INTO risk_rollups (user_email, resolution, bucket, min_score, max_score, risk_score,
+                                  max_debt_ratio, debt_ratio, monthly_obligation, samples)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+        ON CONFLICT(user_email, resolution, bucket) DO UPDATE SET
+            min_score = MIN(min_score, excluded.min_score),
+            max_score = MAX(max_score, excluded.max_score),
+            risk_score = excluded.risk_score,
+            max_debt_ratio = MAX(max_debt_ratio, excluded.max_debt_ratio),
+            debt_ratio = excluded.debt_ratio,
+            monthly_obligation = excluded.monthly_obligation,
+            samples = samples + 1
+    """, [
+        (user_email, resolution, bucket_of(resolution, day), risk_score, risk_score, risk_score,
+         debt_ratio, debt_ratio, monthly_obligation)
+        for resolution in RESOLUTIONS.values()
+    ])
+    return True
+
+
+def backfill_history(cursor):
+    """Seed one point per user on a shard that has no history yet (first start after upgrading)."""
+    if cursor.execute("SELECT 1 FROM risk_history LIMIT 1").fetchone():
+        return 0
+    emails = [row[0] for row in cursor.execute(
+        "SELECT user_email FROM bnpl_records UNION SELECT email FROM users"
+    ).fetchall() if row[0]]
+    return sum(record_snapshot(cursor, email) for email in emails)
+
+
+def rebase_history(cursor):
+    """
+    Re-base every user's running obligation on a rescan of their active records, so a
+    drift in the per-write deltas does not outlive the next compaction. A user whose
+    stored metrics are off gets a corrected point; otherwise the latest point's unrounded
+    obligation is replaced with the rescanned sum. Returns the users corrected.
+    """
+    emails = [row[0] for row in cursor.execute("SELECT DISTINCT user_email FROM risk_history").fetchall()]
+    corrected = 0
+    for email in emails:
+        metrics = current_metrics(cursor, email)
+        if _append_point(cursor, email, metrics):
+            corrected += 1
+            continue
+        cursor.execute("""
+            UPDATE risk_history SET monthly_obligation = ?
+            WHERE user_email = ? AND ts = (SELECT MAX(ts) FROM risk_history WHERE user_email = ?)
+        """, (metrics[2], email, email))
+    return corrected
+
+
+def prune_history(cursor, now=None):
+    """
+    Drop raw points and daily rollups past their retention. Returns the rows removed.
+    Each user's latest point is kept: writes apply their change on top of it.
+    """
+    now = now or time.time()
+    removed = cursor.execute("""
+        DELETE FROM risk_history
+        WHERE ts < ? AND ts < (SELECT MAX(ts) FROM risk_history h WHERE h.user_email = risk_history.user_email)
+    """, (int(now - RAW_RETENTION_DAYS * 86400),)).rowcount
+    oldest_day = datetime.fromtimestamp(now).date().toordinal() - DAILY_RETENTION_DAYS
+    removed += cursor.execute(
+        "DELETE FROM risk_rollups WHERE resolution = ? AND bucket < ?", (RESOLUTIONS["day"], oldest_day)
+    ).rowcount
+    return removed
+
+
+def get_risk_history(user_email, resolution, first_day, last_day):
+    """
+    Stored history between two dates, nothing recomputed.
+    'raw' returns every change point. Rollup resolutions return one point per bucket;
+    buckets without changes carry the previous value forward with samples 0.
+    """
+    conn = get_connection(user_email)
+    try:
+        if resolution == "raw":
+            start = int(datetime.combine(first_day, datetime.min.time()).timestamp())
+            end = int(datetime.combine(last_day, datetime.max.time()).timestamp())
+            rows = conn.execute("""
+                SELECT ts, risk_score, debt_ratio, monthly_obligation FROM risk_history
+                WHERE user_email = ? AND ts BETWEEN ? AND ? ORDER BY ts LIMIT ?
+            """, (user_email, start, end, MAX_HISTORY_POINTS)).fetchall()
+            return [
+                {"time": datetime.fromtimestamp(ts).isoformat(timespec="seconds"), "risk_score": score,
+                 "debt_ratio": ratio, "monthly_obligation": round(obligation, 2)}
+                for ts, score, ratio, obligation in rows
+            ]
+
+        code = RESOLUTIONS[resolution]
+        first, last = bucket_of(code, first_day), bucket_of(code, last_day)
+        columns = "bucket, min_score, max_score, risk_score, max_debt_ratio, debt_ratio, monthly_obligation, samples"
+        rows = conn.execute(f"""
+            SELECT {columns} FROM risk_rollups
+            WHERE user_email = ? AND resolution = ? AND bucket BETWEEN ? AND ? ORDER BY bucket
+        """, (user_email, code, first, last)).fetchall()
+        previous = conn.execute(f"""
+            SELECT {columns} FROM risk_rollups
+            WHERE user_email = ? AND resolution = ? AND bucket < ? ORDER BY bucket DESC LIMIT 1
+        """, (user_email, code, first)).fetchone()
+    finally:
+        conn.close()
+
+    found = {row[0]: row for row in rows}
+    step = 7 if code == RESOLUTIONS["week"] else 1
+    points = []
+    for bucket in range(first, last + 1, step):
+        row = found.get(bucket)
+        if row:
+            previous = row
+            _, min_score, max_score, score, max_ratio, ratio, obligation, samples = row
+        elif previous:
+            score, ratio, obligation = previous[3], previous[5], previous[6]
+            min_score = max_score = score
+            max_ratio = ratio
+            samples = 0
+        else:
+            continue
+        points.append({
+            "period": bucket_label(code, bucket),
+            "risk_score": score,
+            "min_score": min_score,
+            "max_score": max_score,
+            "debt_ratio": ratio,
+            "max_debt_ratio": max_ratio,
+            "monthly_obligation": obligation,
+            "samples": samples
+        })
+        if len(points) >= MAX_HISTORY_POINTS:
+            break
+    return points
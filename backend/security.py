@@ -0,0 +1,386 @@
+import os
+import sys
+import json
+import math
+import time
+import base64
+import sqlite3
+import hashlib
+import secrets
+import threading
+from datetime import datetime
+from functools import wraps
+import jwt
+from flask import request, jsonify
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from google.oauth2.credentials import Credentials
+from backend.cache import LRUCache
+
+VAULT_PATH = os.getenv("CREDENTIAL_VAULT_PATH", "database/credential_vault.db")
+
+# Lifetime of the slim bearer tokens handed to the frontend
+TOKEN_TTL_DAYS = 30
+
+# Decrypted credentials kept in process, keyed by handle
+_credential_cache = LRUCache(
+    maxsize=int(os.getenv("CREDENTIAL_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("CREDENTIAL_CACHE_TTL", "300"))
+)
+
+_fernet = None
+
+# Rate limiting: "sqlite" holds buckets across gunicorn workers, "memory" per process
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "sqlite")
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", "database/rate_limits.db")
+RATE_LIMITS_ENABLED = os.getenv("RATE_LIMITS_ENABLED", "1") != "0"
+
+# Reverse proxies in front of the app that append to X-Forwarded-For (0 = use the socket address)
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+
+# Buckets idle this long are full again and can be dropped
+BUCKET_IDLE_SECONDS = 24 * 3600
+
+# How long a check waits for another worker's bucket write. SQLite's busy wait blocks
+# the whole gevent worker, so it is kept short; a check that times out fails open.
+RATE_LIMIT_BUSY_TIMEOUT = float(os.getenv("RATE_LIMIT_BUSY_TIMEOUT", "0.1"))
+
+
+def _secret_key():
+    # Same fallback as app.secret_key, so tokens minted before the vault keep verifying
+    return os.getenv("SECRET_KEY", "default-secret-key-change-in-production")
+
+
+def _get_fernet():
+    """
+    CREDENTIAL_VAULT_KEYS: comma-separated Fernet keys, newest first (older keys still
+    decrypt, so keys can be rotated). Without it a key is derived from SECRET_KEY so
+    every worker agrees on it.
+    """
+    global _fernet
+    if _fernet is None:
+        keys = [k.strip() for k in os.getenv("CREDENTIAL_VAULT_KEYS", "").split(",") if k.strip()]
+        if not keys:
+            keys = [base64.urlsafe_b64encode(hashlib.sha256(_secret_key().encode("utf-8")).digest())]
+        _fernet = MultiFernet([Fernet(key) for key in keys])
+    return _fernet
+
+
+def _connect():
+    conn = sqlite3.connect(VAULT_PATH, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS credential_vault (
+            handle TEXT PRIMARY KEY,
+            user_email TEXT NOT NULL,
+            ciphertext BLOB NOT NULL,
+            created_at REAL,
+            updated_at REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vault_user ON credential_vault(user_email)")
+    return conn
+
+
+def credentials_to_dict(credentials):
+    return {
+        "token": credentials.token,
+        "refresh_token": credentials.refresh_token,
+        "token_uri": credentials.token_uri,
+        "client_id": credentials.client_id,
+        "client_secret": credentials.client_secret,
+        "scopes": list(credentials.scopes) if credentials.scopes else [],
+        "expiry": credentials.expiry.isoformat() if credentials.expiry else None
+    }
+
+
+def credentials_from_dict(data, credentials_class=Credentials):
+    # Without an expiry google-auth only refreshes after the API has answered 401
+    expiry = data.get("expiry")
+    return credentials_class(
+        token=data.get("token"),
+        refresh_token=data.get("refresh_token"),
+        token_uri=data.get("token_uri"),
+        client_id=data.get("client_id"),
+        client_secret=data.get("client_secret"),
+        scopes=data.get("scopes") or [],
+        expiry=datetime.fromisoformat(expiry) if expiry else None
+    )
+
+
+class VaultCredentials(Credentials):
+    """
+    Credentials loaded from the vault. A refreshed access token is written back under
+    the same handle, so other workers, and this one once its cache entry expires,
+    reuse it instead of refreshing again.
+    """
+    vault_handle = None
+    vault_owner = None
+
+    def refresh(self, request):
+        super().refresh(request)
+        if not self.vault_handle:
+            return
+        try:
+            store_credentials(self.vault_owner, credentials_to_dict(self), handle=self.vault_handle)
+        except sqlite3.Error as e:
+            print(f"[Vault] ERROR saving refreshed credentials for handle {self.vault_handle[:6]}...: {e}")
+            return
+        _credential_cache.set(self.vault_handle, (self.vault_owner, self))
+
+
+def store_credentials(user_email, credentials_data, handle=None):
+    """
+    Encrypt and store OAuth credentials (dict form) for a user.
+    Returns the opaque handle that tokens and sessions carry instead of the secrets;
+    passing an existing handle overwrites it (e.g. after an access-token refresh).
+    """
+    handle = handle or secrets.token_urlsafe(18)
+    ciphertext = _get_fernet().encrypt(json.dumps(credentials_data).encode("utf-8"))
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("""
+            INSERT INTO credential_vault (handle, user_email, ciphertext, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(handle) DO UPDATE SET ciphertext = excluded.ciphertext, updated_at = excluded.updated_at
+            WHERE credential_vault.user_email = excluded.user_email
+        """, (handle, user_email, ciphertext, now, now))
+        conn.commit()
+    finally:
+        conn.close()
+    _credential_cache.pop(handle)
+    return handle
+
+
+def load_credentials(handle, user_email):
+    """
+    Credentials for a handle, or None when it is unknown, revoked, belongs to another
+    user or cannot be decrypted. Decrypted credentials are cached per handle.
+    """
+    if not handle:
+        return None
+    cached = _credential_cache.get(handle)
+    if cached is not None:
+        owner, credentials = cached
+        return credentials if owner == user_email else None
+
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT user_email, ciphertext FROM credential_vault WHERE handle = ?", (handle,)
+        ).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+
+    try:
+        data = json.loads(_get_fernet().decrypt(row[1]))
+    except InvalidToken:
+        print(f"[Vault] Could not decrypt credentials for handle {handle[:6]}...")
+        return None
+    credentials = credentials_from_dict(data, VaultCredentials)
+    credentials.vault_handle, credentials.vault_owner = handle, row[0]
+    _credential_cache.set(handle, (row[0], credentials))
+    return credentials if row[0] == user_email else None
+
+
+def revoke_credentials(handle):
+    """Delete a handle's credentials (logout). Returns True if it existed."""
+    if not handle:
+        return False
+    _credential_cache.pop(handle)
+    conn = _connect()
+    try:
+        deleted = conn.execute("DELETE FROM credential_vault WHERE handle = ?", (handle,)).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    return bool(deleted)
+
+
+def issue_token(user_email, handle, ttl_days=TOKEN_TTL_DAYS):
+    """Slim bearer token: the user id and the credential handle, nothing secret."""
+    return jwt.encode({
+        "email": user_email,
+        "cid": handle,
+        "exp": int(time.time()) + ttl_days * 86400
+    }, _secret_key(), algorithm="HS256")
+
+
+def decode_token(token):
+    """Verified token payload, or None for invalid or expired tokens"""
+    try:
+        return jwt.decode(token, _secret_key(), algorithms=["HS256"])
+    except jwt.InvalidTokenError:
+        return None
+
+
+
+def _refill(tokens, updated_at, now, capacity, refill_seconds):
+    """Tokens in a bucket at now; it refills capacity tokens per refill_seconds"""
+    return min(capacity, tokens + (now - updated_at) * capacity / refill_seconds)
+
+
+class MemoryRateLimiter:
+    """Token buckets in a bounded per-process LRU."""
+
+    def __init__(self, maxsize=100000):
+        self._buckets = LRUCache(maxsize=maxsize, ttl=BUCKET_IDLE_SECONDS)
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, refill_seconds, cost=1):
+        """Take cost tokens; returns 0 when allowed, else seconds until enough tokens refill."""
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            tokens = capacity if bucket is None else _refill(bucket[0], bucket[1], now, capacity, refill_seconds)
+            if tokens >= cost:
+                self._buckets.set(key, (tokens - cost, now))
+                return 0
+            self._buckets.set(key, (tokens, now))
+        return (cost - tokens) * refill_seconds / capacity
+
+
+class SQLiteRateLimiter:
+    """
+    Token buckets in one SQLite file shared by every worker. Each process keeps one
+    connection behind a lock (per-thread connections would mean one per greenlet under
+    gevent), and the bucket table is not fsynced (losing it on a crash only resets
+    limits), so a check is a single short write transaction.
+    """
+
+    def __init__(self, path=RATE_LIMIT_PATH, busy_timeout=RATE_LIMIT_BUSY_TIMEOUT):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._checks = 0
+        with self._lock:
+            self._connection().execute("""
+                CREATE TABLE IF NOT EXISTS rate_buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL,
+                    updated_at REAL
+                ) WITHOUT ROWID
+            """)
+
+    def _connection(self):
+        # Reopened after a fork: gunicorn workers must not share the master's connection
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def consume(self, key, capacity, refill_seconds, cost=1):
+        """Take cost tokens; returns 0 when allowed, else seconds until enough tokens refill."""
+        with self._lock:
+            conn = self._connection()
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT tokens, updated_at FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+                tokens = capacity if row is None else _refill(row[0], row[1], now, capacity, refill_seconds)
+                allowed = tokens >= cost
+                if allowed:
+                    tokens -= cost
+                conn.execute(
+                    "INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                    (key, tokens, now)
+                )
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+
+            self._checks += 1
+            if self._checks % 1000 == 0:
+                conn.execute("DELETE FROM rate_buckets WHERE updated_at < ?", (now - BUCKET_IDLE_SECONDS,))
+        return 0 if allowed else (cost - tokens) * refill_seconds / capacity
+
+
+_limiter = None
+
+
+def get_rate_limiter():
+    global _limiter
+    if _limiter is None:
+        _limiter = SQLiteRateLimiter() if RATE_LIMIT_BACKEND == "sqlite" else MemoryRateLimiter()
+    return _limiter
+
+
+def client_ip():
+    """Client address, taken from X-Forwarded-For only as far as TRUSTED_PROXY_HOPS allows"""
+    if TRUSTED_PROXY_HOPS:
+        forwarded = [ip.strip() for ip in request.headers.get("X-Forwarded-For", "").split(",") if ip.strip()]
+        if len(forwarded) >= TRUSTED_PROXY_HOPS:
+            return forwarded[-TRUSTED_PROXY_HOPS]
+    return request.remote_addr or "unknown"
+
+
+def rate_limit(name, user=None, ip=None, get_user=None):
+    """
+    Route decorator applying token buckets. user / ip are (capacity, refill_seconds)
+    budgets: a burst of capacity requests, refilled at capacity per refill_seconds.
+    get_user returns the caller's id (or None; anonymous callers only get the IP bucket).
+    Over budget the route answers 429 with Retry-After. Limiter errors fail open.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if not RATE_LIMITS_ENABLED:
+                return view(*args, **kwargs)
+
+            checks = []
+            if ip:
+                checks.append((f"{name}:ip:{client_ip()}", ip))
+            user_id = get_user() if user and get_user else None
+            if user_id:
+                checks.append((f"{name}:user:{user_id}", user))
+
+            limiter = get_rate_limiter()
+            for key, (capacity, refill_seconds) in checks:
+                try:
+                    retry_after = limiter.consume(key, capacity, refill_seconds)
+                except sqlite3.Error as e:
+                    print(f"[RateLimit] ERROR checking {key}: {e}")
+                    continue
+                if retry_after:
+                    retry_after = max(1, math.ceil(retry_after))
+                    print(f"[RateLimit] {key} over budget, retry in {retry_after}s")
+                    response = jsonify({"error": "Too many requests. Please slow down.", "retry_after": retry_after})
+                    response.status_code = 429
+                    response.headers["Retry-After"] = str(retry_after)
+                    return response
+            return view(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def benchmark_rate_limiter(checks=20000):
+    """Average cost of one bucket check on each backend."""
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        limiters = {
+            "memory": MemoryRateLimiter(),
+            "sqlite": SQLiteRateLimiter(os.path.join(tmp, "rate_limits.db")),
+        }
+        for backend, limiter in limiters.items():
+            start = time.perf_counter()
+            for i in range(checks):
+                limiter.consume(f"bench:user:{i % 500}", 10, 60)
+            elapsed = time.perf_counter() - start
+            print(f"[RateLimit] {backend}: {elapsed / checks * 1e6:.1f}us per check")
+
+
+if __name__ == "__main__":
+    # Usage: python -m backend.security bench [checks]
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark_rate_limiter(int(sys.argv[2]) if len(sys.argv) > 2 else 20000)
+    else:
+        print("Usage: python -m backend.security bench [checks]")
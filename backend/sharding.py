@@ -0,0 +1,454 @@
+import os
+import sys
+import time
+import zlib
+import heapq
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+
+DB_PATH = "database/bnpl.db"
+SHARD_DIR = os.getenv("BNPL_SHARD_DIR", "database")
+SHARD_MAP_PATH = os.getenv("BNPL_SHARD_MAP_PATH", os.path.join(SHARD_DIR, "shard_map.db"))
+
+# Shard count used until the resharding tool has written a layout to the shard map
+DEFAULT_SHARD_COUNT = max(1, int(os.getenv("BNPL_SHARD_COUNT", "1")))
+
+# How long a worker trusts its cached copy of the layout before re-reading the shard map
+LAYOUT_CACHE_TTL = 2.0
+
+# Per-user tables that move together when a user is resharded: (table, user column, keep primary key)
+SHARDED_TABLES = [
+    ("bnpl_records", "user_email", True),
+    ("users", "email", False),
+    ("bnpl_archive", "user_email", True),
+    ("bnpl_record_sources", "user_email", True),
+    ("bnpl_message_tombstones", "user_email", True),
+    ("user_data_versions", "user_email", True),
+    ("dues_calendar", "user_email", True),
+    ("risk_history", "user_email", True),
+    ("risk_rollups", "user_email", True),
+]
+
+_layout_cache = {"layout": None, "loaded_at": 0.0}
+_layout_lock = threading.Lock()
+
+
+def shard_index(user_email, shard_count):
+    """Stable shard number for a user (crc32 is identical across processes, unlike hash())."""
+    return zlib.crc32((user_email or "").encode("utf-8")) % shard_count
+
+
+def shard_path(index, shard_count, generation=0):
+    """File path of one shard. The single-shard generation-0 layout is the original bnpl.db."""
+    if generation == 0 and shard_count == 1:
+        return DB_PATH
+    return os.path.join(SHARD_DIR, f"bnpl_g{generation}_{index}.db")
+
+
+def shard_id_base(index, generation=0):
+    """
+    First AUTOINCREMENT id handed out by a shard.
+    Every (generation, index) owns its own 2^32 id range, so record ids stay globally
+    unique and can be copied verbatim when a user moves to a newer layout.
+    """
+    return ((generation * 4096) + index) << 32
+
+
+def _connect_map():
+    conn = sqlite3.connect(SHARD_MAP_PATH)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS shard_config (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS shard_map (
+            user_email TEXT PRIMARY KEY,
+            generation INTEGER
+        )
+    """)
+    return conn
+
+
+def get_layout(refresh=False):
+    """
+    Current shard layout as a dict:
+    generation, shard_count and, while a reshard is running, target_generation/target_count.
+    """
+    now = time.monotonic()
+    with _layout_lock:
+        cached = _layout_cache["layout"]
+        if cached and not refresh and now - _layout_cache["loaded_at"] < LAYOUT_CACHE_TTL:
+            return cached
+
+        layout = {
+            "generation": 0,
+            "shard_count": DEFAULT_SHARD_COUNT,
+            "target_generation": None,
+            "target_count": None
+        }
+        if os.path.exists(SHARD_MAP_PATH):
+            conn = _connect_map()
+            for key, value in conn.execute("SELECT key, value FROM shard_config"):
+                layout[key] = value
+            conn.close()
+
+        _layout_cache["layout"] = layout
+        _layout_cache["loaded_at"] = now
+        return layout
+
+
+def _user_generation(user_email, layout):
+    """Generation a user currently lives in (users move one at a time during a reshard)."""
+    if layout["target_generation"] is None:
+        return layout["generation"]
+
+    conn = _connect_map()
+    row = conn.execute(
+        "SELECT generation FROM shard_map WHERE user_email = ?", (user_email,)
+    ).fetchone()
+    conn.close()
+    return row[0] if row else layout["generation"]
+
+
+def get_shard_path(user_email):
+    """Resolve the shard file holding all rows of one user."""
+    layout = get_layout()
+    generation = _user_generation(user_email, layout)
+    if generation == layout["generation"]:
+        count = layout["shard_count"]
+    else:
+        count = layout["target_count"]
+    return shard_path(shard_index(user_email, count), count, generation)
+
+
+def get_connection(user_email):
+    """Open a connection to the shard that owns user_email."""
+    return sqlite3.connect(get_shard_path(user_email))
+
+
+def all_shard_paths():
+    """Every shard file that may hold rows right now (both layouts while resharding)."""
+    layout = get_layout()
+    paths = [
+        shard_path(i, layout["shard_count"], layout["generation"])
+        for i in range(layout["shard_count"])
+    ]
+    if layout["target_generation"] is not None:
+        paths += [
+            shard_path(i, layout["target_count"], layout["target_generation"])
+            for i in range(layout["target_count"])
+        ]
+    return paths
+
+
+def fan_out_query(sql, params=(), sort_key=None, reverse=False):
+    """
+    Run a read query on every shard and merge the rows.
+    With sort_key the per-shard results (already ORDERed by the same key) are
+    merged lazily instead of re-sorted, so the ordering of the SQL is preserved.
+    """
+    results = []
+    for path in all_shard_paths():
+        if not os.path.exists(path):
+            continue
+        conn = sqlite3.connect(path)
+        try:
+            results.append(conn.execute(sql, params).fetchall())
+        finally:
+            conn.close()
+
+    if sort_key is None:
+        return [row for rows in results for row in rows]
+    return list(heapq.merge(*results, key=sort_key, reverse=reverse))
+
+
+def fan_out_execute(sql, params=()):
+    """Run a write statement on every shard. Returns the total number of rows changed."""
+    changed = 0
+    for path in all_shard_paths():
+        if not os.path.exists(path):
+            continue
+        conn = sqlite3.connect(path)
+        try:
+            changed += conn.execute(sql, params).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+    return changed
+
+
+def seed_id_range(conn, index, generation=0):
+    """Start AUTOINCREMENT of a fresh shard at its own id range."""
+    base = shard_id_base(index, generation)
+    if base == 0:
+        return
+    for table, _, keep_id in SHARDED_TABLES:
+        if not keep_id:
+            continue
+        sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = ?", (table,)).fetchone()
+        if not sql or "AUTOINCREMENT" not in sql[0].upper():
+            continue
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+        if row is None:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, base))
+
+
+def _move_user(user_email, source_path, target_path, target_generation):
+    """Copy one user's rows to the target shard, repoint the shard map, then delete the source rows."""
+    source = sqlite3.connect(source_path, timeout=30)
+    target = sqlite3.connect(target_path, timeout=30)
+    try:
+        # Block writers for this user's shard while the rows are in flight
+        source.execute("BEGIN IMMEDIATE")
+
+        for table, user_column, keep_id in SHARDED_TABLES:
+            cursor = source.execute(f"SELECT * FROM {table} WHERE {user_column} = ?", (user_email,))
+            columns = [d[0] for d in cursor.description]
+            rows = cursor.fetchall()
+            if not keep_id and "id" in columns:
+                pos = columns.index("id")
+                columns = columns[:pos] + columns[pos + 1:]
+                rows = [row[:pos] + row[pos + 1:] for row in rows]
+            if rows:
+                placeholders = ", ".join("?" for _ in columns)
+                target.executemany(
+                    f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+                    rows
+                )
+        target.commit()
+
+        conn = _connect_map()
+        conn.execute(
+            "INSERT OR REPLACE INTO shard_map (user_email, generation) VALUES (?, ?)",
+            (user_email, target_generation)
+        )
+        conn.commit()
+        conn.close()
+
+        for table, user_column, _ in SHARDED_TABLES:
+            source.execute(f"DELETE FROM {table} WHERE {user_column} = ?", (user_email,))
+        source.commit()
+    finally:
+        source.close()
+        target.close()
+
+
+def _users_in_shard(path):
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("""
+            SELECT user_email FROM bnpl_records WHERE user_email IS NOT NULL
+            UNION
+            SELECT user_email FROM bnpl_archive WHERE user_email IS NOT NULL
+            UNION
+            SELECT email FROM users WHERE email IS NOT NULL
+            UNION
+            SELECT user_email FROM user_data_versions WHERE user_email IS NOT NULL
+        """).fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows]
+
+
+def reshard(new_count, init_shard, keep_old=False):
+    """
+    Online resharding: move every user from the current layout to new_count shards.
+
+    Users are moved one at a time, so the app keeps serving while this runs.
+    init_shard(conn, index, generation) creates the schema on a new shard file.
+    Returns the number of users moved.
+    """
+    layout = get_layout(refresh=True)
+    if layout["target_generation"] is not None:
+        # Resume an interrupted run
+        target_generation = layout["target_generation"]
+        new_count = layout["target_count"]
+    else:
+        target_generation = layout["generation"] + 1
+
+    for index in range(new_count):
+        conn = sqlite3.connect(shard_path(index, new_count, target_generation))
+        init_shard(conn, index, target_generation)
+        conn.close()
+
+    conn = _connect_map()
+    conn.executemany(
+        "INSERT OR REPLACE INTO shard_config (key, value) VALUES (?, ?)",
+        [
+            ("generation", layout["generation"]),
+            ("shard_count", layout["shard_count"]),
+            ("target_generation", target_generation),
+            ("target_count", new_count)
+        ]
+    )
+    conn.commit()
+    conn.close()
+    get_layout(refresh=True)
+
+    source_paths = [
+        shard_path(i, layout["shard_count"], layout["generation"])
+        for i in range(layout["shard_count"])
+    ]
+
+    moved = 0
+    # Keep sweeping until the old layout is empty: workers still holding a cached
+    # layout can land a few late writes in a source shard after its users moved.
+    while True:
+        pending = 0
+        for source_path in source_paths:
+            if not os.path.exists(source_path):
+                continue
+            for user_email in _users_in_shard(source_path):
+                target_path = shard_path(shard_index(user_email, new_count), new_count, target_generation)
+                _move_user(user_email, source_path, target_path, target_generation)
+                pending += 1
+                print(f"[Shard] Moved {user_email} -> {target_path}")
+        moved += pending
+        if pending == 0:
+            time.sleep(LAYOUT_CACHE_TTL * 2)
+            if not any(os.path.exists(p) and _users_in_shard(p) for p in source_paths):
+                break
+
+    conn = _connect_map()
+    conn.executemany(
+        "INSERT OR REPLACE INTO shard_config (key, value) VALUES (?, ?)",
+        [
+            ("generation", target_generation),
+            ("shard_count", new_count),
+            ("target_generation", None),
+            ("target_count", None)
+        ]
+    )
+    conn.execute("DELETE FROM shard_map")
+    conn.commit()
+    conn.close()
+    get_layout(refresh=True)
+
+    if not keep_old:
+        time.sleep(LAYOUT_CACHE_TTL * 2)
+        for source_path in source_paths:
+            if source_path != DB_PATH and os.path.exists(source_path):
+                os.remove(source_path)
+
+    print(f"[Shard] Reshard complete: {moved} users now on {new_count} shards (generation {target_generation})")
+    return moved
+
+
+def benchmark_sync_writes(init_shard, shard_counts=(1, 2, 4, 8), users=16, records_per_user=200):
+    """
+    Concurrent multi-user sync write throughput against shard count.
+    Every user gets its own thread committing one record per transaction,
+    the same pattern as insert_bnpl_record during /api/emails/sync.
+    Returns {shard_count: records_per_second}.
+    """
+    results = {}
+    for count in shard_counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, f"bench_{i}.db") for i in range(count)]
+            for index, path in enumerate(paths):
+                conn = sqlite3.connect(path)
+                init_shard(conn, index, 0)
+                conn.close()
+
+            def sync_user(user_email):
+                conn = sqlite3.connect(paths[shard_index(user_email, count)], timeout=60)
+                for n in range(records_per_user):
+                    conn.execute("""
+                        INSERT INTO bnpl_records (user_email, gmail_message_id, vendor, amount, installments, due_date, email_subject)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """, (user_email, f"msg-{n}", "LazyPay", 1200.0, 3, "01/01/2030", "Installment due"))
+                    conn.commit()
+                conn.close()
+
+            threads = [
+                threading.Thread(target=sync_user, args=(f"user{u}@example.com",))
+                for u in range(users)
+            ]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+
+        results[count] = round(users * records_per_user / elapsed, 1)
+        print(f"[Shard] {count} shard(s): {results[count]} records/s")
+    return results
+
+
+def selftest(users=6, new_count=3):
+    """
+    Reshard a scratch database and check that every per-user table arrives intact:
+    records, archive, risk history and rollups, and the dues calendar.
+    """
+    global LAYOUT_CACHE_TTL
+    from backend import models
+    from backend.finance import month_key
+    from backend.risk_history import get_risk_history
+
+    def snapshot(user_email):
+        today = datetime.now().date()
+        return (
+            models.get_bnpl_records(user_email),
+            get_risk_history(user_email, "raw", today, today),
+            get_risk_history(user_email, "month", today, today),
+            models.get_dues_calendar(user_email, month_key(today), 6),
+        )
+
+    cwd = os.getcwd()
+    cache_ttl = LAYOUT_CACHE_TTL
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        # No other workers hold a cached layout here
+        LAYOUT_CACHE_TTL = 0.05
+        try:
+            os.makedirs(os.path.dirname(DB_PATH))
+            get_layout(refresh=True)
+            models.init_db()
+            emails = [f"user{u}@example.com" for u in range(users)]
+            for u, email in enumerate(emails):
+                for n in range(u + 1):
+                    models.insert_bnpl_record(email, f"msg-{n}", "LazyPay", 1000.0 * (n + 1), 3,
+                                              "01/01/2030", "Installment due")
+                models.update_user_salary(email, 40000 + u)
+            before = {email: snapshot(email) for email in emails}
+            assert all(history for _, history, _, _ in before.values())
+
+            reshard(new_count, models.init_shard)
+            after = {email: snapshot(email) for email in emails}
+            for email in emails:
+                assert after[email] == before[email], f"{email} lost rows in the reshard"
+            print(f"[Shard] {users} users resharded to {new_count} shards with records, "
+                  f"risk history and dues calendar intact")
+        finally:
+            LAYOUT_CACHE_TTL = cache_ttl
+            os.chdir(cwd)
+            get_layout(refresh=True)
+
+
+if __name__ == "__main__":
+    # Usage:
+    #   python -m backend.sharding status
+    #   python -m backend.sharding reshard <count> [--keep-old]
+    #   python -m backend.sharding bench [counts...]
+    #   python -m backend.sharding selftest
+    from backend.models import init_shard
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "status"
+    if command == "reshard":
+        reshard(int(sys.argv[2]), init_shard, keep_old="--keep-old" in sys.argv)
+    elif command == "selftest":
+        # Run in the imported module, whose layout cache models reads through
+        from backend.sharding import selftest
+        selftest()
+    elif command == "bench":
+        counts = [int(c) for c in sys.argv[2:]] or [1, 2, 4, 8]
+        benchmark_sync_writes(init_shard, shard_counts=counts)
+    else:
+        print(get_layout(refresh=True))
+        for path in all_shard_paths():
+            print(path, "exists" if os.path.exists(path) else "missing")
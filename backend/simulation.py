@@ -0,0 +1,349 @@
+import sys
+import math
+import time
+import heapq
+from datetime import date
+import numpy as np
+from backend.finance import monthly_dues, month_key, format_month, risk_from_debt_ratio
+
+# calculate_affordability treats EMIs above 30% of income as over the safe limit
+SAFE_EMI_RATIO = 0.3
+
+DEFAULT_PATHS = 10000
+MAX_PATHS = 50000
+MIN_MONTHS = 12
+MAX_MONTHS = 24
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# Scenario assumptions, per month
+INCOME_SHOCK_PROBABILITY = 0.02    # chance an income shock (job loss, pay cut) starts
+INCOME_SHOCK_RECOVERY = 0.25       # chance a shocked income recovers
+INCOME_SHOCK_LEVEL = (0.0, 0.7)    # share of salary still earned during a shock (uniform)
+INCOME_NOISE = 0.03                # salary variation (standard deviation, share of salary)
+EXPENSE_SIGMA = 0.15               # lognormal sigma of other expenses; the mean is kept
+PURCHASE_RATE = 0.4                # new BNPL purchases (Poisson mean)
+PURCHASE_SIGMA = 0.6               # lognormal sigma of new purchase amounts
+PURCHASE_INSTALLMENTS = (3, 4, 6, 12)
+DEFAULT_PURCHASE_AMOUNT = 5000     # median new purchase for users without records
+
+
+def existing_dues(records, first_month, months):
+    """Installments of the active records due in each simulated month (array)"""
+    year, month = divmod(first_month, 12)
+    dues = monthly_dues(records, since=date(year, month + 1, 1))
+    return np.array([dues.get(first_month + m, (0, 0))[0] for m in range(months)], dtype=np.float64)
+
+
+def _percentile_bands(values):
+    bands = np.percentile(values, PERCENTILES, axis=0)
+    return [
+        {f"p{p}": round(float(v), 2) for p, v in zip(PERCENTILES, column)}
+        for column in bands.T
+    ]
+
+
+def simulate_cash_flow(salary, rent, other_expenses, records, paths=DEFAULT_PATHS, months=MIN_MONTHS,
+                       seed=0, start=None):
+    """
+    Monte Carlo of a user's monthly cash flow over `months` months from start's month.
+    Every path draws income shocks, expense variance and new BNPL purchases; all paths
+    advance together one month at a time as NumPy arrays. The same seed and inputs
+    always give the same result.
+    Returns the probability of breaching SAFE_EMI_RATIO and percentile bands.
+    """
+    started = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    first_month = month_key(start or date.today())
+    dues = existing_dues(records, first_month, months)
+
+    amounts = [record.get("amount") for record in records if record.get("amount")]
+    median_purchase = float(np.median(amounts)) if amounts else DEFAULT_PURCHASE_AMOUNT
+    plans = np.array(PURCHASE_INSTALLMENTS)
+
+    # Room after the horizon so purchases in the last months need no bounds checks
+    obligation = np.zeros((paths, months + 1 + plans.max()))
+    obligation[:, :months] = dues
+    income = np.empty((paths, months))
+    shocked = np.zeros(paths, dtype=bool)
+    level = np.ones(paths)
+    path_index = np.arange(paths)
+
+    for m in range(months):
+        starts = ~shocked & (rng.random(paths) < INCOME_SHOCK_PROBABILITY)
+        recovers = shocked & (rng.random(paths) < INCOME_SHOCK_RECOVERY)
+        level[starts] = rng.uniform(*INCOME_SHOCK_LEVEL, starts.sum())
+        shocked = (shocked | starts) & ~recovers
+        income[:, m] = salary * np.where(shocked, level, 1.0) * (1 + INCOME_NOISE * rng.standard_normal(paths))
+
+        # New purchases are paid from the following month on
+        counts = rng.poisson(PURCHASE_RATE, paths)
+        owners = np.repeat(path_index, counts)
+        purchases = rng.lognormal(np.log(median_purchase), PURCHASE_SIGMA, len(owners))
+        chosen = rng.choice(plans, len(owners))
+        for installments in PURCHASE_INSTALLMENTS:
+            mask = chosen == installments
+            if mask.any():
+                per_month = np.bincount(owners[mask], weights=purchases[mask] / installments, minlength=paths)
+                obligation[:, m + 1:m + 1 + installments] += per_month[:, None]
+
+    obligation = obligation[:, :months]
+    expenses = other_expenses * rng.lognormal(-EXPENSE_SIGMA ** 2 / 2, EXPENSE_SIGMA, (paths, months))
+    cash_flow = income - rent - expenses - obligation
+    balance = np.cumsum(cash_flow, axis=1)
+    breaches = obligation > SAFE_EMI_RATIO * np.maximum(income, 0)
+
+    cash_flow_bands = _percentile_bands(cash_flow)
+    balance_bands = _percentile_bands(balance)
+    monthly_breach = breaches.mean(axis=0)
+    return {
+        "paths": paths,
+        "months": months,
+        "seed": seed,
+        "breach_probability": round(float(breaches.any(axis=1).mean()), 4),
+        "negative_balance_probability": round(float((balance < 0).any(axis=1).mean()), 4),
+        "monthly": [
+            {
+                "month": format_month(first_month + m),
+                "existing_dues": round(float(dues[m]), 2),
+                "breach_probability": round(float(monthly_breach[m]), 4),
+                "cash_flow": cash_flow_bands[m],
+                "balance": balance_bands[m]
+            }
+            for m in range(months)
+        ],
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+    }
+
+
+# --- Payoff planner --------------------------------------------------------
+
+# BNPL plans in this app carry no interest, so "avalanche" (costliest debt first)
+# targets the largest balance; "risk" targets the plan whose payoff frees the most
+# monthly obligation per rupee, which lowers the debt ratio fastest
+PAYOFF_STRATEGIES = {
+    "avalanche": lambda balance, payment: -balance,
+    "snowball": lambda balance, payment: balance,
+    "risk": lambda balance, payment: -payment / balance,
+}
+
+# Balances below this (half a paisa) count as cleared
+PAYOFF_EPSILON = 0.005
+MAX_PAYOFF_MONTHS = 600
+
+
+def _payoff_debts(records):
+    """(id, balance, minimum payment) of records with an outstanding amount"""
+    debts = []
+    for position, record in enumerate(records):
+        amount = record.get("amount")
+        if not amount or amount <= 0:
+            continue
+        installments = record.get("installments")
+        payment = amount / installments if installments and installments > 0 else amount
+        debts.append((record.get("id", position), amount, payment))
+    return debts
+
+
+def payoff_plan(records, surplus, strategy="avalanche", salary=None, start=None):
+    """
+    Month-by-month plan clearing the records' balances. Every month each plan gets its
+    installment; the surplus plus installments freed by cleared plans go to the
+    strategy's current target. Plans are only touched when they are targeted or clear:
+    a min-heap of natural payoff months retires plans on minimum payments, and a heap
+    in strategy order yields the next target, so a month costs O(log n) instead of a
+    pass over every record.
+    """
+    rank = PAYOFF_STRATEGIES[strategy]
+    debts = _payoff_debts(records)
+    ids = [debt[0] for debt in debts]
+    balance0 = [debt[1] for debt in debts]
+    payment = [debt[2] for debt in debts]
+    extra_paid = [0.0] * len(debts)
+    finish = [math.ceil(b / p - 1e-9) for b, p in zip(balance0, payment)]
+    alive = [True] * len(debts)
+    live = len(debts)
+
+    finish_heap = [(f, i) for i, f in enumerate(finish)]
+    heapq.heapify(finish_heap)
+    target_heap = [(rank(b, p), i) for i, (b, p) in enumerate(zip(balance0, payment))]
+    heapq.heapify(target_heap)
+
+    minimum_total = sum(payment)
+    budget = minimum_total + max(surplus, 0)
+    remaining = sum(balance0)
+    first_month = month_key(start or date.today())
+    plan = []
+    order = []
+    total_paid = 0.0
+    month = 0
+
+    def balance_after(i, month):
+        # Balance once `month` installments and any extra payments went in
+        return balance0[i] - payment[i] * month - extra_paid[i]
+
+    while live and month < MAX_PAYOFF_MONTHS:
+        month += 1
+        cleared = []
+        paid_minimum = minimum_total
+
+        # Plans whose last installment falls this month pay only what is left
+        while finish_heap and finish_heap[0][0] <= month:
+            due_month, i = heapq.heappop(finish_heap)
+            if not alive[i] or due_month != finish[i]:
+                continue
+            paid_minimum -= payment[i] - balance_after(i, month - 1)
+            minimum_total -= payment[i]
+            alive[i] = False
+            live -= 1
+            cleared.append(i)
+
+        extra = max(budget - paid_minimum, 0) if surplus > 0 else 0
+        extra_spent = 0.0
+        extra_to = []
+        while extra > PAYOFF_EPSILON and target_heap:
+            i = target_heap[0][1]
+            if not alive[i]:
+                heapq.heappop(target_heap)
+                continue
+            amount = min(extra, balance_after(i, month))
+            extra_paid[i] += amount
+            extra -= amount
+            extra_spent += amount
+            extra_to.append(i)
+            left = balance_after(i, month)
+            if left <= PAYOFF_EPSILON:
+                heapq.heappop(target_heap)
+                minimum_total -= payment[i]
+                alive[i] = False
+                live -= 1
+                cleared.append(i)
+            else:
+                finish[i] = month + math.ceil(left / payment[i] - 1e-9)
+                heapq.heappush(finish_heap, (finish[i], i))
+
+        paid = paid_minimum + extra_spent
+        remaining -= paid
+        total_paid += paid
+        order.extend(ids[i] for i in cleared)
+        row = {
+            "month": format_month(first_month + month - 1),
+            "paid": round(paid, 2),
+            "minimum_paid": round(paid_minimum, 2),
+            "extra_paid": round(extra_spent, 2),
+            "extra_to": [ids[i] for i in extra_to],
+            "cleared": [ids[i] for i in cleared],
+            "remaining_balance": round(max(remaining, 0), 2),
+            "monthly_obligation": round(max(minimum_total, 0), 2)
+        }
+        if salary:
+            debt_ratio = max(minimum_total, 0) / salary
+            row["debt_ratio"] = round(debt_ratio, 4)
+            row["risk_score"] = risk_from_debt_ratio(debt_ratio)[0]
+        plan.append(row)
+
+    return {
+        "strategy": strategy,
+        "surplus": round(surplus, 2),
+        "months_to_debt_free": None if live else month,
+        "debt_free_month": plan[-1]["month"] if plan and not live else None,
+        "total_paid": round(total_paid, 2),
+        "payoff_order": order,
+        "plan": plan
+    }
+
+
+def _payoff_plan_rescan(records, surplus, strategy):
+    """Reference planner that walks every record every month; used by benchmark_payoff."""
+    rank = PAYOFF_STRATEGIES[strategy]
+    debts = _payoff_debts(records)
+    balance = [debt[1] for debt in debts]
+    payment = [debt[2] for debt in debts]
+    targets = sorted(range(len(debts)), key=lambda i: (rank(balance[i], payment[i]), i))
+    budget = sum(payment) + max(surplus, 0)
+    remaining_by_month = []
+    while any(b > PAYOFF_EPSILON for b in balance):
+        paid = 0.0
+        for i, b in enumerate(balance):
+            if b > PAYOFF_EPSILON:
+                amount = min(payment[i], b)
+                balance[i] -= amount
+                paid += amount
+        extra = max(budget - paid, 0) if surplus > 0 else 0
+        for i in targets:
+            if extra <= PAYOFF_EPSILON:
+                break
+            if balance[i] > PAYOFF_EPSILON:
+                amount = min(extra, balance[i])
+                balance[i] -= amount
+                extra -= amount
+        remaining_by_month.append(round(max(sum(b for b in balance if b > PAYOFF_EPSILON), 0), 2))
+    return remaining_by_month
+
+
+def benchmark_payoff(record_count=500, runs=5, seed=48):
+    """
+    Plan every strategy for a user with record_count plans and compare the heap planner
+    with a full rescan per month: same month count and (to the paisa) same balances.
+    """
+    rng = np.random.default_rng(seed)
+    records = [
+        {"id": i, "amount": float(round(amount, 2)), "installments": int(n)}
+        for i, (amount, n) in enumerate(zip(
+            rng.uniform(500, 60000, record_count), rng.choice([3, 4, 6, 9, 12, 24], record_count)
+        ))
+    ]
+    minimums = sum(r["amount"] / r["installments"] for r in records)
+    # Minimum payments only (the longest horizon), then a surplus of 2% of the minimums
+    scenarios = [("avalanche", 0)] + [(strategy, 0.02 * minimums) for strategy in PAYOFF_STRATEGIES]
+    for strategy, surplus in scenarios:
+        heap_times, rescan_times = [], []
+        for _ in range(runs):
+            start = time.perf_counter()
+            result = payoff_plan(records, surplus, strategy)
+            heap_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            reference = _payoff_plan_rescan(records, surplus, strategy)
+            rescan_times.append(time.perf_counter() - start)
+        balances = [row["remaining_balance"] for row in result["plan"]]
+        assert len(balances) == len(reference), f"{strategy}: {len(balances)} vs {len(reference)} months"
+        assert all(abs(a - b) <= 0.05 for a, b in zip(balances, reference)), f"{strategy}: balances differ"
+        print(f"[Payoff] {strategy:9s} surplus {surplus:9.0f}, {record_count} plans: "
+              f"debt-free in {result['months_to_debt_free']} months; "
+              f"heap {min(heap_times) * 1000:.2f}ms vs rescan {min(rescan_times) * 1000:.2f}ms")
+
+
+def benchmark(paths=DEFAULT_PATHS, months=MAX_MONTHS, runs=5):
+    """Time simulate_cash_flow for a sample user and check seeded reproducibility."""
+    today = date.today()
+    records = [
+        {"amount": 12000, "installments": 6, "due_date": today.replace(day=1).strftime("%d/%m/%Y")},
+        {"amount": 4500, "installments": 3, "due_date": today.strftime("%d/%m/%Y")},
+        {"amount": 30000, "installments": 12, "due_date": today.replace(day=28).strftime("%d/%m/%Y")},
+    ]
+    results = []
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        results.append(simulate_cash_flow(45000, 12000, 8000, records, paths, months, seed=7))
+        timings.append(time.perf_counter() - start)
+
+    first = dict(results[0], elapsed_ms=None)
+    assert all(dict(r, elapsed_ms=None) == first for r in results), "same seed gave different results"
+    other = simulate_cash_flow(45000, 12000, 8000, records, paths, months, seed=8)
+    assert other["monthly"] != first["monthly"], "different seeds gave identical results"
+    print(f"[Simulation] {paths} paths x {months} months: best {min(timings) * 1000:.1f}ms, "
+          f"worst {max(timings) * 1000:.1f}ms over {runs} runs; seeded runs identical")
+    print(f"[Simulation] breach probability {first['breach_probability']}, "
+          f"negative balance probability {first['negative_balance_probability']}")
+
+
+if __name__ == "__main__":
+    # Usage: python -m backend.simulation bench [paths] [months] | payoff [records]
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    args = [int(a) for a in sys.argv[2:4]]
+    if command == "bench":
+        benchmark(*args)
+    elif command == "payoff":
+        benchmark_payoff(*args[:1])
+    else:
+        print("Usage: python -m backend.simulation bench [paths] [months] | payoff [records]")
@@ -0,0 +1,301 @@
+import os
+import sys
+import json
+import time
+import heapq
+import sqlite3
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+
+# "sqlite" shares entries between gunicorn workers; "memory" is per process
+TTL_STORE_BACKEND = os.getenv("TTL_STORE_BACKEND", "sqlite")
+TTL_STORE_PATH = os.getenv("TTL_STORE_PATH", "database/ttl_store.db")
+
+# Seconds between background sweeps of expired entries
+SWEEP_INTERVAL = float(os.getenv("TTL_STORE_SWEEP_INTERVAL", "60"))
+
+
+class TTLStore(ABC):
+    """
+    Short-lived key/value store. Values must be JSON-serializable.
+    take() returns and removes an entry atomically, so a key can be redeemed only once;
+    expired entries are never returned and are removed by sweep().
+    """
+
+    @abstractmethod
+    def put(self, key, value, ttl):
+        pass
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def take(self, key):
+        pass
+
+    @abstractmethod
+    def add(self, key, value, ttl):
+        """put() only if the key is absent or expired; True when this call stored it."""
+
+    @abstractmethod
+    def sweep(self):
+        """Remove expired entries; returns how many were removed."""
+
+    def start_sweeper(self, interval=SWEEP_INTERVAL):
+        """Sweep periodically on a daemon thread."""
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sweep()
+                except sqlite3.Error as e:
+                    print(f"[TTLStore] ERROR sweeping: {e}")
+
+        threading.Thread(target=loop, name="ttl-store-sweeper", daemon=True).start()
+        return self
+
+
+class MemoryTTLStore(TTLStore):
+    """Per-process store: dict of (value, expires_at) plus a heap ordered by expiry."""
+
+    def __init__(self):
+        self._data = {}
+        self._expiry = []
+        self._lock = threading.Lock()
+
+    def put(self, key, value, ttl):
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            heapq.heappush(self._expiry, (expires_at, key))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def take(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def add(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] > now:
+                return False
+            self._data[key] = (value, now + ttl)
+            heapq.heappush(self._expiry, (now + ttl, key))
+        return True
+
+    def sweep(self):
+        now = time.time()
+        removed = 0
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                expires_at, key = heapq.heappop(self._expiry)
+                entry = self._data.get(key)
+                # A key that was re-put later has a newer heap entry; leave it
+                if entry is not None and entry[1] == expires_at:
+                    del self._data[key]
+                    removed += 1
+        return removed
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteTTLStore(TTLStore):
+    """Store shared by every process that opens the same file; one namespace per use."""
+
+    def __init__(self, namespace, path=TTL_STORE_PATH):
+        self.namespace = namespace
+        self.path = path
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS ttl_entries (
+                namespace TEXT,
+                key TEXT,
+                value TEXT,
+                expires_at REAL,
+                PRIMARY KEY (namespace, key)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ttl_entries_expiry ON ttl_entries(expires_at)")
+        conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def put(self, key, value, ttl):
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO ttl_entries (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value), time.time() + ttl)
+            )
+        finally:
+            conn.close()
+
+    def get(self, key):
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT value FROM ttl_entries WHERE namespace = ? AND key = ? AND expires_at > ?",
+                (self.namespace, key, time.time())
+            ).fetchone()
+        finally:
+            conn.close()
+        return json.loads(row[0]) if row else None
+
+    def take(self, key):
+        conn = self._connect()
+        try:
+            # The write lock makes read-then-delete atomic across processes
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT value, expires_at FROM ttl_entries WHERE namespace = ? AND key = ?",
+                (self.namespace, key)
+            ).fetchone()
+            if row:
+                conn.execute("DELETE FROM ttl_entries WHERE namespace = ? AND key = ?", (self.namespace, key))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        if not row or row[1] <= time.time():
+            return None
+        return json.loads(row[0])
+
+    def add(self, key, value, ttl):
+        now = time.time()
+        conn = self._connect()
+        try:
+            # The conflict update only fires for an expired entry; rowcount is 0 otherwise
+            return conn.execute("""
+                INSERT INTO ttl_entries (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+                WHERE ttl_entries.expires_at <= ?
+            """, (self.namespace, key, json.dumps(value), now + ttl, now)).rowcount == 1
+        finally:
+            conn.close()
+
+    def sweep(self):
+        conn = self._connect()
+        try:
+            return conn.execute(
+                "DELETE FROM ttl_entries WHERE namespace = ? AND expires_at <= ?",
+                (self.namespace, time.time())
+            ).rowcount
+        finally:
+            conn.close()
+
+    def __len__(self):
+        conn = self._connect()
+        try:
+            return conn.execute(
+                "SELECT COUNT(*) FROM ttl_entries WHERE namespace = ? AND expires_at > ?",
+                (self.namespace, time.time())
+            ).fetchone()[0]
+        finally:
+            conn.close()
+
+
+def create_store(namespace, backend=TTL_STORE_BACKEND, sweep_interval=SWEEP_INTERVAL):
+    """Store for TTL_STORE_BACKEND with its background sweeper running."""
+    if backend == "memory":
+        store = MemoryTTLStore()
+    elif backend == "sqlite":
+        store = SQLiteTTLStore(namespace)
+    else:
+        raise ValueError(f"Unknown TTL store backend: {backend}")
+    if sweep_interval > 0:
+        store.start_sweeper(sweep_interval)
+    return store
+
+
+def _race_worker(path, worker, keys, start, results):
+    store = SQLiteTTLStore("selftest", path)
+    taken = []
+    for key in keys:
+        # All workers go for each key at once; otherwise the first to get the write lock
+        # redeems everything while SQLite's busy handler keeps the others backing off
+        start.wait()
+        if store.take(key) is not None:
+            taken.append(key)
+    results.put((worker, taken))
+
+
+def selftest(processes=4, keys=200):
+    """
+    Mint keys in this process and let several processes, released together, race to
+    redeem every one of them: each key must be redeemed exactly once, every process must
+    win some, and expired keys are never redeemed.
+    """
+    import multiprocessing
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "ttl_store.db")
+        store = SQLiteTTLStore("selftest", path)
+        codes = [f"code-{i}" for i in range(keys)]
+        for code in codes:
+            store.put(code, {"email": f"{code}@example.com"}, ttl=60)
+        store.put("expired", {"email": "late@example.com"}, ttl=-1)
+        store.put("unredeemed", {"email": "gone@example.com"}, ttl=-1)
+
+        results = multiprocessing.Queue()
+        start = multiprocessing.Barrier(processes, timeout=30)
+        workers = [
+            multiprocessing.Process(target=_race_worker, args=(path, i, codes + ["expired"], start, results))
+            for i in range(processes)
+        ]
+        for process in workers:
+            process.start()
+        taken = [results.get(timeout=60) for _ in workers]
+        for process in workers:
+            process.join()
+
+        redeemed = sorted(key for _, keys_taken in taken for key in keys_taken)
+        assert len(redeemed) == keys and redeemed == sorted(codes), \
+            "a key was redeemed twice, never, or after expiring"
+        assert all(keys_taken for _, keys_taken in taken), "a process redeemed no keys: the workers never competed"
+        assert store.sweep() == 1 and len(store) == 0
+        store.put("stale", 1, ttl=-1)
+        assert store.add("claim", 1, ttl=60) and not store.add("claim", 2, ttl=60) and store.add("stale", 3, ttl=60)
+        assert store.get("claim") == 1 and store.get("stale") == 3
+        print(f"[TTLStore] {processes} processes redeemed {len(redeemed)} keys, each exactly once: "
+              + ", ".join(f"worker {w}: {len(k)}" for w, k in sorted(taken)))
+
+    memory = MemoryTTLStore()
+    memory.put("a", 1, ttl=60)
+    memory.put("b", 2, ttl=-1)
+    assert memory.take("a") == 1 and memory.take("a") is None and memory.get("b") is None
+    assert memory.add("c", 3, ttl=60) and not memory.add("c", 4, ttl=60) and memory.add("b", 5, ttl=60)
+    assert memory.sweep() == 0 and len(memory) == 2
+    print("[TTLStore] Memory backend OK")
+
+    class PartialStore(TTLStore):
+        def put(self, key, value, ttl):
+            pass
+
+    try:
+        PartialStore()
+    except TypeError:
+        print("[TTLStore] Incomplete backends are rejected when constructed")
+    else:
+        raise AssertionError("a backend without get/take/add/sweep was constructed")
+
+
+if __name__ == "__main__":
+    # Usage: python -m backend.ttl_store selftest [processes]
+    if len(sys.argv) > 1 and sys.argv[1] == "selftest":
+        selftest(int(sys.argv[2]) if len(sys.argv) > 2 else 4)
+    else:
+        print("Usage: python -m backend.ttl_store selftest [processes]")
@@ -114,6 +114,54 @@ api.interceptors.response.use(
   }
 )
 
+// Stream a chat reply from the SSE endpoint. axios cannot read a response body
+// incrementally in the browser, so this uses fetch. onChunk receives each piece of
+// text as it arrives; pass an AbortSignal to cancel (the server then stops the upstream call).
+export const streamChat = async ({ message, history, conversationId, signal, onChunk }) => {
+  await codeExchangePromise.catch(() => {})
+  const token = localStorage.getItem('authToken')
+  const res = await fetch(`${getApiUrl()}/api/chat/stream`, {
+    method: 'POST',
+    credentials: 'include',
+    signal,
+    headers: {
+      'Content-Type': 'application/json',
+      ...(token ? { Authorization: `Bearer ${token}` } : {})
+    },
+    body: JSON.stringify({ message, history, conversation_id: conversationId })
+  })
+  if (!res.ok) {
+    const data = await res.json().catch(() => ({}))
+    throw new Error(data.error || 'Chatbot is unavailable right now.')
+  }
+
+  const reader = res.body.getReader()
+  const decoder = new TextDecoder()
+  let buffer = ''
+  while (true) {
+    const { value, done } = await reader.read()
+    if (done) break
+    buffer += decoder.decode(value, { stream: true })
+
+    let boundary
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const raw = buffer.slice(0, boundary)
+      buffer = buffer.slice(boundary + 2)
+
+      let event = 'message'
+      let data = ''
+      for (const line of raw.split('\n')) {
+        if (line.startsWith('event:')) event = line.slice(6).trim()
+        else if (line.startsWith('data:')) data += line.slice(5).trim()
+      }
+      const payload = data ? JSON.parse(data) : {}
+      if (event === 'chunk') onChunk(payload.text)
+      else if (event === 'error') throw new Error(payload.error)
+      else if (event === 'done') return
+    }
+  }
+}
+
 export default api
 
 
@@ -1,6 +1,6 @@
-import { useState } from 'react'
+import { useState, useRef, useEffect } from 'react'
 import { motion, AnimatePresence } from 'framer-motion'
-import api from '../api/axios'
+import { streamChat } from '../api/axios'
 
 function Chatbot() {
   const [isOpen, setIsOpen] = useState(false)
@@ -8,6 +8,20 @@ function Chatbot() {
   const [input, setInput] = useState('')
   const [loading, setLoading] = useState(false)
   const [error, setError] = useState('')
+  const [streaming, setStreaming] = useState(false)
+  const abortRef = useRef(null)
+  // Lets the server reuse its rolling summary of older turns for this conversation
+  const conversationIdRef = useRef(
+    window.crypto?.randomUUID?.() || `${Date.now()}-${Math.random().toString(36).slice(2)}`
+  )
+
+  // Stop an in-flight reply when the component goes away
+  useEffect(() => () => abortRef.current?.abort(), [])
+
+  const closeChat = () => {
+    abortRef.current?.abort()
+    setIsOpen(false)
+  }
 
   const sendMessage = async (e) => {
     e?.preventDefault()
@@ -20,19 +34,42 @@ function Chatbot() {
     setLoading(true)
     setError('')
 
+    const controller = new AbortController()
+    abortRef.current = controller
+    let started = false
+
     try {
-      const res = await api.post('/api/chat', {
+      await streamChat({
         message: text,
         history: newHistory,
+        conversationId: conversationIdRef.current,
+        signal: controller.signal,
+        onChunk: (chunk) => {
+          // First chunk opens the assistant bubble; later chunks extend it
+          if (!started) {
+            started = true
+            setStreaming(true)
+            setMessages((prev) => [...prev, { role: 'assistant', content: chunk }])
+          } else {
+            setMessages((prev) => {
+              const last = prev[prev.length - 1]
+              return [...prev.slice(0, -1), { ...last, content: last.content + chunk }]
+            })
+          }
+        },
       })
-      const reply = res.data.reply || 'Sorry, I could not generate a response.'
-      setMessages((prev) => [...prev, { role: 'assistant', content: reply }])
+      if (!started) {
+        setMessages((prev) => [...prev, { role: 'assistant', content: 'Sorry, I could not generate a response.' }])
+      }
     } catch (err) {
-      console.error('Chat error:', err)
-      const msg = err.response?.data?.error || 'Chatbot is unavailable right now.'
-      setError(msg)
+      if (err.name !== 'AbortError') {
+        console.error('Chat error:', err)
+        setError(err.message || 'Chatbot is unavailable right now.')
+      }
     } finally {
+      abortRef.current = null
       setLoading(false)
+      setStreaming(false)
     }
   }
 
@@ -64,7 +101,7 @@ function Chatbot() {
                 <p className="text-xs text-[#A1A1AA]">Ask anything about your BNPL health</p>
               </div>
               <button
-                onClick={() => setIsOpen(false)}
+                onClick={closeChat}
                 className="text-[#A1A1AA] hover:text-[#F5F5F5] text-lg leading-none"
               >
                 ×
@@ -90,7 +127,7 @@ function Chatbot() {
                   {m.content}
                 </div>
               ))}
-              {loading && (
+              {loading && !streaming && (
                 <p className="text-xs text-[#A1A1AA]">Thinking...</p>
               )}
               {error && (
@@ -55,23 +55,12 @@ function NewDashboard() {
   const loadData = async () => {
     setLoading(true)
     try {
-      // Load profile
-      const profileRes = await api.get('/api/user/profile')
-      if (profileRes.data.success) {
-        setProfile(profileRes.data.data)
-      }
-      
-      // Load records
-      const recordsRes = await api.get('/api/bnpl/records')
-      setRecords(recordsRes.data.records || [])
-      
-      // Load risk score
-      const riskRes = await api.get('/api/risk-score')
-      setRiskData(riskRes.data)
-      
-      // Load affordability
-      const affordRes = await api.get('/api/affordability')
-      setAffordability(affordRes.data)
+      // Load profile, records, risk score and affordability in one round-trip
+      const res = await api.get('/api/dashboard')
+      setProfile(res.data.profile)
+      setRecords(res.data.records || [])
+      setRiskData(res.data.risk)
+      setAffordability(res.data.affordability)
     } catch (error) {
       console.error('Error loading data:', error)
       showMessage('error', 'Failed to load data')
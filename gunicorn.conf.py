@@ -0,0 +1,21 @@
+import os
+
+# Gmail sync, chat and the OAuth callback spend nearly all their time waiting on
+# outbound HTTP; gevent workers keep serving other requests meanwhile, so a few
+# workers hold hundreds of in-flight calls (python -m backend.http_client loadtest:
+# 4.9 req/s per sync worker vs ~210-255 per gevent worker at 200 concurrent requests
+# with a 200ms upstream). GUNICORN_WORKER_CLASS=sync restores the old
+# one-request-per-worker mode.
+# Those numbers only cover time spent waiting on an upstream. SQLite calls are not
+# cooperative: each one blocks its whole gevent worker, so DB-bound routes (dashboard,
+# export, status updates) scale with the number of workers, not connections, and the
+# load test does not measure them. Compaction and reminders therefore run in the
+# Procfile's separate worker process (python -m backend.jobs), not in web workers.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "500"))
+
+# Longer than the slowest outbound call (a Gmail sync makes ~50 sequential requests)
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5